@@ -3,31 +3,45 @@ import sqlite3
 import json
 import math
 import hashlib
+import zlib
+import ast
 import requests
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 from PIL import Image
 import io
 import base64
 import time
 import numpy as np
 from scipy import stats
+from scipy import sparse
 import statsmodels.api as sm
 import zipfile
 import os
 import uuid
-from scipy.optimize import linprog
+from scipy.optimize import linprog, minimize_scalar
 import joblib
 import random
+import sys
+import shutil
+import threading
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+from itertools import combinations
+from threadpoolctl import threadpool_limits
 
 # Machine Learning
-from sklearn.ensemble import RandomForestRegressor, IsolationForest
-from sklearn.cluster import KMeans
+from sklearn.ensemble import RandomForestRegressor, IsolationForest, HistGradientBoostingRegressor
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics import silhouette_score
 from sklearn.preprocessing import StandardScaler
-from sklearn.model_selection import train_test_split
+from sklearn.model_selection import train_test_split, KFold, cross_validate
+from sklearn.pipeline import make_pipeline
+from sklearn.base import clone
 from sklearn.linear_model import ElasticNet
 
 # Pour l'analyse exploratoire (optionnel)
@@ -46,8 +60,10 @@ import cv2
 # -----------------------------------------------------------------------------
 PHOTO_DIR = "photos_brebis"
 MODEL_DIR = "models"
+GENO_DIR = "genotypes_store"
 os.makedirs(PHOTO_DIR, exist_ok=True)
 os.makedirs(MODEL_DIR, exist_ok=True)
+os.makedirs(GENO_DIR, exist_ok=True)
 
 class Config:
     APP_NAME = "Ovin Manager Pro"
@@ -62,6 +78,33 @@ class Config:
     CYAN = "#00838F"
     
     NCBI_EUTILS_BASE = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils"
+    NCBI_CACHE = "cache_ncbi.db"
+    NCBI_CACHE_TTL_HEURES = 24 * 7
+    NCBI_TIMEOUT = (5, 30)
+    # Limites E-utilities : 3 requêtes/s sans clé, 10 avec NCBI_API_KEY
+    NCBI_REQUETES_SECONDE = 3
+    NCBI_REQUETES_SECONDE_CLE = 10
+    NCBI_ORGANISMES = {
+        "Ovis aries (Mouton)": "Ovis aries",
+        "Capra hircus (Chèvre)": "Capra hircus",
+        "Bos taurus (Bovin)": "Bos taurus",
+    }
+    NCBI_LOT_ESUMMARY = 200
+
+    # Recherche locale de séquences (graines k-mers + extension sans gap, scores blastn 1/-2)
+    RECHERCHE_K = 11
+    RECHERCHE_MATCH = 1
+    RECHERCHE_MISMATCH = -2
+    RECHERCHE_LAMBDA = 1.28
+    RECHERCHE_K_KARLIN = 0.46
+    RECHERCHE_EVALUE_MAX = 10.0
+    RECHERCHE_DIAGONALES_MAX = 2000
+
+    # Esquisses MinHash (one-permutation hashing sur les k-mers canoniques)
+    MINHASH_K = 21
+    MINHASH_TAILLE = 512
+    MINHASH_SEUIL_DOUBLON = 0.9
+    MINHASH_BUDGET_ELEMENTS = 50_000_000
     
     ETALONS = {
         "baton_1m": {"nom": "Bâton 1m", "largeur": 1000, "hauteur": None},
@@ -104,6 +147,70 @@ class Config:
         "Tarie", "Engraissement"
     ]
 
+    # Stockage des modèles : budget vérifié à l'enregistrement du modèle laitier
+    MODELE_BUDGET_MO = 50
+    MODELE_BUDGET_CHARGEMENT_MS = 250
+    LAIT_RF_PROFONDEUR_MAX = 16
+    LAIT_RF_MIN_FEUILLE = 3
+
+    # Détection d'anomalies (modèle mis en cache, réentraînement planifié)
+    ANOMALIES_CONTAMINATION = 0.1
+    ANOMALIES_REFIT_JOURS = 7
+    ANOMALIES_SEUIL_DERIVE = 0.25
+
+    # Clustering (MiniBatchKMeans, évaluation parallèle de k)
+    CLUSTERING_K_MAX = 8
+    CLUSTERING_ECHANTILLON = 5000
+
+    # Alertes de production laitière (z-scores robustes glissants + CUSUM)
+    ALERTES_HISTORIQUE_JOURS = 60
+    ALERTES_FENETRE_JOURS = 21
+    ALERTES_MIN_MESURES = 7
+    ALERTES_HORIZON_JOURS = 3
+    ALERTES_SEUIL_Z = 4.0
+    ALERTES_CUSUM_K = 1.0
+    ALERTES_CUSUM_H = 6.0
+
+    # Jeux PLINK téléversés conservés sur disque (les plus récents)
+    PLINK_COPIES_MAX = 5
+
+    # Déséquilibre de liaison (r² par fenêtres glissantes, élagage type --indep-pairwise)
+    LD_FENETRE = 50
+    LD_PAS = 5
+    LD_SEUIL_R2 = 0.5
+    LD_SEUIL_STOCKAGE = 0.2
+
+    # Pédigrée : bélier retrouvé par la saillie ~150 jours avant la mise bas
+    PEDIGREE_GESTATION_JOURS = 150
+    PEDIGREE_TOLERANCE_JOURS = 10
+    PEDIGREE_PROFONDEUR_MAX = 200
+
+    # BLUP modèle animal (proportions de la variance phénotypique)
+    BLUP_HERITABILITE_LAIT = 0.30
+    BLUP_REPETABILITE_LAIT = 0.45
+    BLUP_MIN_CONTROLES = 5
+    BLUP_TOLERANCE = 1e-8
+    BLUP_ITERATIONS_MAX = 5000
+
+    # Prédiction génomique : héritabilité choisie par validation croisée sur cette grille
+    GBLUP_H2_GRILLE = (0.1, 0.2, 0.3, 0.5, 0.7)
+    GBLUP_PLIS = 5
+
+    # Composition raciale : références retirées du panel sous cette part de leur race déclarée
+    ADMIXTURE_PURETE_MIN = 0.80
+    ADMIXTURE_MIN_REFERENCES = 5
+    ADMIXTURE_ITERATIONS_MAX = 5
+
+    # Vérification de parenté : taux d'homozygotes opposés toléré (erreurs de génotypage)
+    PARENTE_NB_SNPS = 2000
+    PARENTE_SNPS_MIN = 100
+    PARENTE_TAUX_EXCLUSION_MAX = 0.01
+
+    # Plan d'accouplement : pénalité en unités de mérite par unité de F du descendant
+    ACCOUPLEMENT_PENALITE_F = 10.0
+    ACCOUPLEMENT_F_MAX = 0.125
+    ACCOUPLEMENT_CAPACITE = 50
+
 # -----------------------------------------------------------------------------
 # BASE DE DONNÉES
 # -----------------------------------------------------------------------------
@@ -160,6 +267,23 @@ class Database:
                 id INTEGER PRIMARY KEY, brebis_id INTEGER, date_analyse TIMESTAMP,
                 gene_cible TEXT, sequence_query TEXT, blast_hits TEXT,
                 identite_pct REAL, e_value REAL
+            )""",
+            """CREATE TABLE IF NOT EXISTS sequences_reference (
+                accession TEXT PRIMARY KEY, description TEXT,
+                sequence TEXT, date_ajout TIMESTAMP
+            )""",
+            # Séquences des brebis hors de la table brebis : 2 bits par base + zlib
+            """CREATE TABLE IF NOT EXISTS sequences (
+                id INTEGER PRIMARY KEY, brebis_id INTEGER, rang INTEGER,
+                entete TEXT, longueur INTEGER, donnees BLOB, exceptions BLOB,
+                date_maj TIMESTAMP,
+                UNIQUE (brebis_id, rang),
+                FOREIGN KEY (brebis_id) REFERENCES brebis(id)
+            )""",
+            """CREATE TABLE IF NOT EXISTS sketches_minhash (
+                brebis_id INTEGER PRIMARY KEY, k INTEGER, taille INTEGER,
+                signature BLOB, n_kmers INTEGER, date_maj TIMESTAMP,
+                FOREIGN KEY (brebis_id) REFERENCES brebis(id)
             )"""
         ]
         
@@ -334,8 +458,325 @@ class Database:
                 FOREIGN KEY (brebis_id) REFERENCES brebis(id)
             )
         """)
-        
+        cursor.execute("PRAGMA table_info(mises_bas)")
+        if 'agneaux' not in [col[1] for col in cursor.fetchall()]:
+            cursor.execute("ALTER TABLE mises_bas ADD COLUMN agneaux TEXT")
+
+        # Pédigrée : un animal par identifiant (brebis, agneaux, béliers), parents inconnus à NULL
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS pedigree (
+                animal TEXT PRIMARY KEY,
+                pere TEXT,
+                mere TEXT,
+                date_naissance DATE,
+                mise_bas_id INTEGER,
+                source TEXT
+            )
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_pedigree_pere ON pedigree (pere)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_pedigree_mere ON pedigree (mere)")
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS consanguinite (
+                animal TEXT PRIMARY KEY,
+                F REAL,
+                date_calcul TIMESTAMP
+            )
+        """)
+        # Valeurs génétiques par animal (BLUP, GBLUP...) ; brebis_id renseigné pour les brebis du troupeau
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS valeurs_genetiques (
+                animal TEXT,
+                brebis_id INTEGER,
+                caractere TEXT,
+                methode TEXT,
+                valeur REAL,
+                precision REAL,
+                nb_performances INTEGER,
+                date_calcul TIMESTAMP,
+                PRIMARY KEY (animal, caractere, methode)
+            )
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_valeurs_genetiques_brebis ON valeurs_genetiques (brebis_id, caractere, methode)")
+        # Contrôle des parents déclarés par homozygotes opposés ; pere_suggere = bélier génotypé le plus compatible
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS verifications_parente (
+                animal TEXT PRIMARY KEY,
+                pere_declare TEXT,
+                statut_pere TEXT,
+                exclusions_pere INTEGER,
+                snps_pere INTEGER,
+                mere_declaree TEXT,
+                statut_mere TEXT,
+                exclusions_mere INTEGER,
+                snps_mere INTEGER,
+                pere_suggere TEXT,
+                exclusions_suggere INTEGER,
+                snps_suggere INTEGER,
+                date_verification TIMESTAMP
+            )
+        """)
+        # Proportions raciales estimées sur SNPs (reference = 1 si la brebis a servi au panel de sa race)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS composition_raciale (
+                brebis_id INTEGER,
+                race TEXT,
+                proportion REAL,
+                reference INTEGER,
+                date_calcul TIMESTAMP,
+                PRIMARY KEY (brebis_id, race),
+                FOREIGN KEY (brebis_id) REFERENCES brebis(id)
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS plans_accouplement (
+                id INTEGER PRIMARY KEY,
+                plan_id TEXT,
+                date_plan TIMESTAMP,
+                brebis_id INTEGER,
+                belier TEXT,
+                F_descendant REAL,
+                merite REAL,
+                FOREIGN KEY (brebis_id) REFERENCES brebis(id)
+            )
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_plans_accouplement ON plans_accouplement (plan_id)")
+        # Un changement de parents rend F obsolète ; les descendants sont recalculés par propagation
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_pedigree_parents_update
+            AFTER UPDATE OF pere, mere ON pedigree
+            WHEN OLD.pere IS NOT NEW.pere OR OLD.mere IS NOT NEW.mere
+            BEGIN
+                DELETE FROM consanguinite WHERE animal = NEW.animal;
+            END
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_pedigree_delete
+            AFTER DELETE ON pedigree
+            BEGIN
+                DELETE FROM consanguinite WHERE animal = OLD.animal;
+            END
+        """)
+
+        # Versions de données (incrémentées par triggers) pour l'invalidation des caches
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS versions_donnees (
+                domaine TEXT PRIMARY KEY,
+                version INTEGER DEFAULT 0
+            )
+        """)
+        for table in ["brebis", "productions", "mesures_morpho", "genotypes", "sequences_reference", "sequences",
+                      "pedigree"]:
+            self.suivre_version(cursor, table)
+
+        # Génotypes SNP : index pour les recherches de porteurs et les fréquences par élevage
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_genotypes_snp_genotype ON genotypes (snp_name, genotype, brebis_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_genotypes_brebis ON genotypes (brebis_id, snp_name)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_brebis_elevage ON brebis (elevage_id)")
+
+        # Effectifs de génotypes par (SNP, élevage), tenus à jour par triggers : les
+        # fréquences alléliques se lisent sans parcourir les appels individuels
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS comptes_genotypes (
+                snp_name TEXT,
+                elevage_id INTEGER,
+                genotype TEXT,
+                n INTEGER,
+                PRIMARY KEY (snp_name, elevage_id, genotype)
+            )
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_comptes_genotypes_insert
+            AFTER INSERT ON genotypes
+            BEGIN
+                INSERT INTO comptes_genotypes (snp_name, elevage_id, genotype, n)
+                SELECT NEW.snp_name, elevage_id, NEW.genotype, 1 FROM brebis WHERE id = NEW.brebis_id
+                ON CONFLICT (snp_name, elevage_id, genotype) DO UPDATE SET n = n + 1;
+            END
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_comptes_genotypes_delete
+            AFTER DELETE ON genotypes
+            BEGIN
+                UPDATE comptes_genotypes SET n = n - 1
+                WHERE snp_name = OLD.snp_name AND genotype IS OLD.genotype
+                  AND elevage_id = (SELECT elevage_id FROM brebis WHERE id = OLD.brebis_id);
+            END
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_comptes_genotypes_update
+            AFTER UPDATE OF snp_name, genotype, brebis_id ON genotypes
+            BEGIN
+                UPDATE comptes_genotypes SET n = n - 1
+                WHERE snp_name = OLD.snp_name AND genotype IS OLD.genotype
+                  AND elevage_id = (SELECT elevage_id FROM brebis WHERE id = OLD.brebis_id);
+                INSERT INTO comptes_genotypes (snp_name, elevage_id, genotype, n)
+                SELECT NEW.snp_name, elevage_id, NEW.genotype, 1 FROM brebis WHERE id = NEW.brebis_id
+                ON CONFLICT (snp_name, elevage_id, genotype) DO UPDATE SET n = n + 1;
+            END
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_comptes_genotypes_brebis_elevage
+            AFTER UPDATE OF elevage_id ON brebis
+            BEGIN
+                UPDATE comptes_genotypes SET n = n - (
+                    SELECT COUNT(*) FROM genotypes g
+                    WHERE g.brebis_id = NEW.id AND g.snp_name = comptes_genotypes.snp_name
+                      AND g.genotype IS comptes_genotypes.genotype
+                ) WHERE elevage_id = OLD.elevage_id;
+                INSERT INTO comptes_genotypes (snp_name, elevage_id, genotype, n)
+                SELECT snp_name, NEW.elevage_id, genotype, COUNT(*) FROM genotypes WHERE brebis_id = NEW.id
+                GROUP BY snp_name, genotype
+                ON CONFLICT (snp_name, elevage_id, genotype) DO UPDATE SET n = n + excluded.n;
+            END
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_genotypes_brebis_delete
+            BEFORE DELETE ON brebis
+            BEGIN
+                DELETE FROM genotypes WHERE brebis_id = OLD.id;
+            END
+        """)
+        if cursor.execute("SELECT COUNT(*) FROM comptes_genotypes").fetchone()[0] == 0:
+            cursor.execute("""
+                INSERT INTO comptes_genotypes (snp_name, elevage_id, genotype, n)
+                SELECT g.snp_name, b.elevage_id, g.genotype, COUNT(*)
+                FROM genotypes g JOIN brebis b ON g.brebis_id = b.id
+                GROUP BY g.snp_name, b.elevage_id, g.genotype
+            """)
+
+        # Migration des SNPs JSON (brebis.variants_snps) vers la table genotypes
+        for bid, texte in cursor.execute(
+                "SELECT id, variants_snps FROM brebis WHERE variants_snps IS NOT NULL AND variants_snps != ''"
+        ).fetchall():
+            snps = lire_snps_texte(texte)
+            if snps is not None:
+                enregistrer_genotypes(bid, snps, conn=self.conn)
+                cursor.execute("UPDATE brebis SET variants_snps=NULL WHERE id=?", (bid,))
+
+        # Migration des séquences FASTA stockées dans brebis vers la table compacte
+        a_migrer = cursor.execute(
+            "SELECT id, sequence_fasta FROM brebis WHERE sequence_fasta IS NOT NULL AND sequence_fasta != ''"
+        ).fetchall()
+        for bid, fasta in a_migrer:
+            enregistrer_sequence(bid, fasta, conn=self.conn)
+            cursor.execute("UPDATE brebis SET sequence_fasta=NULL WHERE id=?", (bid,))
+        if a_migrer:
+            # Libère les pages qu'occupaient les séquences dans la table brebis
+            self.conn.commit()
+            self.conn.execute("VACUUM")
+
+        # Esquisses MinHash manquantes (séquences enregistrées avant leur introduction ou paramètres modifiés)
+        sans_esquisse = cursor.execute("""
+            SELECT DISTINCT brebis_id FROM sequences WHERE brebis_id NOT IN (
+                SELECT brebis_id FROM sketches_minhash WHERE k=? AND taille=?
+            )
+        """, (Config.MINHASH_K, Config.MINHASH_TAILLE)).fetchall()
+        for (bid,) in sans_esquisse:
+            sequences = [decompacter_sequence(d, e, n) for d, e, n in cursor.execute(
+                "SELECT donnees, exceptions, longueur FROM sequences WHERE brebis_id=? ORDER BY rang", (bid,)
+            ).fetchall()]
+            enregistrer_esquisse(self.conn, bid, sequences)
+
+        # Tables IA : scores d'anomalies persistés et brebis à rescorer
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS scores_anomalies (
+                brebis_id INTEGER PRIMARY KEY,
+                prod_moy REAL,
+                score_morpho REAL,
+                poids_vif REAL,
+                viande_estimee REAL,
+                score REAL,
+                anomalie INTEGER,
+                modele TEXT,
+                date_calcul TIMESTAMP,
+                FOREIGN KEY (brebis_id) REFERENCES brebis(id)
+            )
+        """)
+
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS brebis_a_rescorer (
+                brebis_id INTEGER PRIMARY KEY
+            )
+        """)
+
+        for table, col in [("brebis", "id"), ("productions", "brebis_id"), ("mesures_morpho", "brebis_id")]:
+            for evt, ref in [("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD")]:
+                if table == "brebis" and evt == "DELETE":
+                    continue
+                cursor.execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS trg_rescorer_{table}_{evt.lower()}
+                    AFTER {evt} ON {table}
+                    BEGIN
+                        INSERT OR IGNORE INTO brebis_a_rescorer (brebis_id) VALUES ({ref}.{col});
+                    END
+                """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_scores_brebis_delete
+            AFTER DELETE ON brebis
+            BEGIN
+                DELETE FROM scores_anomalies WHERE brebis_id = OLD.id;
+                DELETE FROM brebis_a_rescorer WHERE brebis_id = OLD.id;
+            END
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_sequences_brebis_delete
+            AFTER DELETE ON brebis
+            BEGIN
+                DELETE FROM sequences WHERE brebis_id = OLD.id;
+                DELETE FROM sketches_minhash WHERE brebis_id = OLD.id;
+            END
+        """)
+
+        # Alertes sanitaires issues de la détection sur la production laitière
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS alertes_sante (
+                id INTEGER PRIMARY KEY,
+                brebis_id INTEGER,
+                date_alerte DATE,
+                type TEXT,
+                score REAL,
+                message TEXT,
+                statut TEXT DEFAULT 'Nouvelle',
+                UNIQUE (brebis_id, date_alerte, type),
+                FOREIGN KEY (brebis_id) REFERENCES brebis(id)
+            )
+        """)
+
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS genes_ncbi (
+                symbole TEXT,
+                organisme TEXT,
+                gene_id TEXT,
+                nom TEXT,
+                description TEXT,
+                chromosome TEXT,
+                map_location TEXT,
+                date_maj TIMESTAMP,
+                PRIMARY KEY (symbole, organisme, gene_id)
+            )
+        """)
+
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS executions_taches (
+                tache TEXT PRIMARY KEY,
+                derniere_execution TIMESTAMP,
+                details TEXT
+            )
+        """)
+
         self.conn.commit()
+
+    def suivre_version(self, cursor, table: str):
+        """Crée les triggers qui incrémentent la version de `table` à chaque écriture."""
+        cursor.execute("INSERT OR IGNORE INTO versions_donnees (domaine, version) VALUES (?, 0)", (table,))
+        for evt in ["INSERT", "UPDATE", "DELETE"]:
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS trg_version_{table}_{evt.lower()}
+                AFTER {evt} ON {table}
+                BEGIN
+                    UPDATE versions_donnees SET version = version + 1 WHERE domaine = '{table}';
+                END
+            """)
     
     def execute(self, query: str, params: tuple = ()):
         cursor = self.conn.cursor()
@@ -490,13 +931,157 @@ class MachineLearning:
             "niveau": "Élite" if base > 1.5 else "Bon" if base > 1.0 else "Standard"
         }
 
+class LimiteurDebit:
+    """Seau à jetons partagé entre threads : au plus `debit` requêtes par seconde en régime établi."""
+    def __init__(self, debit: float, rafale: int = 1):
+        self.debit = debit
+        self.capacite = rafale
+        self.jetons = float(rafale)
+        self.dernier = time.monotonic()
+        self.verrou = threading.Lock()
+
+    def attendre(self):
+        with self.verrou:
+            maintenant = time.monotonic()
+            self.jetons = min(self.capacite, self.jetons + (maintenant - self.dernier) * self.debit)
+            self.dernier = maintenant
+            attente = (1 - self.jetons) / self.debit if self.jetons < 1 else 0.0
+            self.jetons -= 1
+            if attente > 0:
+                # Le jeton est réservé sous verrou : les threads suivants attendent leur tour
+                time.sleep(attente)
+
+class CacheHTTP:
+    """Cache disque (SQLite) des réponses HTTP avec durée de vie et validateurs ETag / Last-Modified."""
+    def __init__(self, chemin: str, ttl_secondes: float):
+        self.ttl = ttl_secondes
+        self.verrou = threading.Lock()
+        self.conn = sqlite3.connect(chemin, check_same_thread=False)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS reponses (
+                cle TEXT PRIMARY KEY,
+                url TEXT,
+                corps BLOB,
+                etag TEXT,
+                last_modified TEXT,
+                date_stockage REAL
+            )
+        """)
+        # Anciennes entrées enregistrées avec la clé API dans l'URL
+        self.conn.execute("""
+            UPDATE reponses SET url = substr(url, 1, instr(url, '?') - 1)
+            WHERE url LIKE '%api_key=%'
+        """)
+        self.conn.commit()
+
+    def lire(self, cle: str) -> Optional[Dict]:
+        with self.verrou:
+            ligne = self.conn.execute(
+                "SELECT corps, etag, last_modified, date_stockage FROM reponses WHERE cle=?", (cle,)
+            ).fetchone()
+        if ligne is None:
+            return None
+        corps, etag, last_modified, date_stockage = ligne
+        return {"corps": corps, "etag": etag, "last_modified": last_modified,
+                "frais": time.time() - date_stockage < self.ttl}
+
+    def ecrire(self, cle: str, url: str, corps: bytes, etag: Optional[str], last_modified: Optional[str]):
+        with self.verrou:
+            self.conn.execute("INSERT OR REPLACE INTO reponses VALUES (?, ?, ?, ?, ?, ?)",
+                              (cle, url, corps, etag, last_modified, time.time()))
+            self.conn.commit()
+
+    def rafraichir(self, cle: str):
+        with self.verrou:
+            self.conn.execute("UPDATE reponses SET date_stockage=? WHERE cle=?", (time.time(), cle))
+            self.conn.commit()
+
+    def vider(self):
+        with self.verrou:
+            self.conn.execute("DELETE FROM reponses")
+            self.conn.commit()
+
 class NCBIApi:
-    def __init__(self):
-        self.base_url = Config.NCBI_EUTILS_BASE
+    """Client E-utilities : session HTTP persistante, débit limité et cache disque des réponses.
+
+    `base_url`, `cache_path` et `ttl_heures` sont injectables pour viser un faux
+    serveur E-utilities local.
+    """
+    _limiteurs: Dict[float, LimiteurDebit] = {}
+
+    def __init__(self, base_url: Optional[str] = None, cache_path: Optional[str] = None,
+                 ttl_heures: Optional[float] = None, api_key: Optional[str] = None):
+        self.base_url = (base_url or Config.NCBI_EUTILS_BASE).rstrip("/")
+        self.api_key = api_key if api_key is not None else os.environ.get("NCBI_API_KEY")
+        debit = Config.NCBI_REQUETES_SECONDE_CLE if self.api_key else Config.NCBI_REQUETES_SECONDE
+        # Un limiteur par débit, commun à toutes les instances du processus
+        self.limiteur = NCBIApi._limiteurs.setdefault(debit, LimiteurDebit(debit))
+        self.cache = CacheHTTP(cache_path or Config.NCBI_CACHE,
+                               3600 * (ttl_heures if ttl_heures is not None else Config.NCBI_CACHE_TTL_HEURES))
+
+        self.session = requests.Session()
+        reprises = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                         allowed_methods=["GET"])
+        adaptateur = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=reprises)
+        self.session.mount("https://", adaptateur)
+        self.session.mount("http://", adaptateur)
+        self.session.headers.update({"User-Agent": f"{Config.APP_NAME}/{Config.VERSION}"})
+
+    def _get(self, endpoint: str, params: Dict) -> bytes:
+        """GET sur un endpoint E-utilities via le cache ; lève requests.RequestException en cas d'échec.
+
+        Réponse fraîche : servie sans réseau. Réponse expirée : revalidée par
+        requête conditionnelle (304 = réutilisée). Réseau indisponible : la
+        réponse expirée est servie plutôt que rien.
+        """
+        url = f"{self.base_url}/{endpoint}"
+        cle = hashlib.sha1(f"{url}?{json.dumps(params, sort_keys=True)}".encode()).hexdigest()
+        en_cache = self.cache.lire(cle)
+        if en_cache and en_cache["frais"]:
+            return en_cache["corps"]
+
+        entetes = {}
+        if en_cache:
+            if en_cache["etag"]:
+                entetes["If-None-Match"] = en_cache["etag"]
+            if en_cache["last_modified"]:
+                entetes["If-Modified-Since"] = en_cache["last_modified"]
+        params_requete = dict(params, api_key=self.api_key) if self.api_key else params
+        try:
+            self.limiteur.attendre()
+            response = self.session.get(url, params=params_requete, headers=entetes, timeout=Config.NCBI_TIMEOUT)
+            if response.status_code == 304 and en_cache:
+                self.cache.rafraichir(cle)
+                return en_cache["corps"]
+            response.raise_for_status()
+        except requests.RequestException:
+            if en_cache:
+                return en_cache["corps"]
+            raise
+        # URL reconstruite sans api_key : la clé ne doit pas finir en clair dans le cache
+        url_cache = requests.Request("GET", url, params=params).prepare().url
+        self.cache.ecrire(cle, url_cache, response.content,
+                          response.headers.get("ETag"), response.headers.get("Last-Modified"))
+        return response.content
     
+    def rechercher_ids(self, gene_name: str, organism: str = "Ovis aries", retmax: int = 5) -> List[str]:
+        """Identifiants NCBI Gene d'un symbole pour un organisme (lève en cas d'échec réseau)."""
+        params = {"db": "gene", "term": f"{gene_name}[Gene] AND {organism}[Organism]",
+                  "retmode": "json", "retmax": retmax}
+        return json.loads(self._get("esearch.fcgi", params)).get("esearchresult", {}).get("idlist", [])
+
+    def resumes_genes(self, gene_ids: List[str]) -> Dict[str, Dict]:
+        """Résumés esummary de nombreux gènes, par lots de Config.NCBI_LOT_ESUMMARY identifiants."""
+        resumes = {}
+        for debut in range(0, len(gene_ids), Config.NCBI_LOT_ESUMMARY):
+            lot = gene_ids[debut:debut + Config.NCBI_LOT_ESUMMARY]
+            params = {"db": "gene", "id": ",".join(lot), "retmode": "json"}
+            resultat = json.loads(self._get("esummary.fcgi", params)).get("result", {})
+            resumes.update({gid: resultat.get(gid, {}) for gid in lot})
+        return resumes
+
     def search_gene(self, gene_name: str, organism: str = "Ovis aries") -> List[Dict]:
         try:
-            url = f"{self.base_url}/esearch.fcgi"
             params = {
                 "db": "gene",
                 "term": f"{gene_name}[Gene] AND {organism}[Organism]",
@@ -504,8 +1089,7 @@ class NCBIApi:
                 "retmax": 5
             }
             with st.spinner(f"Recherche {gene_name} dans NCBI..."):
-                response = requests.get(url, params=params, timeout=30)
-                data = response.json()
+                data = json.loads(self._get("esearch.fcgi", params))
             gene_ids = data.get("esearchresult", {}).get("idlist", [])
             if gene_ids:
                 return self.fetch_gene_details(gene_ids)
@@ -516,10 +1100,8 @@ class NCBIApi:
     
     def fetch_gene_details(self, gene_ids: List[str]) -> List[Dict]:
         try:
-            url = f"{self.base_url}/esummary.fcgi"
             params = {"db": "gene", "id": ",".join(gene_ids), "retmode": "json"}
-            response = requests.get(url, params=params, timeout=30)
-            data = response.json()
+            data = json.loads(self._get("esummary.fcgi", params))
             results = []
             for gid in gene_ids:
                 summary = data.get("result", {}).get(gid, {})
@@ -537,17 +1119,73 @@ class NCBIApi:
     
     def fetch_fasta(self, accession: str) -> Optional[str]:
         try:
-            url = f"{self.base_url}/efetch.fcgi"
             params = {"db": "nucleotide", "id": accession, "rettype": "fasta", "retmode": "text"}
-            response = requests.get(url, params=params, timeout=30)
-            return response.text if response.status_code == 200 else None
+            return self._get("efetch.fcgi", params).decode("utf-8", errors="replace")
         except Exception as e:
             st.error(f"Erreur FASTA: {e}")
             return None
 
+@st.cache_resource
+def get_ncbi_api() -> NCBIApi:
+    """Client NCBI unique par processus, pour conserver les connexions ouvertes entre les reruns."""
+    return NCBIApi()
+
+def prefetch_genes_economiques(organismes: Optional[List[str]] = None, max_workers: int = 4,
+                               api: Optional[NCBIApi] = None) -> Dict:
+    """Résout tous les gènes de Config.GENES_ECONOMIQUES pour plusieurs organismes dans le miroir `genes_ncbi`.
+
+    Les esearch (un par symbole × organisme) partent en parallèle sur un pool de
+    threads, sous le limiteur de débit commun ; les résumés sont ensuite
+    demandés en un seul esummary par lot d'identifiants. Seul le thread
+    appelant écrit dans la base.
+    """
+    api = api or get_ncbi_api()
+    organismes = organismes or list(Config.NCBI_ORGANISMES.values())
+    couples = [(symbole, organisme) for organisme in organismes for symbole in Config.GENES_ECONOMIQUES]
+    debut_calcul = time.perf_counter()
+
+    def rechercher(couple):
+        try:
+            return couple, api.rechercher_ids(*couple), None
+        except requests.RequestException as e:
+            return couple, [], str(e)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        recherches = list(pool.map(rechercher, couples))
+    ids = list(dict.fromkeys(gid for _, liste, _ in recherches for gid in liste))
+    resumes = api.resumes_genes(ids) if ids else {}
+
+    maintenant = datetime.now().isoformat()
+    lignes = []
+    for (symbole, organisme), liste, erreur in recherches:
+        if erreur is None:
+            db.conn.execute("DELETE FROM genes_ncbi WHERE symbole=? AND organisme=?", (symbole, organisme))
+        for gid in liste:
+            resume = resumes.get(gid, {})
+            lignes.append((symbole, organisme, gid, resume.get("name", "N/A"), resume.get("description", "N/A"),
+                           resume.get("chromosome", "N/A"), resume.get("maplocation", "N/A"), maintenant))
+    db.conn.executemany("INSERT OR REPLACE INTO genes_ncbi VALUES (?, ?, ?, ?, ?, ?, ?, ?)", lignes)
+    bilan = {"requetes": len(couples), "genes": len(lignes), "erreurs": sum(e is not None for _, _, e in recherches),
+             "duree_s": round(time.perf_counter() - debut_calcul, 2)}
+    db.conn.execute("""
+        INSERT OR REPLACE INTO executions_taches (tache, derniere_execution, details)
+        VALUES ('miroir_genes_ncbi', ?, ?)
+    """, (maintenant, json.dumps(bilan)))
+    db.conn.commit()
+    return bilan
+
+def genes_miroir(symbole: str, organisme: str) -> List[Dict]:
+    """Gènes d'un symbole lus dans le miroir local, sans accès réseau."""
+    lignes = db.fetchall("""
+        SELECT gene_id, nom, description, chromosome, map_location, date_maj
+        FROM genes_ncbi WHERE symbole=? AND organisme=?
+    """, (symbole.upper(), organisme))
+    return [{"gene_id": l[0], "name": l[1], "description": l[2], "chromosome": l[3],
+             "map_location": l[4], "date_maj": l[5]} for l in lignes]
+
 class GenomicAnalyzer:
     def __init__(self):
-        self.ncbi = NCBIApi()
+        self.ncbi = get_ncbi_api()
     
     def analyze_race_profile(self, race: str) -> Dict:
         genes_race = Config.RACES.get(race, {}).get("genes", [])
@@ -584,12 +1222,55 @@ class GenomicAnalyzer:
             results["recommandations"].append("✅ Excellent potentiel laitier")
         return results
 
+# -----------------------------------------------------------------------------
+# STOCKAGE DES MODÈLES
+# -----------------------------------------------------------------------------
+class BudgetModeleDepasse(Exception):
+    """Levée quand un artefact dépasse le budget de taille ou de temps de chargement."""
+
+@st.cache_resource(max_entries=16)
+def _charger_artefact(chemin: str, mtime: float):
+    """Charge un artefact en projetant ses tableaux NumPy en mémoire ; la date de modification sert de clé."""
+    return joblib.load(chemin, mmap_mode="r")
+
+def sauvegarder_modele(nom: str, objet, budget_mo: Optional[float] = None,
+                       budget_chargement_ms: Optional[float] = None) -> Dict:
+    """Enregistre un artefact dans MODEL_DIR sans compression pour permettre le chargement par mmap.
+
+    L'artefact est d'abord écrit dans un fichier temporaire, rechargé pour mesurer
+    sa latence, puis n'est installé que s'il respecte le budget ; sinon l'artefact
+    précédent est conservé et BudgetModeleDepasse est levée.
+    """
+    chemin = os.path.join(MODEL_DIR, nom)
+    temporaire = chemin + ".tmp"
+    joblib.dump(objet, temporaire)
+    taille_mo = os.path.getsize(temporaire) / 1e6
+    debut = time.perf_counter()
+    joblib.load(temporaire, mmap_mode="r")
+    chargement_ms = (time.perf_counter() - debut) * 1000
+
+    if budget_mo is not None and taille_mo > budget_mo:
+        os.remove(temporaire)
+        raise BudgetModeleDepasse(f"{nom} : {taille_mo:.1f} Mo > budget {budget_mo} Mo")
+    if budget_chargement_ms is not None and chargement_ms > budget_chargement_ms:
+        os.remove(temporaire)
+        raise BudgetModeleDepasse(f"{nom} : chargement {chargement_ms:.0f} ms > budget {budget_chargement_ms} ms")
+    os.replace(temporaire, chemin)
+    return {"taille_mo": taille_mo, "chargement_ms": chargement_ms}
+
+def charger_modele(nom: str):
+    """Charge un artefact de MODEL_DIR (mis en cache tant que le fichier ne change pas), ou None."""
+    chemin = os.path.join(MODEL_DIR, nom)
+    if not os.path.exists(chemin):
+        return None
+    return _charger_artefact(chemin, os.path.getmtime(chemin))
+
 # -----------------------------------------------------------------------------
 # FONCTIONS ML
 # -----------------------------------------------------------------------------
 
-def train_lait_model():
-    """Entraîne un modèle RandomForest pour prédire la production laitière."""
+def preparer_donnees_lait():
+    """Construit le jeu (X, y, features) utilisé pour la prédiction laitière, ou None si trop peu de données."""
     query = """
         SELECT p.quantite, b.race, b.date_naissance, 
                AVG(m.score_global) as score_morpho,
@@ -612,27 +1293,126 @@ def train_lait_model():
     feature_cols = [c for c in df.columns if c not in ['quantite', 'date_naissance', 'nb_mesures']]
     X = df[feature_cols].fillna(0)
     y = df['quantite']
+    return X, y, feature_cols
+
+def train_lait_model():
+    """Entraîne un modèle RandomForest pour prédire la production laitière."""
+    donnees = preparer_donnees_lait()
+    if donnees is None:
+        return None  # Pas assez de données
+    X, y, feature_cols = donnees
     
     X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
-    model = RandomForestRegressor(n_estimators=100, random_state=42)
+    model = RandomForestRegressor(n_estimators=100, max_depth=Config.LAIT_RF_PROFONDEUR_MAX,
+                                  min_samples_leaf=Config.LAIT_RF_MIN_FEUILLE, random_state=42)
     model.fit(X_train, y_train)
-    score = model.score(X_test, y_test)
     
-    # Sauvegarde
-    joblib.dump(model, os.path.join(MODEL_DIR, 'lait_model.pkl'))
-    joblib.dump(feature_cols, os.path.join(MODEL_DIR, 'lait_features.pkl'))
+    # Sauvegarde (repli sur un gradient boosting compact si la forêt dépasse le budget)
+    budget = {"budget_mo": Config.MODELE_BUDGET_MO, "budget_chargement_ms": Config.MODELE_BUDGET_CHARGEMENT_MS}
+    try:
+        sauvegarder_modele('lait_model.pkl', model, **budget)
+    except BudgetModeleDepasse:
+        model = HistGradientBoostingRegressor(random_state=42)
+        model.fit(X_train, y_train)
+        try:
+            sauvegarder_modele('lait_model.pkl', model, **budget)
+        except BudgetModeleDepasse as e:
+            # Aucun modèle plus compact disponible : on l'installe quand même plutôt que de n'avoir aucun modèle
+            st.warning(f"Budget du modèle dépassé ({e}) ; modèle de repli enregistré sans contrôle de budget.")
+            sauvegarder_modele('lait_model.pkl', model)
+    sauvegarder_modele('lait_features.pkl', feature_cols)
+    score = model.score(X_test, y_test)
     return model, score
 
+def candidats_lait() -> Dict:
+    """Estimateurs comparés par le banc d'évaluation de la prédiction laitière."""
+    return {
+        "RandomForest": RandomForestRegressor(n_estimators=100, random_state=42),
+        "HistGradientBoosting": HistGradientBoostingRegressor(random_state=42),
+        "ElasticNet": make_pipeline(StandardScaler(), ElasticNet(alpha=0.01, max_iter=10000))
+    }
+
+def taille_memoire(obj, _vus=None) -> int:
+    """Estime l'empreinte mémoire d'un modèle (tableaux NumPy, arbres sklearn et objets Python)."""
+    # Dictionnaire id -> objet : garder une référence évite la réutilisation des id des états temporaires
+    _vus = {} if _vus is None else _vus
+    if id(obj) in _vus:
+        return 0
+    _vus[id(obj)] = obj
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(taille_memoire(v, _vus) for v in obj.values())
+    if isinstance(obj, (list, tuple, set)):
+        return sys.getsizeof(obj) + sum(taille_memoire(v, _vus) for v in obj)
+    if isinstance(obj, (str, bytes, int, float, bool, type(None))):
+        return sys.getsizeof(obj)
+    # Les arbres sklearn exposent leurs noeuds (alloués en C) via __getstate__
+    etat = obj.__getstate__() if hasattr(obj, "__getstate__") else None
+    return sys.getsizeof(obj) + (taille_memoire(etat, _vus) if etat is not None else 0)
+
+def mesurer_modele(model, X: pd.DataFrame) -> Dict:
+    """Mesure la taille (disque et mémoire) d'un modèle et sa latence de prédiction pour 10 000 lignes."""
+    buffer = io.BytesIO()
+    joblib.dump(model, buffer)
+
+    X_10k = X.sample(n=10000, replace=True, random_state=0)
+    model.predict(X_10k.iloc[:10])  # échauffement
+    debut = time.perf_counter()
+    model.predict(X_10k)
+    latence = time.perf_counter() - debut
+    return {
+        "taille_disque_ko": buffer.tell() / 1024,
+        "taille_memoire_ko": taille_memoire(model) / 1024,
+        "latence_10k_ms": latence * 1000
+    }
+
+def evaluer_modeles_lait(n_splits: int = 5, n_jobs: int = -1) -> Optional[pd.DataFrame]:
+    """Compare les estimateurs candidats par validation croisée k-fold et écrit un rapport CSV.
+
+    Pour chaque candidat : R², RMSE et MAE en validation croisée (plis en parallèle),
+    temps d'ajustement, latence de prédiction pour 10 000 lignes et taille du modèle.
+    """
+    donnees = preparer_donnees_lait()
+    if donnees is None:
+        return None
+    X, y, _ = donnees
+    cv = KFold(n_splits=n_splits, shuffle=True, random_state=42)
+
+    lignes = []
+    for nom, estimateur in candidats_lait().items():
+        cv_res = cross_validate(
+            estimateur, X, y, cv=cv, n_jobs=n_jobs,
+            scoring=("r2", "neg_root_mean_squared_error", "neg_mean_absolute_error")
+        )
+        model = clone(estimateur)
+        debut = time.perf_counter()
+        model.fit(X, y)
+        duree_fit = time.perf_counter() - debut
+        lignes.append({
+            "modele": nom,
+            "r2_cv": cv_res["test_r2"].mean(),
+            "r2_cv_std": cv_res["test_r2"].std(),
+            "rmse_cv": -cv_res["test_neg_root_mean_squared_error"].mean(),
+            "mae_cv": -cv_res["test_neg_mean_absolute_error"].mean(),
+            "fit_pli_s": cv_res["fit_time"].mean(),
+            "fit_complet_s": duree_fit,
+            **mesurer_modele(model, X)
+        })
+
+    rapport = pd.DataFrame(lignes).sort_values("r2_cv", ascending=False)
+    chemin = os.path.join(MODEL_DIR, f"evaluation_lait_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv")
+    rapport.to_csv(chemin, index=False)
+    rapport.attrs["chemin"] = chemin
+    return rapport
+
 def predict_lait_ml(brebis_id):
     """Prédit la production laitière pour une brebis donnée en utilisant le modèle entraîné."""
-    model_path = os.path.join(MODEL_DIR, 'lait_model.pkl')
-    features_path = os.path.join(MODEL_DIR, 'lait_features.pkl')
-    if not os.path.exists(model_path) or not os.path.exists(features_path):
+    model = charger_modele('lait_model.pkl')
+    feature_cols = charger_modele('lait_features.pkl')
+    if model is None or feature_cols is None:
         return None
     
-    model = joblib.load(model_path)
-    feature_cols = joblib.load(features_path)
-    
     # Récupérer les infos de la brebis
     query = """
         SELECT b.race, b.date_naissance,
@@ -689,6 +1469,2683 @@ def detect_anomalies(df, contamination=0.1):
     preds = model.fit_predict(X)  # -1 pour anomalies, 1 pour normaux
     return preds
 
+# -----------------------------------------------------------------------------
+# DÉTECTION D'ANOMALIES INCRÉMENTALE (MODÈLE EN CACHE)
+# -----------------------------------------------------------------------------
+FEATURES_IA = ['prod_moy', 'score_morpho', 'poids_vif', 'viande_estimee']
+
+def version_donnees(*domaines) -> str:
+    """Retourne la version courante des tables indiquées (clé d'invalidation des caches)."""
+    placeholders = ",".join("?" * len(domaines))
+    rows = db.fetchall(
+        f"SELECT domaine, version FROM versions_donnees WHERE domaine IN ({placeholders}) ORDER BY domaine",
+        tuple(domaines)
+    )
+    return "|".join(f"{d}:{v}" for d, v in rows)
+
+def charger_features_ia(user_id, eleveur_id=None, a_rescorer: bool = False) -> pd.DataFrame:
+    """Agrège les caractéristiques utilisées par les modèles IA (une ligne par brebis)."""
+    query = """
+        SELECT b.id, b.numero_id, b.nom, b.poids_vif,
+               AVG(p.quantite) as prod_moy,
+               AVG(m.score_global) as score_morpho
+        FROM brebis b
+        LEFT JOIN productions p ON b.id = p.brebis_id AND p.date >= date('now', '-30 days')
+        LEFT JOIN mesures_morpho m ON b.id = m.brebis_id
+        JOIN elevages e ON b.elevage_id = e.id
+        JOIN eleveurs el ON e.eleveur_id = el.id
+        WHERE el.user_id=?
+    """
+    params = [user_id]
+    if eleveur_id is not None:
+        query += " AND el.id=?"
+        params.append(eleveur_id)
+    if a_rescorer:
+        query += " AND b.id IN (SELECT brebis_id FROM brebis_a_rescorer)"
+    query += " GROUP BY b.id"
+    df = pd.read_sql_query(query, db.conn, params=params)
+    df['viande_estimee'] = df['poids_vif'] * 0.45
+    df[FEATURES_IA] = df[FEATURES_IA].fillna(0)
+    return df
+
+def _nom_detecteur(user_id) -> str:
+    return f"anomalies_{user_id}.pkl"
+
+def _ecrire_scores_anomalies(df: pd.DataFrame, artefact: Dict):
+    """Score les brebis de `df` avec le modèle en cache et persiste les résultats."""
+    X = df[artefact["features"]].to_numpy(dtype=float)
+    model = artefact["modele"]
+    scores = model.score_samples(X)
+    anomalies = (model.predict(X) == -1).astype(int)
+    maintenant = datetime.now().isoformat()
+    rows = [
+        (int(bid), *map(float, x), float(s), int(a), artefact["date"], maintenant)
+        for bid, x, s, a in zip(df["id"], X, scores, anomalies)
+    ]
+    db.conn.executemany("""
+        INSERT OR REPLACE INTO scores_anomalies
+        (brebis_id, prod_moy, score_morpho, poids_vif, viande_estimee, score, anomalie, modele, date_calcul)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, rows)
+    db.conn.commit()
+
+def entrainer_detecteur_anomalies(user_id, contamination: float = Config.ANOMALIES_CONTAMINATION) -> Optional[Dict]:
+    """Réentraîne l'IsolationForest sur tout le troupeau et réécrit la table des scores."""
+    df = charger_features_ia(user_id)
+    if df.empty:
+        return None
+    X = df[FEATURES_IA].to_numpy(dtype=float)
+    model = IsolationForest(contamination=contamination, random_state=42)
+    model.fit(X)
+    artefact = {
+        "modele": model,
+        "features": FEATURES_IA,
+        "contamination": contamination,
+        "version": version_donnees("brebis", "productions", "mesures_morpho"),
+        "date": datetime.now().isoformat(),
+        "n": len(df),
+        "moyennes": X.mean(axis=0),
+        "ecarts": X.std(axis=0)
+    }
+    sauvegarder_modele(_nom_detecteur(user_id), artefact)
+
+    db.execute("""
+        DELETE FROM scores_anomalies WHERE brebis_id IN (
+            SELECT b.id FROM brebis b
+            JOIN elevages e ON b.elevage_id = e.id
+            JOIN eleveurs el ON e.eleveur_id = el.id
+            WHERE el.user_id=?
+        )
+    """, (user_id,))
+    _ecrire_scores_anomalies(df, artefact)
+    db.execute("""
+        DELETE FROM brebis_a_rescorer WHERE brebis_id IN (
+            SELECT b.id FROM brebis b
+            JOIN elevages e ON b.elevage_id = e.id
+            JOIN eleveurs el ON e.eleveur_id = el.id
+            WHERE el.user_id=?
+        )
+    """, (user_id,))
+    return artefact
+
+def derive_anomalies(user_id, artefact: Dict) -> float:
+    """Écart maximal (en écarts-types d'entraînement) entre les moyennes actuelles et celles du modèle."""
+    row = db.fetchone("""
+        SELECT AVG(s.prod_moy), AVG(s.score_morpho), AVG(s.poids_vif), AVG(s.viande_estimee)
+        FROM scores_anomalies s
+        JOIN brebis b ON s.brebis_id = b.id
+        JOIN elevages e ON b.elevage_id = e.id
+        JOIN eleveurs el ON e.eleveur_id = el.id
+        WHERE el.user_id=?
+    """, (user_id,))
+    if not row or row[0] is None:
+        return 0.0
+    moyennes = np.array(row, dtype=float)
+    ecarts = np.where(artefact["ecarts"] > 0, artefact["ecarts"], 1.0)
+    return float(np.max(np.abs(moyennes - artefact["moyennes"]) / ecarts))
+
+def maj_scores_anomalies(user_id, forcer: bool = False) -> Dict:
+    """Met à jour les scores d'anomalies de manière incrémentale.
+
+    Seules les brebis nouvelles ou modifiées sont scorées avec le modèle en cache.
+    Le modèle est réentraîné s'il est plus ancien que `ANOMALIES_REFIT_JOURS`
+    ou si la dérive des caractéristiques dépasse `ANOMALIES_SEUIL_DERIVE`.
+    """
+    artefact = charger_modele(_nom_detecteur(user_id))
+
+    motif = None
+    if forcer:
+        motif = "demande manuelle"
+    elif artefact is None:
+        motif = "aucun modèle"
+    elif datetime.now() - datetime.fromisoformat(artefact["date"]) > timedelta(days=Config.ANOMALIES_REFIT_JOURS):
+        motif = "réentraînement planifié"
+    if motif:
+        artefact = entrainer_detecteur_anomalies(user_id)
+        return {"reentraine": artefact is not None, "motif": motif, "rescores": 0, "derive": 0.0, "artefact": artefact}
+
+    df = charger_features_ia(user_id, a_rescorer=True)
+    ids = df["id"].tolist()
+    derive = 0.0
+    if ids:
+        _ecrire_scores_anomalies(df, artefact)
+        db.conn.executemany("DELETE FROM brebis_a_rescorer WHERE brebis_id=?", [(i,) for i in ids])
+        db.conn.commit()
+        derive = derive_anomalies(user_id, artefact)
+        if derive > Config.ANOMALIES_SEUIL_DERIVE:
+            artefact = entrainer_detecteur_anomalies(user_id)
+            return {"reentraine": True, "motif": f"dérive {derive:.2f}", "rescores": len(ids), "derive": derive, "artefact": artefact}
+    return {"reentraine": False, "motif": None, "rescores": len(ids), "derive": derive, "artefact": artefact}
+
+# -----------------------------------------------------------------------------
+# CLUSTERING (MINIBATCHKMEANS, SÉLECTION DE K)
+# -----------------------------------------------------------------------------
+def _evaluer_k(X_scaled, k: int, echantillon, graine: int = 42):
+    """Ajuste un MiniBatchKMeans à k clusters et mesure inertie et silhouette sur l'échantillon."""
+    model = MiniBatchKMeans(n_clusters=k, random_state=graine, batch_size=2048, n_init=3)
+    labels = model.fit_predict(X_scaled)
+    sil = np.nan
+    if len(np.unique(labels[echantillon])) > 1:
+        sil = silhouette_score(X_scaled[echantillon], labels[echantillon])
+    return k, model, labels, model.inertia_, sil
+
+def _calculer_clustering(df: pd.DataFrame, k_max: int, n_jobs: int = -1) -> Dict:
+    """Évalue k = 2..k_max en parallèle et conserve modèle et étiquettes pour chaque k."""
+    scaler = StandardScaler()
+    X_scaled = scaler.fit_transform(df[FEATURES_IA].to_numpy(dtype=float))
+    rng = np.random.default_rng(42)
+    taille = min(len(df), Config.CLUSTERING_ECHANTILLON)
+    echantillon = rng.choice(len(df), size=taille, replace=False)
+
+    resultats = joblib.Parallel(n_jobs=n_jobs)(
+        joblib.delayed(_evaluer_k)(X_scaled, k, echantillon) for k in range(2, k_max + 1)
+    )
+    evaluation = pd.DataFrame(
+        [(k, inertie, sil) for k, _, _, inertie, sil in resultats],
+        columns=["k", "inertie", "silhouette"]
+    )
+    meilleur_k = int(evaluation.loc[evaluation["silhouette"].idxmax(), "k"]) if evaluation["silhouette"].notna().any() else 2
+    return {
+        "scaler": scaler,
+        "modeles": {k: model for k, model, _, _, _ in resultats},
+        "labels": {k: labels for k, _, labels, _, _ in resultats},
+        "evaluation": evaluation,
+        "meilleur_k": meilleur_k
+    }
+
+@st.cache_resource(max_entries=4)
+def service_clustering(user_id, eleveur_id, version: str) -> Optional[Dict]:
+    """Retourne les clusterings de toutes les valeurs de k pour une version des données.
+
+    Le résultat est mis en cache en mémoire et sur disque : tant que `version`
+    ne change pas, le déplacement du curseur n'est qu'une lecture de dictionnaire.
+    """
+    nom = f"clusters_{user_id}_{eleveur_id or 'tous'}.pkl"
+    artefact = charger_modele(nom)
+    if artefact is not None and artefact.get("version") == version:
+        return artefact
+
+    df = charger_features_ia(user_id, eleveur_id)
+    k_max = min(Config.CLUSTERING_K_MAX, len(df) - 1)
+    if k_max < 2:
+        return None
+    artefact = _calculer_clustering(df, k_max)
+    artefact["df"] = df
+    artefact["version"] = version
+    sauvegarder_modele(nom, artefact)
+    return artefact
+
+# -----------------------------------------------------------------------------
+# ALERTES DE PRODUCTION LAITIÈRE (DÉTECTION VECTORISÉE SUR LE TROUPEAU)
+# -----------------------------------------------------------------------------
+def matrice_productions(jours: int = Config.ALERTES_HISTORIQUE_JOURS):
+    """Construit la matrice (brebis × jour) des productions ; NaN pour les jours sans mesure."""
+    debut = datetime.now().date() - timedelta(days=jours)
+    dates = pd.date_range(debut, periods=jours + 1, freq="D")
+    rows = db.fetchall("""
+        SELECT brebis_id, CAST(julianday(date) - julianday(?) AS INTEGER), quantite
+        FROM productions
+        WHERE quantite IS NOT NULL AND date >= ?
+    """, (debut.isoformat(), debut.isoformat()))
+    if not rows:
+        return np.array([], dtype=int), dates, np.empty((0, len(dates)))
+    data = np.array(rows, dtype=float)
+    ids, lignes = np.unique(data[:, 0].astype(np.int64), return_inverse=True)
+    colonnes = data[:, 1].astype(int)
+    valides = (colonnes >= 0) & (colonnes < len(dates))
+    # Plusieurs traites le même jour sont additionnées
+    Y = np.zeros((len(ids), len(dates)))
+    nb = np.zeros((len(ids), len(dates)), dtype=int)
+    np.add.at(Y, (lignes[valides], colonnes[valides]), data[valides, 2])
+    np.add.at(nb, (lignes[valides], colonnes[valides]), 1)
+    Y[nb == 0] = np.nan
+    return ids, dates, Y
+
+def _mediane_nan(a: np.ndarray):
+    """Médiane sur le dernier axe en ignorant les NaN (tri vectorisé, plus rapide que np.nanmedian)."""
+    trie = np.sort(a, axis=-1)
+    n = np.sum(~np.isnan(a), axis=-1)
+    bas = np.take_along_axis(trie, np.maximum((n - 1) // 2, 0)[..., None], axis=-1)[..., 0]
+    haut = np.take_along_axis(trie, np.maximum(n // 2, 0)[..., None], axis=-1)[..., 0]
+    return np.where(n > 0, (bas + haut) / 2, np.nan), n
+
+def zscores_robustes(Y: np.ndarray, fenetre: int = Config.ALERTES_FENETRE_JOURS,
+                     min_mesures: int = Config.ALERTES_MIN_MESURES, taille_bloc: int = 5000) -> np.ndarray:
+    """Z-scores robustes glissants : chaque jour est comparé à la médiane/MAD des `fenetre` jours précédents."""
+    n, d = Y.shape
+    Z = np.full((n, d), np.nan)
+    for debut in range(0, n, taille_bloc):
+        bloc = Y[debut:debut + taille_bloc]
+        pad = np.concatenate([np.full((len(bloc), fenetre), np.nan), bloc[:, :-1]], axis=1)
+        fenetres = np.lib.stride_tricks.sliding_window_view(pad, fenetre, axis=1)
+        mediane, nb = _mediane_nan(fenetres)
+        mad, _ = _mediane_nan(np.abs(fenetres - mediane[..., None]))
+        echelle = np.maximum(1.4826 * mad, np.maximum(0.05, 0.05 * np.abs(mediane)))
+        with np.errstate(invalid="ignore"):
+            z = (bloc - mediane) / echelle
+        Z[debut:debut + taille_bloc] = np.where(nb >= min_mesures, z, np.nan)
+    return Z
+
+def cusum_baisse(Z: np.ndarray, k: float = Config.ALERTES_CUSUM_K) -> np.ndarray:
+    """CUSUM unilatéral (baisse) sur les z-scores ; les jours sans mesure conservent la statistique."""
+    S = np.zeros(Z.shape)
+    courant = np.zeros(Z.shape[0])
+    for t in range(Z.shape[1]):
+        z = Z[:, t]
+        courant = np.where(np.isnan(z), courant, np.maximum(0.0, courant - z - k))
+        S[:, t] = courant
+    return S
+
+def detecter_alertes_production() -> Dict:
+    """Analyse tout le troupeau en une passe et enregistre les alertes dans `alertes_sante`."""
+    debut_calcul = time.perf_counter()
+    ids, dates, Y = matrice_productions()
+    if len(ids) == 0:
+        return {"brebis": 0, "alertes": 0, "duree_s": 0.0}
+    Z = zscores_robustes(Y)
+    S = cusum_baisse(Z)
+
+    horizon = Config.ALERTES_HORIZON_JOURS
+    z_recent = np.where(np.isnan(Z[:, -horizon:]), np.inf, Z[:, -horizon:])
+    jour_min = np.argmin(z_recent, axis=1)
+    z_min = z_recent[np.arange(len(ids)), jour_min]
+    s_final = S[:, -1]
+    aujourd_hui = datetime.now().date().isoformat()
+
+    alertes = []
+    for i in np.flatnonzero(z_min < -Config.ALERTES_SEUIL_Z):
+        date_evt = dates[len(dates) - horizon + jour_min[i]].date()
+        alertes.append((int(ids[i]), aujourd_hui, "Chute brutale de production", float(z_min[i]),
+                        f"Production du {date_evt.strftime('%d/%m')} à {abs(z_min[i]):.1f} écarts robustes sous la normale"))
+    for i in np.flatnonzero(s_final > Config.ALERTES_CUSUM_H):
+        alertes.append((int(ids[i]), aujourd_hui, "Baisse persistante (CUSUM)", float(s_final[i]),
+                        f"Baisse cumulée sur plusieurs jours (CUSUM = {s_final[i]:.1f})"))
+
+    db.conn.executemany("""
+        INSERT OR IGNORE INTO alertes_sante (brebis_id, date_alerte, type, score, message)
+        VALUES (?, ?, ?, ?, ?)
+    """, alertes)
+    duree = time.perf_counter() - debut_calcul
+    db.conn.execute("""
+        INSERT OR REPLACE INTO executions_taches (tache, derniere_execution, details)
+        VALUES ('alertes_production', ?, ?)
+    """, (datetime.now().isoformat(), json.dumps({"brebis": len(ids), "alertes": len(alertes), "duree_s": duree})))
+    db.conn.commit()
+    return {"brebis": len(ids), "alertes": len(alertes), "duree_s": duree}
+
+def detection_quotidienne_production(forcer: bool = False) -> Optional[Dict]:
+    """Lance la détection si elle n'a pas encore tourné aujourd'hui."""
+    derniere = db.fetchone("SELECT derniere_execution FROM executions_taches WHERE tache='alertes_production'")
+    if not forcer and derniere and derniere[0][:10] == datetime.now().date().isoformat():
+        return None
+    return detecter_alertes_production()
+
+# -----------------------------------------------------------------------------
+# MOTEUR GWAS (ASSOCIATION VECTORISÉE)
+# -----------------------------------------------------------------------------
+def association_bloc(G: np.ndarray, y: np.ndarray, avec_p: bool = True):
+    """Régression y ~ 1 + g pour toutes les colonnes de G à la fois, en forme fermée.
+
+    G (n × m) contient les dosages, NaN pour un génotype manquant : chaque SNP
+    n'utilise que ses individus génotypés. `y` (n,) ou (n × k) est centré et
+    complet. Renvoie beta, se, t, p et n, de forme (m,) ou (m × k) ; p vaut
+    None si `avec_p` est faux (permutations, où seul t est utile).
+    """
+    G = np.asarray(G, dtype=float)
+    Y = y[:, None] if y.ndim == 1 else y
+    observe = ~np.isnan(G)
+    masque = observe.astype(float)
+    n = masque.sum(axis=0)
+
+    # Génotypes centrés sur la moyenne des individus observés, 0 pour les manquants
+    with np.errstate(invalid="ignore", divide="ignore"):
+        moyenne = np.where(observe, G, 0.0).sum(axis=0) / n
+    Gc = np.where(observe, G - moyenne, 0.0)
+    sxx = np.einsum("ij,ij->j", Gc, Gc)[:, None]
+    sxy = Gc.T @ Y
+    sy = masque.T @ Y
+    syy = masque.T @ (Y * Y)
+
+    ddl = (n - 2)[:, None]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        syy_c = syy - sy * sy / n[:, None]
+        beta = sxy / sxx
+        rss = syy_c - beta * sxy
+        se = np.sqrt(rss / ddl / sxx)
+        t = beta / se
+    valide = (sxx > 0) & (ddl > 0)
+    beta, se, t = (np.where(valide, a, np.nan) for a in (beta, se, t))
+    p = 2 * stats.t.sf(np.abs(t), np.where(valide, ddl, 1)) if avec_p else None
+    if y.ndim == 1:
+        return beta[:, 0], se[:, 0], t[:, 0], (p[:, 0] if avec_p else None), n
+    return beta, se, t, p, n
+
+def iter_blocs_matrice(G: np.ndarray, snps: List[str], taille_bloc: int):
+    """Découpe une matrice de génotypes en blocs de colonnes (noms, G_bloc)."""
+    for debut in range(0, G.shape[1], taille_bloc):
+        yield snps[debut:debut + taille_bloc], G[:, debut:debut + taille_bloc]
+
+def taille_bloc_auto(n: int, elements: int = 4_000_000) -> int:
+    """Nombre de SNPs par bloc pour borner la mémoire à ~`elements` valeurs par bloc."""
+    return max(1, elements // max(n, 1))
+
+def gwas_par_blocs(blocs, y: np.ndarray) -> pd.DataFrame:
+    """GWAS sur un flux de blocs (noms, G_bloc) dont les lignes sont alignées sur `y`."""
+    y = np.asarray(y, dtype=float)
+    lignes = ~np.isnan(y)
+    yc = y[lignes] - y[lignes].mean()
+    resultats = []
+    for noms, G in blocs:
+        beta, se, t, p, n = association_bloc(np.asarray(G, dtype=float)[lignes], yc)
+        resultats.append(pd.DataFrame({
+            'SNP': list(noms), 'Beta': beta, 'SE': se, 'T': t, 'P_value': p, 'N': n.astype(int)
+        }))
+    df_res = pd.concat(resultats, ignore_index=True) if resultats else pd.DataFrame(
+        columns=['SNP', 'Beta', 'SE', 'T', 'P_value', 'N'])
+    df_res['-log10(p)'] = -np.log10(np.maximum(df_res['P_value'].to_numpy(dtype=float), 1e-300))
+    return df_res
+
+def gwas_vectorise(G: np.ndarray, y: np.ndarray, snps: List[str], taille_bloc: Optional[int] = None) -> pd.DataFrame:
+    """GWAS par régression simple sur tous les SNPs d'une matrice (n × m), traitée par blocs."""
+    taille_bloc = taille_bloc or taille_bloc_auto(G.shape[0])
+    return gwas_par_blocs(iter_blocs_matrice(G, list(snps), taille_bloc), y)
+
+# -----------------------------------------------------------------------------
+# GÉNOTYPES SNP (TABLE NORMALISÉE ET INDEXÉE)
+# -----------------------------------------------------------------------------
+def normaliser_genotype(genotype) -> Optional[str]:
+    """Forme canonique d'un appel : 'G/A', 'ga' ou 'GA' → 'AG' ; les dosages 0/1/2 sont conservés."""
+    if genotype is None:
+        return None
+    texte = "".join(c for c in str(genotype).upper() if c.isalnum())
+    if len(texte) == 2 and texte.isalpha():
+        return "".join(sorted(texte))
+    return texte or None
+
+def lire_snps_texte(texte: str) -> Optional[Dict[str, str]]:
+    """Interprète le JSON libre de saisie des SNPs ({'BMP15': 'AA', ...}, guillemets simples acceptés)."""
+    try:
+        donnees = json.loads(texte)
+    except (ValueError, TypeError):
+        try:
+            donnees = ast.literal_eval(texte)
+        except (ValueError, SyntaxError):
+            return None
+    if not isinstance(donnees, dict):
+        return None
+    snps = {}
+    for snp, valeur in donnees.items():
+        if isinstance(valeur, dict):
+            valeur = valeur.get("genotype", valeur.get("génotype"))
+        if isinstance(valeur, (str, int, float)):
+            snps[str(snp).strip()] = valeur
+    return snps
+
+def enregistrer_genotypes(brebis_id: int, snps: Dict[str, str], conn: Optional[sqlite3.Connection] = None):
+    """Remplace les appels des SNPs donnés pour une brebis (chromosome repris des gènes connus)."""
+    conn = conn or db.conn
+    lignes = [(brebis_id, snp, normaliser_genotype(g), Config.GENES_ECONOMIQUES.get(snp.upper(), {}).get("chr"))
+              for snp, g in snps.items() if normaliser_genotype(g)]
+    conn.executemany("DELETE FROM genotypes WHERE brebis_id=? AND snp_name=?", [(l[0], l[1]) for l in lignes])
+    conn.executemany("INSERT INTO genotypes (brebis_id, snp_name, genotype, chromosome) VALUES (?, ?, ?, ?)", lignes)
+    conn.commit()
+
+def genotypes_brebis(brebis_id: int) -> pd.DataFrame:
+    return pd.read_sql_query("""
+        SELECT snp_name AS SNP, genotype AS Génotype, chromosome AS Chromosome, position AS Position
+        FROM genotypes WHERE brebis_id=? ORDER BY snp_name
+    """, db.conn, params=(brebis_id,))
+
+def _filtre_utilisateur(user_id, eleveur_id=None) -> Tuple[str, str, List]:
+    """Jointure et clause WHERE restreignant les brebis à l'utilisateur (et à l'éleveur choisi)."""
+    jointure = """
+        JOIN brebis b ON g.brebis_id = b.id
+        JOIN elevages e ON b.elevage_id = e.id
+        JOIN eleveurs el ON e.eleveur_id = el.id
+    """
+    clause, params = "el.user_id=?", [user_id]
+    if eleveur_id:
+        clause += " AND el.id=?"
+        params.append(eleveur_id)
+    return jointure, clause, params
+
+def _valider_allele(allele: str) -> str:
+    """Allèle d'une seule lettre parmi A, C, G, T, I, D (insertion / délétion) ; lève ValueError sinon."""
+    allele = (allele or "").strip().upper()
+    if len(allele) != 1 or allele not in "ACGTID":
+        raise ValueError(f"Allèle invalide : {allele!r} (attendu : une lettre parmi A, C, G, T, I, D)")
+    return allele
+
+def porteurs_allele(snp_name: str, allele: str, user_id, eleveur_id=None,
+                    limite: Optional[int] = None) -> pd.DataFrame:
+    """Brebis portant `allele` au SNP donné, avec leur nombre de copies.
+
+    Les génotypes distincts du SNP sont d'abord lus dans les effectifs agrégés,
+    puis seuls ceux qui contiennent l'allèle sont recherchés sur l'index couvrant
+    (snp_name, genotype, brebis_id).
+    """
+    allele = _valider_allele(allele)
+    distincts = [g for (g,) in db.fetchall(
+        "SELECT DISTINCT genotype FROM comptes_genotypes WHERE snp_name=? AND n > 0", (snp_name,))]
+    cibles = [g for g in distincts if g and allele in g]
+    if not cibles:
+        return pd.DataFrame(columns=["brebis_id", "numero_id", "nom", "elevage", "genotype", "copies"])
+    jointure, clause, params = _filtre_utilisateur(user_id, eleveur_id)
+    df = pd.read_sql_query(f"""
+        SELECT b.id AS brebis_id, b.numero_id, b.nom, e.nom AS elevage, g.genotype
+        FROM genotypes g {jointure}
+        WHERE g.snp_name=? AND g.genotype IN ({",".join("?" * len(cibles))}) AND {clause}
+        ORDER BY b.numero_id
+        {"LIMIT " + str(int(limite)) if limite else ""}
+    """, db.conn, params=[snp_name] + cibles + params)
+    df["copies"] = [g.count(allele) for g in df["genotype"]]
+    return df
+
+def compter_porteurs(snp_name: str, allele: str, user_id, eleveur_id=None) -> int:
+    """Nombre de brebis portant `allele`, lu dans les effectifs agrégés (sans parcourir les appels)."""
+    allele = _valider_allele(allele)
+    params = [snp_name, user_id]
+    filtre_eleveur = ""
+    if eleveur_id:
+        filtre_eleveur = " AND el.id=?"
+        params.append(eleveur_id)
+    lignes = db.fetchall(f"""
+        SELECT c.genotype, SUM(c.n)
+        FROM comptes_genotypes c
+        JOIN elevages e ON c.elevage_id = e.id
+        JOIN eleveurs el ON e.eleveur_id = el.id
+        WHERE c.snp_name=? AND el.user_id=?{filtre_eleveur}
+        GROUP BY c.genotype
+    """, tuple(params))
+    return int(sum(n for g, n in lignes if g and allele in g))
+
+def frequences_alleliques(snp_name: str, user_id, eleveur_id=None) -> pd.DataFrame:
+    """Fréquences alléliques d'un SNP par élevage, lues dans les effectifs pré-agrégés `comptes_genotypes`."""
+    params = [snp_name, user_id]
+    filtre_eleveur = ""
+    if eleveur_id:
+        filtre_eleveur = " AND el.id=?"
+        params.append(eleveur_id)
+    comptes = pd.read_sql_query(f"""
+        SELECT e.nom AS elevage, c.genotype, c.n
+        FROM comptes_genotypes c
+        JOIN elevages e ON c.elevage_id = e.id
+        JOIN eleveurs el ON e.eleveur_id = el.id
+        WHERE c.snp_name=? AND c.n > 0 AND el.user_id=?{filtre_eleveur}
+    """, db.conn, params=params)
+    comptes = comptes[comptes["genotype"].str.fullmatch(r"[A-Z]{2}", na=False)]
+    if comptes.empty:
+        return pd.DataFrame(columns=["elevage", "allele", "copies", "frequence", "n_brebis"])
+    alleles = pd.concat([comptes.assign(allele=comptes["genotype"].str[0]),
+                         comptes.assign(allele=comptes["genotype"].str[1])])
+    freq = alleles.groupby(["elevage", "allele"], as_index=False)["n"].sum().rename(columns={"n": "copies"})
+    totaux = comptes.groupby("elevage")["n"].sum()
+    freq["n_brebis"] = freq["elevage"].map(totaux)
+    freq["frequence"] = freq["copies"] / (2 * freq["n_brebis"])
+    return freq[["elevage", "allele", "copies", "frequence", "n_brebis"]]
+
+# -----------------------------------------------------------------------------
+# STOCK DE GÉNOTYPES (2 BITS PAR APPEL, LECTURE PAR MEMMAP)
+# -----------------------------------------------------------------------------
+def _table_decodage(codes: List[int]) -> np.ndarray:
+    """Table (256 × 4) donnant, pour chaque octet, les 4 dosages qu'il contient (-1 = manquant)."""
+    octets = np.arange(256, dtype=np.uint8)
+    champs = np.stack([(octets >> (2 * k)) & 3 for k in range(4)], axis=1)
+    return np.asarray(codes, dtype=np.int8)[champs]
+
+# Codage du stock : 0, 1, 2 = nombre d'allèles alternatifs, 3 = manquant
+CODE_MANQUANT = 3
+LUT_STOCK = _table_decodage([0, 1, 2, -1])
+
+def compacter_dosages(G: np.ndarray) -> np.ndarray:
+    """Compacte un bloc (n × b) de dosages (NaN ou -1 = manquant) en octets (b × ceil(n/4))."""
+    G = np.asarray(G, dtype=float)
+    codes = np.where(np.isnan(G) | (G < 0), CODE_MANQUANT, np.rint(G)).astype(np.uint8).T
+    n = codes.shape[1]
+    if n % 4:
+        codes = np.concatenate([codes, np.full((codes.shape[0], 4 - n % 4), CODE_MANQUANT, np.uint8)], axis=1)
+    codes = codes.reshape(codes.shape[0], -1, 4)
+    return codes[:, :, 0] | (codes[:, :, 1] << 2) | (codes[:, :, 2] << 4) | (codes[:, :, 3] << 6)
+
+def dosages_depuis_texte(snp: pd.Series, genotype: pd.Series) -> Tuple[np.ndarray, pd.DataFrame]:
+    """Convertit des génotypes texte ('AG', 'A/G', '0', '2'...) en dosages de l'allèle alternatif.
+
+    L'allèle de référence d'un SNP est son allèle le plus fréquent ; les valeurs
+    numériques sont prises telles quelles. Renvoie les dosages (NaN = manquant)
+    et la table des allèles (snp_name, allele_ref, allele_alt).
+    """
+    texte = genotype.fillna("").astype(str).str.upper().str.replace(r"[^A-Z0-9]", "", regex=True)
+    dosage = pd.to_numeric(texte.where(texte.str.fullmatch(r"[012]")), errors="coerce")
+    lettres = texte.str.fullmatch(r"[ACGTID]{2}")
+
+    a1, a2 = texte.str[0], texte.str[1]
+    alleles = pd.DataFrame({"snp_name": pd.concat([snp[lettres], snp[lettres]]),
+                            "allele": pd.concat([a1[lettres], a2[lettres]])})
+    comptes = alleles.groupby(["snp_name", "allele"]).size().reset_index(name="n")
+    comptes = comptes.sort_values(["snp_name", "n"], ascending=[True, False])
+    ref = comptes.drop_duplicates("snp_name").set_index("snp_name")["allele"]
+    alt = comptes[~comptes.set_index(["snp_name", "allele"]).index.isin(list(ref.items()))] \
+        .drop_duplicates("snp_name").set_index("snp_name")["allele"]
+
+    ref_ligne = snp.map(ref)
+    dosage = dosage.where(~lettres, (a1 != ref_ligne).astype(float) + (a2 != ref_ligne).astype(float))
+    table_alleles = pd.DataFrame({"allele_ref": ref, "allele_alt": alt}).rename_axis("snp_name").reset_index()
+    return dosage.to_numpy(dtype=float), table_alleles
+
+class GenotypeStore:
+    """Stock de génotypes compacté à 2 bits par appel et lu par np.memmap.
+
+    Le fichier binaire est organisé par SNP : une ligne de ceil(n/4) octets par
+    SNP, 4 individus par octet. `echantillons.csv` (identifiant, brebis_id) et
+    `snps.csv` (snp_name, chromosome, position, allèles) indexent lignes et colonnes.
+    """
+    FICHIER = "genotypes.bin"
+
+    def __init__(self, dossier: str):
+        self.dossier = dossier
+        with open(os.path.join(dossier, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.echantillons = pd.read_csv(os.path.join(dossier, "echantillons.csv"), dtype={"identifiant": str})
+        self.snps = pd.read_csv(os.path.join(dossier, "snps.csv"), dtype={"snp_name": str, "chromosome": str})
+        self.empreinte = self.meta["empreinte"]
+        self._ouvrir(os.path.join(dossier, self.FICHIER), LUT_STOCK)
+
+    def _ouvrir(self, chemin: str, lut: np.ndarray, decalage: int = 0):
+        """Projette le fichier binaire (m × ceil(n/4) octets) en mémoire."""
+        self.n = len(self.echantillons)
+        self.m = len(self.snps)
+        self.octets_par_snp = (self.n + 3) // 4
+        self.lut = lut
+        self._bin = np.memmap(chemin, dtype=np.uint8, mode="r", offset=decalage,
+                              shape=(self.m, self.octets_par_snp))
+
+    def __getstate__(self):
+        # Envoi vers un processus de calcul : seul le chemin du binaire voyage, le
+        # processus le reprojette en mémoire (pages partagées via le cache système)
+        etat = {k: v for k, v in self.__dict__.items() if k not in ("_bin", "echantillons", "snps")}
+        etat["_chemin_bin"] = self._bin.filename
+        etat["_decalage"] = self._bin.offset
+        return etat
+
+    def __setstate__(self, etat):
+        chemin, decalage = etat.pop("_chemin_bin"), etat.pop("_decalage")
+        self.__dict__.update(etat)
+        self._bin = np.memmap(chemin, dtype=np.uint8, mode="r", offset=decalage,
+                              shape=(self.m, self.octets_par_snp))
+
+    def decoder_bloc(self, debut: int, fin: int, lignes=None, dtype=np.float32) -> np.ndarray:
+        """Décode les SNPs [debut, fin) en matrice (individus × SNPs).
+
+        Avec dtype=np.int8 les manquants valent -1 (chemin rapide) ; avec un type
+        flottant ils valent NaN.
+        """
+        codes = self.lut[self._bin[debut:fin]].reshape(fin - debut, -1)[:, :self.n]
+        if lignes is not None:
+            codes = codes[:, lignes]
+        G = np.ascontiguousarray(codes.T)
+        if np.dtype(dtype) == np.int8:
+            return G
+        Gf = G.astype(dtype)
+        Gf[G < 0] = np.nan
+        return Gf
+
+    def decoder_colonnes(self, colonnes: np.ndarray, lignes=None, dtype=np.float32, ecart_max: int = 16) -> np.ndarray:
+        """Décode les SNPs `colonnes` (triés) en ne lisant que leurs plages contiguës.
+
+        Deux SNPs séparés de moins de `ecart_max` positions sont lus dans la même plage :
+        un sous-ensemble épars (panel élagué, SNPs d'intérêt) ne décode pas tout le chip.
+        """
+        colonnes = np.asarray(colonnes)
+        coupures = np.flatnonzero(np.diff(colonnes) > ecart_max) + 1
+        morceaux = []
+        for plage in np.split(colonnes, coupures):
+            G = self.decoder_bloc(int(plage[0]), int(plage[-1]) + 1, lignes, dtype)
+            morceaux.append(G[:, plage - plage[0]])
+        return morceaux[0] if len(morceaux) == 1 else np.hstack(morceaux)
+
+    def iter_blocs(self, taille_bloc: Optional[int] = None, lignes=None, dtype=np.float32, snps=None):
+        """Parcourt le stock par blocs de SNPs et produit (noms, G_bloc)."""
+        n_lignes = self.n if lignes is None else len(lignes)
+        taille_bloc = taille_bloc or taille_bloc_auto(n_lignes)
+        noms = self.snps["snp_name"].to_numpy()
+        if snps is not None:
+            snps = np.sort(np.asarray(snps))
+            for debut in range(0, len(snps), taille_bloc):
+                sel = snps[debut:debut + taille_bloc]
+                yield noms[sel], self.decoder_colonnes(sel, lignes, dtype)
+            return
+        for debut in range(0, self.m, taille_bloc):
+            fin = min(debut + taille_bloc, self.m)
+            yield noms[debut:fin], self.decoder_bloc(debut, fin, lignes, dtype)
+
+    def lignes_brebis(self, brebis_ids) -> np.ndarray:
+        """Indices de lignes du stock correspondant aux brebis demandées (-1 si absente)."""
+        index = pd.Series(np.arange(self.n), index=self.echantillons["brebis_id"])
+        index = index[index.index.notna()]
+        index = index[~index.index.duplicated()]
+        return pd.Series(brebis_ids).map(index).fillna(-1).astype(int).to_numpy()
+
+    def aligner_phenotypes(self, df_pheno: pd.DataFrame, trait: str):
+        """Retourne (lignes du stock, valeurs du trait) pour les brebis phénotypées présentes dans le stock."""
+        df = df_pheno[["brebis_id", trait]].dropna()
+        lignes = self.lignes_brebis(df["brebis_id"].to_numpy())
+        garde = lignes >= 0
+        return lignes[garde], df[trait].to_numpy(dtype=float)[garde]
+
+    @classmethod
+    def ecrire(cls, dossier: str, blocs, echantillons: pd.DataFrame, snps: pd.DataFrame,
+               meta: Optional[Dict] = None) -> "GenotypeStore":
+        """Écrit un stock à partir d'un flux de blocs (n × b) de dosages, SNP par SNP.
+
+        Le stock est écrit dans un dossier temporaire puis substitué à l'ancien.
+        """
+        temporaire = dossier + ".tmp"
+        shutil.rmtree(temporaire, ignore_errors=True)
+        os.makedirs(temporaire)
+        empreinte = hashlib.sha1()
+        with open(os.path.join(temporaire, cls.FICHIER), "wb") as f:
+            for G in blocs:
+                octets = compacter_dosages(G).tobytes()
+                empreinte.update(octets)
+                f.write(octets)
+        echantillons.to_csv(os.path.join(temporaire, "echantillons.csv"), index=False)
+        snps.to_csv(os.path.join(temporaire, "snps.csv"), index=False)
+        for fichier in ["echantillons.csv", "snps.csv"]:
+            with open(os.path.join(temporaire, fichier), "rb") as f:
+                empreinte.update(f.read())
+        meta = dict(meta or {}, empreinte=empreinte.hexdigest(), n=len(echantillons), m=len(snps),
+                    date=datetime.now().isoformat())
+        with open(os.path.join(temporaire, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        shutil.rmtree(dossier, ignore_errors=True)
+        os.replace(temporaire, dossier)
+        return cls(dossier)
+
+# Codage PLINK .bed : 00 = homozygote A1, 01 = manquant, 10 = hétérozygote, 11 = homozygote A2
+LUT_PLINK = _table_decodage([2, -1, 1, 0])
+MAGIQUE_PLINK = bytes([0x6C, 0x1B, 0x01])
+
+class StockPlink(GenotypeStore):
+    """Lecture en flux d'un jeu PLINK binaire (.bed/.bim/.fam), sans conversion.
+
+    Le .bed en mode SNP-major a la même organisation que le stock interne ;
+    seuls le décalage de 3 octets et la table de décodage changent. Les dosages
+    comptent l'allèle A1 (allele_alt), A2 étant l'allèle de référence.
+    """
+
+    def __init__(self, prefixe: str, user_id: Optional[int] = None):
+        self.dossier = os.path.dirname(prefixe)
+        with open(prefixe + ".bed", "rb") as f:
+            entete = f.read(3)
+        if entete != MAGIQUE_PLINK:
+            raise ValueError("Fichier .bed invalide ou non SNP-major")
+        fam = pd.read_csv(prefixe + ".fam", sep=r"\s+", header=None, dtype=str, usecols=[0, 1],
+                          names=["famille", "identifiant"])
+        bim = pd.read_csv(prefixe + ".bim", sep=r"\s+", header=None,
+                          names=["chromosome", "snp_name", "cm", "position", "allele_alt", "allele_ref"],
+                          dtype={"chromosome": str, "snp_name": str, "allele_alt": str, "allele_ref": str})
+        self.snps = bim[["snp_name", "chromosome", "position", "allele_ref", "allele_alt"]]
+        self.echantillons = fam[["identifiant"]].assign(brebis_id=self._brebis_par_numero(fam["identifiant"], user_id))
+
+        attendu = 3 + len(self.snps) * ((len(fam) + 3) // 4)
+        taille = os.path.getsize(prefixe + ".bed")
+        if taille != attendu:
+            raise ValueError(f"Taille du .bed incohérente ({taille} octets, {attendu} attendus)")
+        stat = os.stat(prefixe + ".bed")
+        self.meta = {"source": prefixe, "n": len(fam), "m": len(bim)}
+        self.empreinte = hashlib.sha1(f"{os.path.abspath(prefixe)}|{stat.st_size}|{stat.st_mtime_ns}".encode()).hexdigest()
+        self._ouvrir(prefixe + ".bed", LUT_PLINK, decalage=3)
+
+    @staticmethod
+    def _brebis_par_numero(identifiants: pd.Series, user_id: Optional[int]) -> pd.Series:
+        """Associe les IID du .fam à brebis.id via brebis.numero_id (NaN si inconnue)."""
+        query = "SELECT b.numero_id, b.id FROM brebis b"
+        params = []
+        if user_id is not None:
+            query += """
+                JOIN elevages e ON b.elevage_id = e.id
+                JOIN eleveurs el ON e.eleveur_id = el.id
+                WHERE el.user_id=?
+            """
+            params.append(user_id)
+        correspondance = pd.read_sql_query(query, db.conn, params=params).drop_duplicates("numero_id")
+        return identifiants.map(correspondance.set_index("numero_id")["id"])
+
+def enregistrer_fichiers_plink(fichiers: Dict[str, object]) -> str:
+    """Copie par morceaux des fichiers PLINK téléversés sur disque ; renvoie le préfixe du jeu.
+
+    La copie est rangée sous l'empreinte de son contenu : un même jeu n'est copié qu'une fois,
+    et seules les Config.PLINK_COPIES_MAX copies les plus récentes sont conservées.
+    """
+    racine = os.path.join(GENO_DIR, "plink")
+    temporaire = os.path.join(racine, f".tmp-{uuid.uuid4().hex[:12]}")
+    os.makedirs(temporaire)
+    empreinte = hashlib.sha1()
+    for extension in sorted(fichiers):
+        fichier = fichiers[extension]
+        fichier.seek(0)
+        empreinte.update(extension.encode())
+        with open(os.path.join(temporaire, "donnees" + extension), "wb") as f:
+            while morceau := fichier.read(1 << 20):
+                empreinte.update(morceau)
+                f.write(morceau)
+    dossier = os.path.join(racine, empreinte.hexdigest()[:16])
+    if os.path.exists(dossier):
+        shutil.rmtree(temporaire)
+        os.utime(dossier)
+    else:
+        os.replace(temporaire, dossier)
+
+    copies = sorted((os.path.join(racine, d) for d in os.listdir(racine) if not d.startswith(".tmp-")),
+                    key=os.path.getmtime, reverse=True)
+    for ancienne in copies[Config.PLINK_COPIES_MAX:]:
+        shutil.rmtree(ancienne, ignore_errors=True)
+    return os.path.join(dossier, "donnees")
+
+def construire_stock_troupeau(forcer: bool = False) -> Optional[GenotypeStore]:
+    """Construit (ou réutilise) le stock compacté à partir de la table `genotypes`."""
+    dossier = os.path.join(GENO_DIR, "troupeau")
+    version = version_donnees("genotypes")
+    if not forcer and os.path.exists(os.path.join(dossier, "meta.json")):
+        stock = GenotypeStore(dossier)
+        if stock.meta.get("version_source") == version:
+            return stock
+
+    echantillons = pd.read_sql_query("""
+        SELECT DISTINCT b.numero_id AS identifiant, g.brebis_id
+        FROM genotypes g
+        JOIN brebis b ON g.brebis_id = b.id
+        ORDER BY g.brebis_id
+    """, db.conn)
+    if echantillons.empty:
+        return None
+    snps = pd.read_sql_query("""
+        SELECT g.snp_name, MIN(g.chromosome) AS chromosome, MIN(g.position) AS position
+        FROM genotypes g
+        JOIN brebis b ON g.brebis_id = b.id
+        GROUP BY g.snp_name
+    """, db.conn)
+    snps = snps.assign(_chr=pd.to_numeric(snps["chromosome"], errors="coerce")) \
+        .sort_values(["_chr", "chromosome", "position", "snp_name"]).drop(columns="_chr").reset_index(drop=True)
+    # Les allèles sont déterminés SNP par SNP pendant la lecture des blocs ; `ecrire` n'écrit
+    # snps.csv qu'après avoir consommé le flux, les colonnes sont donc complétées en place
+    snps["allele_ref"], snps["allele_alt"] = None, None
+    ligne_de = pd.Series(np.arange(len(echantillons)), index=echantillons["brebis_id"].to_numpy())
+
+    def blocs():
+        taille = taille_bloc_auto(len(echantillons))
+        for debut in range(0, len(snps), taille):
+            noms = snps["snp_name"].iloc[debut:debut + taille]
+            df = pd.read_sql_query("""
+                SELECT g.brebis_id, g.snp_name, g.genotype
+                FROM genotypes g
+                JOIN brebis b ON g.brebis_id = b.id
+                WHERE g.snp_name IN (SELECT value FROM json_each(?))
+            """, db.conn, params=(json.dumps(noms.tolist()),))
+            dosage, alleles = dosages_depuis_texte(df["snp_name"], df["genotype"])
+            colonne_de = pd.Series(np.arange(len(noms)), index=noms.to_numpy())
+            G = np.full((len(echantillons), len(noms)), np.nan, dtype=np.float32)
+            G[ligne_de[df["brebis_id"]].to_numpy(), colonne_de[df["snp_name"]].to_numpy()] = dosage
+            alleles = alleles.set_index("snp_name").reindex(noms)
+            snps.loc[noms.index, "allele_ref"] = alleles["allele_ref"].to_numpy()
+            snps.loc[noms.index, "allele_alt"] = alleles["allele_alt"].to_numpy()
+            yield G
+
+    return GenotypeStore.ecrire(dossier, blocs(), echantillons[["identifiant", "brebis_id"]], snps,
+                                meta={"version_source": version})
+
+# -----------------------------------------------------------------------------
+# SEUILS GWAS PAR PERMUTATIONS (MAX-T)
+# -----------------------------------------------------------------------------
+def _max_t_lot(source, lignes: np.ndarray, yc: np.ndarray, graine, n_perm: int, taille_bloc: int,
+               colonnes: Optional[np.ndarray] = None) -> np.ndarray:
+    """Balaye le génome (ou les SNPs `colonnes`) pour un lot de permutations et renvoie max|T| de chacune."""
+    rng = np.random.default_rng(graine)
+    Y = np.stack([rng.permutation(yc) for _ in range(n_perm)], axis=1)
+    max_t = np.zeros(n_perm)
+    if colonnes is None:
+        colonnes = np.arange(source.m if hasattr(source, "decoder_bloc") else source.shape[1])
+    for debut in range(0, len(colonnes), taille_bloc):
+        sel = colonnes[debut:debut + taille_bloc]
+        if hasattr(source, "decoder_bloc"):
+            G = source.decoder_colonnes(sel, lignes, dtype=np.float64)
+        else:
+            G = source[np.ix_(lignes, sel)]
+        _, _, t, _, _ = association_bloc(G, Y, avec_p=False)
+        if t.size:
+            max_t = np.maximum(max_t, np.abs(np.nan_to_num(t, nan=0.0)).max(axis=0))
+    return max_t
+
+def permutations_max_t(source, y: np.ndarray, lignes: Optional[np.ndarray] = None, n_permutations: int = 1000,
+                       graine: int = 0, n_jobs: int = -1, taille_lot: int = 50,
+                       taille_bloc: Optional[int] = None, colonnes: Optional[np.ndarray] = None) -> np.ndarray:
+    """Distribution nulle de max|T| sur le génome par permutation des phénotypes.
+
+    `source` est un GenotypeStore (relu par memmap dans chaque processus) ou une
+    matrice (n × m), partagée par joblib sous forme de memmap. Les permutations
+    sont réparties par lots sur un pool de processus, chaque lot parcourant le
+    génome une seule fois avec le noyau d'association vectorisé. `colonnes`
+    restreint le balayage à un sous-ensemble trié de SNPs (panel élagué).
+    """
+    y = np.asarray(y, dtype=float)
+    if lignes is None:
+        lignes = np.arange(len(y))
+    garde = ~np.isnan(y)
+    lignes, y = np.asarray(lignes)[garde], y[garde]
+    yc = y - y.mean()
+    taille_bloc = taille_bloc or taille_bloc_auto(len(lignes))
+    lots = [min(taille_lot, n_permutations - debut) for debut in range(0, n_permutations, taille_lot)]
+    graines = np.random.SeedSequence(graine).spawn(len(lots))
+    resultats = joblib.Parallel(n_jobs=n_jobs)(
+        joblib.delayed(_max_t_lot)(source, lignes, yc, g, k, taille_bloc, colonnes) for g, k in zip(graines, lots)
+    )
+    return np.concatenate(resultats)
+
+def seuils_permutation(df_res: pd.DataFrame, max_t: np.ndarray, alpha: float = 0.05) -> Dict:
+    """Ajoute les p-values empiriques ajustées (max-T) à `df_res` et calcule le seuil génomique."""
+    t_obs = np.abs(df_res['T'].to_numpy(dtype=float))
+    tries = np.sort(max_t)
+    depassements = len(tries) - np.searchsorted(tries, t_obs, side="left")
+    df_res['P_empirique'] = np.where(np.isnan(t_obs), np.nan, (1 + depassements) / (len(tries) + 1))
+    seuil_t = float(np.quantile(max_t, 1 - alpha))
+    ddl = max(float(np.nanmedian(df_res['N'].to_numpy(dtype=float))) - 2, 1)
+    seuil_p = float(2 * stats.t.sf(seuil_t, ddl))
+    return {"seuil_t": seuil_t, "seuil_p": seuil_p, "alpha": alpha, "n_permutations": len(max_t)}
+
+# -----------------------------------------------------------------------------
+# MATRICE DE PARENTÉ GÉNOMIQUE (GRM VANRADEN)
+# -----------------------------------------------------------------------------
+def centrer_bloc_vanraden(G: np.ndarray):
+    """Centre un bloc de dosages sur 2p (Z de VanRaden) ; manquants imputés à la moyenne (0 après centrage).
+
+    Renvoie Z en float32 et la contribution du bloc au dénominateur 2·Σp(1-p).
+    """
+    observe = ~np.isnan(G)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        p = np.where(observe, G, 0).sum(axis=0) / observe.sum(axis=0) / 2
+    polymorphe = np.isfinite(p) & (p > 0) & (p < 1)
+    Z = np.where(observe[:, polymorphe], G[:, polymorphe] - 2 * p[polymorphe], 0).astype(np.float32)
+    return Z, float(2 * (p[polymorphe] * (1 - p[polymorphe])).sum())
+
+def _cle_grm(stock: GenotypeStore, lignes: np.ndarray) -> str:
+    """Clé de cache d'une GRM : empreinte du jeu de génotypes + individus retenus."""
+    return hashlib.sha1(f"{stock.empreinte}|".encode() + np.asarray(lignes, dtype=np.int64).tobytes()).hexdigest()[:16]
+
+def grm_vanraden(stock: GenotypeStore, lignes: Optional[np.ndarray] = None, n_threads: Optional[int] = None,
+                 taille_bloc: Optional[int] = None, forcer: bool = False) -> Tuple[np.memmap, Dict]:
+    """GRM de VanRaden G = ZZᵀ / 2Σp(1-p), calculée en flux et mise en cache sur disque.
+
+    Les SNPs sont lus par blocs ; pour chaque bloc, ZZᵀ est accumulé par tuiles
+    de lignes (triangle supérieur) réparties sur `n_threads` threads, BLAS étant
+    limité à un thread par tuile. Le résultat est un memmap float32 (n × n)
+    rangé sous une clé dérivée de l'empreinte du stock : rien n'est recalculé
+    tant que les génotypes et les individus sont inchangés.
+    """
+    lignes = np.arange(stock.n) if lignes is None else np.asarray(lignes)
+    n = len(lignes)
+    dossier = os.path.join(GENO_DIR, "grm", _cle_grm(stock, lignes))
+    chemin = os.path.join(dossier, "grm.f32")
+    if not forcer and os.path.exists(os.path.join(dossier, "meta.json")):
+        with open(os.path.join(dossier, "meta.json")) as f:
+            meta = json.load(f)
+        return np.memmap(chemin, dtype=np.float32, mode="r", shape=(n, n)), meta
+
+    n_threads = n_threads or os.cpu_count() or 1
+    taille_tuile = max(1, -(-n // (2 * n_threads)))
+    tuiles = [(i, min(i + taille_tuile, n)) for i in range(0, n, taille_tuile)]
+    temporaire = dossier + ".tmp"
+    shutil.rmtree(temporaire, ignore_errors=True)
+    os.makedirs(temporaire)
+    # Accumulation directe dans le memmap de sortie : aucune copie dense de la matrice en mémoire
+    K = np.memmap(os.path.join(temporaire, "grm.f32"), dtype=np.float32, mode="w+", shape=(n, n))
+    denominateur, m_utilises = 0.0, 0
+
+    def accumuler(tuile, Z):
+        debut, fin = tuile
+        # Triangle supérieur seulement : colonnes à partir de la tuile courante
+        K[debut:fin, debut:] += Z[debut:fin] @ Z[debut:].T
+
+    debut_calcul = time.time()
+    with threadpool_limits(limits=1, user_api="blas"), ThreadPoolExecutor(max_workers=n_threads) as pool:
+        for _, G in stock.iter_blocs(taille_bloc=taille_bloc, lignes=lignes, dtype=np.float32):
+            Z, d = centrer_bloc_vanraden(G)
+            if Z.shape[1] == 0:
+                continue
+            denominateur += d
+            m_utilises += Z.shape[1]
+            list(pool.map(lambda tuile: accumuler(tuile, Z), tuiles))
+
+    if denominateur == 0:
+        del K
+        shutil.rmtree(temporaire, ignore_errors=True)
+        raise ValueError("Aucun SNP polymorphe : GRM non calculable")
+
+    # Normalisation puis symétrisation tuile par tuile, en place
+    for debut, fin in tuiles:
+        K[debut:fin, debut:] /= denominateur
+    for debut, fin in tuiles:
+        K[debut:fin, :debut] = K[:debut, debut:fin].T
+    K.flush()
+    del K
+    echantillons = stock.echantillons.iloc[lignes].reset_index(drop=True)
+    echantillons.to_csv(os.path.join(temporaire, "echantillons.csv"), index=False)
+    meta = {"n": n, "m": m_utilises, "denominateur": denominateur, "empreinte_stock": stock.empreinte,
+            "duree_s": round(time.time() - debut_calcul, 2), "date": datetime.now().isoformat()}
+    with open(os.path.join(temporaire, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    shutil.rmtree(dossier, ignore_errors=True)
+    os.replace(temporaire, dossier)
+    return np.memmap(chemin, dtype=np.float32, mode="r", shape=(n, n)), meta
+
+# -----------------------------------------------------------------------------
+# DÉSÉQUILIBRE DE LIAISON (LD) ET ÉLAGAGE
+# -----------------------------------------------------------------------------
+def standardiser_bloc(G: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Standardise un bloc de dosages (manquants imputés à la moyenne) et renvoie aussi la MAF par SNP."""
+    moyenne = np.nanmean(G, axis=0)
+    Z = np.where(np.isnan(G), 0, G - moyenne)
+    ecart = np.sqrt((Z * Z).mean(axis=0))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        Z = np.where(ecart > 0, Z / ecart, 0)
+    p = moyenne / 2
+    return Z, np.nan_to_num(np.minimum(p, 1 - p))
+
+def paires_ld(stock: GenotypeStore, fenetre: int = Config.LD_FENETRE, seuil: float = Config.LD_SEUIL_STOCKAGE,
+              lignes: Optional[np.ndarray] = None, forcer: bool = False) -> Tuple[sparse.csr_matrix, np.ndarray]:
+    """r² entre chaque SNP et ses `fenetre` suivants sur le même chromosome.
+
+    Le génome est parcouru par morceaux de SNPs décodés avec leur zone de
+    recouvrement ; les corrélations d'un morceau sont obtenues d'un seul produit
+    matriciel. Seules les paires avec r² ≥ `seuil` sont conservées, dans une
+    matrice creuse triangulaire supérieure (m × m) mise en cache avec les MAF.
+    """
+    lignes = np.arange(stock.n) if lignes is None else np.asarray(lignes)
+    cle = hashlib.sha1(f"{_cle_grm(stock, lignes)}|{fenetre}|{seuil}".encode()).hexdigest()[:16]
+    dossier = os.path.join(GENO_DIR, "ld", cle)
+    if not forcer and os.path.exists(os.path.join(dossier, "maf.npy")):
+        return sparse.load_npz(os.path.join(dossier, "paires.npz")), np.load(os.path.join(dossier, "maf.npy"))
+
+    chromosomes = stock.snps["chromosome"].astype(str).to_numpy()
+    taille = max(4 * fenetre, 256)
+    maf = np.zeros(stock.m)
+    lignes_i, colonnes_j, valeurs = [], [], []
+    for debut in range(0, stock.m, taille):
+        fin = min(debut + taille, stock.m)
+        fin_etendue = min(fin + fenetre, stock.m)
+        Z, maf_bloc = standardiser_bloc(stock.decoder_bloc(debut, fin_etendue, lignes, dtype=np.float64))
+        maf[debut:fin] = maf_bloc[:fin - debut]
+        r2 = ((Z[:, :fin - debut].T @ Z) / len(lignes)) ** 2
+
+        # Bande (i, i+1..i+fenetre) du morceau, restreinte au même chromosome
+        i = np.arange(fin - debut)[:, None]
+        j = i + np.arange(1, fenetre + 1)[None, :]
+        dans = j < fin_etendue - debut
+        i, j = np.broadcast_to(i, j.shape)[dans], j[dans]
+        r2_bande = r2[i, j]
+        garde = (r2_bande >= seuil) & (chromosomes[debut + i] == chromosomes[debut + j])
+        lignes_i.append(debut + i[garde])
+        colonnes_j.append(debut + j[garde])
+        valeurs.append(r2_bande[garde].astype(np.float32))
+
+    paires = sparse.csr_matrix((np.concatenate(valeurs), (np.concatenate(lignes_i), np.concatenate(colonnes_j))),
+                               shape=(stock.m, stock.m))
+    os.makedirs(dossier, exist_ok=True)
+    sparse.save_npz(os.path.join(dossier, "paires.npz"), paires)
+    np.save(os.path.join(dossier, "maf.npy"), maf)
+    return paires, maf
+
+def elaguer_ld(stock: GenotypeStore, fenetre: int = Config.LD_FENETRE, pas: int = Config.LD_PAS,
+               seuil_r2: float = Config.LD_SEUIL_R2, lignes: Optional[np.ndarray] = None) -> Dict:
+    """Élagage LD à la manière de PLINK --indep-pairwise (fenêtre, pas, r²).
+
+    Les fenêtres de `fenetre` SNPs avancent de `pas` et repartent au début de chaque
+    chromosome ; dans chacune, une paire restante au-delà de `seuil_r2` fait retirer
+    le SNP de plus faible MAF. Chaque paire n'est examinée qu'une fois, dans la première
+    fenêtre qui contient ses deux SNPs, et les paires ne partageant aucune fenêtre sont
+    ignorées. L'ordre de parcours suit celui d'un balayage fenêtre par fenêtre ; seul le
+    critère de retrait (MAF la plus faible) diffère de PLINK, qui peut aussi tenir compte
+    de l'ordre des SNPs dans la fenêtre. S'appuie sur les paires en cache, puis écrit
+    prune.in / prune.out.
+    """
+    paires, maf = paires_ld(stock, fenetre, min(seuil_r2, Config.LD_SEUIL_STOCKAGE), lignes)
+    fortes = sparse.triu(paires, format="coo")
+    selection = fortes.data > seuil_r2
+    ii, jj = fortes.row[selection], fortes.col[selection]
+    # Une paire n'agit que dans la première fenêtre qui la contient (ensuite l'un des
+    # deux SNPs est déjà retiré, ou la paire reste sous le seuil) : on la traite donc une
+    # seule fois, dans l'ordre (début de cette fenêtre, SNP de tête, SNP suivant).
+    # Les fenêtres sont indexées depuis le premier SNP du chromosome.
+    chromosomes = stock.snps["chromosome"].astype(str).to_numpy()
+    debut_chromosome = np.zeros(stock.m, dtype=np.int64)
+    if stock.m:
+        changements = np.flatnonzero(chromosomes[1:] != chromosomes[:-1]) + 1
+        debut_chromosome = np.repeat(np.concatenate([[0], changements]), np.diff(np.concatenate([[0], changements, [stock.m]])))
+    origine = debut_chromosome[ii]
+    premiere_fenetre = np.maximum(0, -(-(jj - origine - fenetre + 1) // pas)) * pas + origine
+    communes = (premiere_fenetre <= ii) & (debut_chromosome[jj] == origine)
+    ii, jj, premiere_fenetre = ii[communes], jj[communes], premiere_fenetre[communes]
+    ordre = np.lexsort((jj, ii, premiere_fenetre))
+
+    garde = np.ones(stock.m, dtype=bool)
+    for a, b in zip(ii[ordre].tolist(), jj[ordre].tolist()):
+        if garde[a] and garde[b]:
+            garde[a if maf[a] < maf[b] else b] = False
+
+    noms = stock.snps["snp_name"].astype(str).to_numpy()
+    dossier = os.path.join(GENO_DIR, "ld", hashlib.sha1(
+        f"{_cle_grm(stock, np.arange(stock.n) if lignes is None else lignes)}|{fenetre}|{pas}|{seuil_r2}".encode()
+    ).hexdigest()[:16])
+    os.makedirs(dossier, exist_ok=True)
+    pd.Series(noms[garde]).to_csv(os.path.join(dossier, "prune.in"), index=False, header=False)
+    pd.Series(noms[~garde]).to_csv(os.path.join(dossier, "prune.out"), index=False, header=False)
+    return {"indices": np.flatnonzero(garde), "n_gardes": int(garde.sum()), "n_retires": int((~garde).sum()),
+            "paires": paires, "maf": maf, "prune_in": os.path.join(dossier, "prune.in")}
+
+def decroissance_ld(stock: GenotypeStore, paires: sparse.csr_matrix, classes: int = 20) -> pd.DataFrame:
+    """r² moyen des paires stockées en fonction de la distance physique (décroissance du LD)."""
+    coo = paires.tocoo()
+    if coo.nnz == 0:
+        return pd.DataFrame(columns=["distance_kb", "r2_moyen", "paires"])
+    positions = pd.to_numeric(stock.snps["position"], errors="coerce").to_numpy(dtype=float)
+    distance = np.abs(positions[coo.col] - positions[coo.row]) / 1000
+    df = pd.DataFrame({"distance": distance, "r2": coo.data}).dropna()
+    df["classe"] = pd.qcut(df["distance"], q=min(classes, df["distance"].nunique()), duplicates="drop")
+    return df.groupby("classe", observed=True).agg(distance_kb=("distance", "median"), r2_moyen=("r2", "mean"),
+                                                   paires=("r2", "size")).reset_index(drop=True)
+
+# -----------------------------------------------------------------------------
+# GWAS EN MODÈLE MIXTE (EMMAX)
+# -----------------------------------------------------------------------------
+def decomposition_grm(stock: GenotypeStore, lignes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Valeurs et vecteurs propres de la GRM des individus `lignes`, calculés une fois puis mis en cache."""
+    K, _ = grm_vanraden(stock, lignes)
+    dossier = os.path.join(GENO_DIR, "grm", _cle_grm(stock, np.asarray(lignes)))
+    chemin_valeurs, chemin_vecteurs = os.path.join(dossier, "valeurs.npy"), os.path.join(dossier, "vecteurs.npy")
+    if os.path.exists(chemin_valeurs) and os.path.exists(chemin_vecteurs):
+        return np.load(chemin_valeurs), np.load(chemin_vecteurs, mmap_mode="r")
+    valeurs, vecteurs = np.linalg.eigh(np.asarray(K, dtype=np.float64))
+    valeurs = np.clip(valeurs, 0, None)
+    np.save(chemin_vecteurs, vecteurs)
+    np.save(chemin_valeurs, valeurs)
+    return valeurs, vecteurs
+
+def ajuster_modele_nul(valeurs: np.ndarray, vecteurs: np.ndarray, y: np.ndarray) -> Dict:
+    """Estime δ = σ²e/σ²g du modèle y = μ + g + e (REML) dans la base propre de la GRM.
+
+    La vraisemblance restreinte est profilée sur log δ : recherche sur grille puis
+    affinage borné. Renvoie les données tournées et les poids 1/(λ + δ) réutilisés
+    pour chaque SNP.
+    """
+    y = np.asarray(y, dtype=float)
+    y_rot = vecteurs.T @ y
+    x_rot = vecteurs.T @ np.ones(len(y))
+    q = len(y) - 1
+
+    def moins_reml(log_delta):
+        w = 1 / (valeurs + np.exp(log_delta))
+        xwx = (w * x_rot * x_rot).sum()
+        r = y_rot - x_rot * (w * x_rot * y_rot).sum() / xwx
+        return 0.5 * (q * np.log((w * r * r).sum()) + np.log(valeurs + np.exp(log_delta)).sum() + np.log(xwx))
+
+    grille = np.linspace(-10, 10, 101)
+    meilleur = grille[np.argmin([moins_reml(v) for v in grille])]
+    res = minimize_scalar(moins_reml, bounds=(meilleur - 0.2, meilleur + 0.2), method="bounded")
+    delta = float(np.exp(res.x))
+    w = 1 / (valeurs + delta)
+    xwx = (w * x_rot * x_rot).sum()
+    sigma_g2 = float((w * (y_rot - x_rot * (w * x_rot * y_rot).sum() / xwx) ** 2).sum() / q)
+    return {"delta": delta, "h2": 1 / (1 + delta), "sigma_g2": sigma_g2, "sigma_e2": sigma_g2 * delta,
+            "poids": w, "y_rot": y_rot, "x_rot": x_rot}
+
+def gwas_mixte_par_blocs(blocs, modele: Dict, vecteurs: np.ndarray) -> pd.DataFrame:
+    """Test par SNP en GLS avec δ fixé (EMMAX) sur un flux de blocs alignés sur la GRM.
+
+    Chaque bloc est imputé à la moyenne, tourné par Uᵀ puis blanchi par les poids
+    du modèle nul ; le test se réduit alors à une régression simple après
+    projection de l'intercept, vectorisée sur tout le bloc.
+    """
+    racine_w = np.sqrt(modele["poids"])
+    x = modele["x_rot"] * racine_w
+    y = modele["y_rot"] * racine_w
+    ry = y - x * (x @ y) / (x @ x)
+    n = len(y)
+    resultats = []
+    for noms, G in blocs:
+        G = np.asarray(G, dtype=np.float64)
+        moyenne = np.nanmean(G, axis=0)
+        G = np.where(np.isnan(G), moyenne, G)
+        Gw = (vecteurs.T @ G) * racine_w[:, None]
+        Rg = Gw - np.outer(x, (x @ Gw) / (x @ x))
+        sgg = np.einsum("ij,ij->j", Rg, Rg)
+        sgy = Rg.T @ ry
+        with np.errstate(invalid="ignore", divide="ignore"):
+            beta = sgy / sgg
+            rss = ry @ ry - beta * sgy
+            se = np.sqrt(rss / (n - 2) / sgg)
+            t = beta / se
+        valide = sgg > 1e-10
+        beta, se, t = (np.where(valide, a, np.nan) for a in (beta, se, t))
+        resultats.append(pd.DataFrame({
+            'SNP': list(noms), 'Beta': beta, 'SE': se, 'T': t,
+            'P_value': 2 * stats.t.sf(np.abs(t), n - 2), 'N': n
+        }))
+    df_res = pd.concat(resultats, ignore_index=True) if resultats else pd.DataFrame(
+        columns=['SNP', 'Beta', 'SE', 'T', 'P_value', 'N'])
+    df_res['-log10(p)'] = -np.log10(np.maximum(df_res['P_value'].to_numpy(dtype=float), 1e-300))
+    return df_res
+
+def gwas_mixte(stock: GenotypeStore, lignes: np.ndarray, y: np.ndarray,
+               snps: Optional[np.ndarray] = None) -> Tuple[pd.DataFrame, Dict]:
+    """GWAS EMMAX complet : GRM et décomposition (en cache), modèle nul, puis balayage des SNPs."""
+    ordre = np.argsort(lignes)
+    lignes, y = np.asarray(lignes)[ordre], np.asarray(y, dtype=float)[ordre]
+    valeurs, vecteurs = decomposition_grm(stock, lignes)
+    modele = ajuster_modele_nul(valeurs, vecteurs, y)
+    return gwas_mixte_par_blocs(stock.iter_blocs(lignes=lignes, snps=snps), modele, vecteurs), modele
+
+# -----------------------------------------------------------------------------
+# GRAPHIQUES GWAS (MANHATTAN / QQ EN WEBGL)
+# -----------------------------------------------------------------------------
+def positions_snps(noms: pd.Series, snps_meta: Optional[pd.DataFrame] = None) -> pd.DataFrame:
+    """Chromosome et position de chaque SNP : métadonnées du stock, sinon table `genotypes`.
+
+    Les SNPs sans position connue sont rangés sur un pseudo-chromosome final, dans l'ordre d'entrée.
+    """
+    if snps_meta is None:
+        snps_meta = pd.read_sql_query("""
+            SELECT snp_name, MIN(chromosome) AS chromosome, MIN(position) AS position
+            FROM genotypes GROUP BY snp_name
+        """, db.conn)
+    meta = snps_meta[["snp_name", "chromosome", "position"]].drop_duplicates("snp_name").set_index("snp_name")
+    meta.index = meta.index.astype(str)
+    df = meta.reindex(noms.astype(str).to_numpy()).rename_axis("SNP").reset_index()
+    df["chromosome"] = df["chromosome"].astype(object)
+    df["position"] = pd.to_numeric(df["position"], errors="coerce")
+    inconnus = df["chromosome"].isna() | df["position"].isna()
+    df.loc[inconnus, "chromosome"] = "?"
+    df.loc[inconnus, "position"] = np.arange(int(inconnus.sum()))
+    return df
+
+def _ordre_chromosomes(chromosomes) -> List[str]:
+    """Ordre naturel des chromosomes : numériques, puis X, Y, autres, puis inconnus."""
+    def cle(c):
+        c = str(c).upper().replace("CHR", "")
+        if c.isdigit():
+            return (0, int(c), c)
+        return (1 if c in ("X", "Y", "MT") else 2 if c != "?" else 3, 0, c)
+    return sorted({str(c) for c in chromosomes}, key=cle)
+
+def preparer_manhattan(df_res: pd.DataFrame, snps_meta: Optional[pd.DataFrame] = None,
+                       seuil_affichage: float = 3.0, cellules_x: int = 2000, cellules_y: int = 15) -> Tuple[pd.DataFrame, Dict]:
+    """Coordonnées génomiques cumulées et éclaircissement des points non significatifs.
+
+    Tous les SNPs au-dessus de `seuil_affichage` (-log10 p) sont gardés ; en
+    dessous, un seul point (le plus haut) est conservé par cellule d'une grille
+    `cellules_x` × `cellules_y`, ce qui borne le nombre de points quel que soit m.
+    """
+    df = df_res[["SNP", "-log10(p)", "P_value", "Beta"]].reset_index(drop=True)
+    df = pd.concat([df, positions_snps(df["SNP"], snps_meta)[["chromosome", "position"]]], axis=1)
+    df = df[np.isfinite(df["-log10(p)"])]
+    df["chromosome"] = df["chromosome"].astype(str)
+    ordre = _ordre_chromosomes(df["chromosome"].unique())
+    rang = {c: i for i, c in enumerate(ordre)}
+    df["rang_chr"] = df["chromosome"].map(rang)
+
+    etendue = df.groupby("rang_chr")["position"].agg(["min", "max"]).reindex(range(len(ordre)))
+    longueur = (etendue["max"] - etendue["min"]).to_numpy(dtype=float)
+    marge = max(np.nanmax(longueur) * 0.02, 1) if len(longueur) else 1
+    decalage = np.concatenate([[0], np.cumsum(longueur + marge)[:-1]]) - etendue["min"].to_numpy(dtype=float)
+    df["x"] = df["position"].to_numpy(dtype=float) + decalage[df["rang_chr"].to_numpy()]
+
+    hauts = df["-log10(p)"] >= seuil_affichage
+    bas = df[~hauts]
+    if len(bas) > cellules_x:
+        x_min, x_max = df["x"].min(), df["x"].max()
+        cx = ((bas["x"] - x_min) / max(x_max - x_min, 1) * (cellules_x - 1)).astype(int)
+        cy = (bas["-log10(p)"] / seuil_affichage * (cellules_y - 1)).astype(int).clip(0, cellules_y - 1)
+        cellule = cx.to_numpy() * cellules_y + cy.to_numpy()
+        # Tri par -log10(p) décroissant : np.unique retient alors le point le plus haut de chaque cellule
+        par_hauteur = np.argsort(-bas["-log10(p)"].to_numpy(), kind="stable")
+        retenus = par_hauteur[np.unique(cellule[par_hauteur], return_index=True)[1]]
+        bas = bas.iloc[np.sort(retenus)]
+    centres = (etendue["min"].to_numpy(dtype=float) + decalage + longueur / 2)
+    axes = {"chromosomes": ordre, "centres": centres, "n_total": len(df)}
+    return pd.concat([bas, df[hauts]]).sort_values("x"), axes
+
+def figure_manhattan(df_res: pd.DataFrame, snps_meta: Optional[pd.DataFrame] = None,
+                     lignes_seuil: Optional[List[Tuple[float, str, str]]] = None) -> go.Figure:
+    """Manhattan plot en WebGL (go.Scattergl), chromosomes alternés et positions cumulées."""
+    df, axes = preparer_manhattan(df_res, snps_meta)
+    fig = go.Figure()
+    for parite, couleur in [(0, Config.VERT), (1, "#81C784")]:
+        sous = df[df["rang_chr"] % 2 == parite]
+        fig.add_trace(go.Scattergl(
+            x=sous["x"], y=sous["-log10(p)"], mode="markers", marker=dict(size=4, color=couleur),
+            text=(sous["SNP"] + " — Chr " + sous["chromosome"]).tolist(),
+            customdata=sous[["position", "P_value"]].to_numpy(dtype=float),
+            hovertemplate="%{text} : %{customdata[0]:,.0f}<br>p = %{customdata[1]:.2e}<extra></extra>",
+            showlegend=False))
+    for y, texte, couleur in lignes_seuil or []:
+        fig.add_hline(y=y, line_dash="dash", line_color=couleur, annotation_text=texte)
+    fig.update_layout(title=f"Manhattan plot ({axes['n_total']:,} SNPs, {len(df):,} points affichés)",
+                      xaxis=dict(tickmode="array", tickvals=axes["centres"], ticktext=axes["chromosomes"],
+                                 title="Chromosome", showgrid=False),
+                      yaxis_title="-log10(p-value)")
+    return fig
+
+def figure_qq(p_values: np.ndarray, points_max: int = 5000) -> Tuple[go.Figure, float]:
+    """QQ plot des p-values (WebGL, queue conservée, reste éclairci) et facteur d'inflation λGC."""
+    p = np.sort(np.asarray(p_values, dtype=float))
+    p = p[np.isfinite(p) & (p > 0)]
+    if len(p) == 0:
+        return go.Figure(), float("nan")
+    # Le χ² étant monotone en p, la médiane des χ² est celle de la p-value médiane
+    lambda_gc = float(stats.chi2.isf(np.median(p), 1) / stats.chi2.ppf(0.5, 1))
+    attendu = -np.log10((np.arange(1, len(p) + 1) - 0.5) / len(p))
+    observe = -np.log10(p)
+    if len(p) > points_max:
+        # Les plus petites p-values intégralement, le reste échantillonné sur une grille log
+        index = np.unique(np.concatenate([np.arange(points_max // 2),
+                                          np.geomspace(points_max // 2, len(p) - 1, points_max // 2).astype(int)]))
+        attendu, observe = attendu[index], observe[index]
+    fig = go.Figure()
+    fig.add_trace(go.Scattergl(x=attendu, y=observe, mode="markers", marker=dict(size=4, color=Config.VERT),
+                               name="SNPs"))
+    fig.add_trace(go.Scattergl(x=[0, attendu.max()], y=[0, attendu.max()], mode="lines",
+                               line=dict(color="red", dash="dash"), name="Attendu sous H0"))
+    fig.update_layout(title=f"QQ plot (λGC = {lambda_gc:.3f})", xaxis_title="-log10(p) attendu",
+                      yaxis_title="-log10(p) observé", showlegend=False)
+    return fig, lambda_gc
+
+# -----------------------------------------------------------------------------
+# SÉQUENCES NUCLÉOTIDIQUES (STOCKAGE HORS LIGNE, 2 BITS + ZLIB)
+# -----------------------------------------------------------------------------
+_CODES_NUCLEOTIDES = np.full(256, 4, dtype=np.uint8)
+for _i, _b in enumerate(b"ACGT"):
+    _CODES_NUCLEOTIDES[_b] = _i
+    _CODES_NUCLEOTIDES[ord(chr(_b).lower())] = _i
+_CODES_NUCLEOTIDES[ord("U")] = _CODES_NUCLEOTIDES[ord("u")] = 3
+
+def parser_fasta(texte: str) -> List[Tuple[str, str]]:
+    """Découpe un texte FASTA en (en-tête, séquence) ; une séquence nue donne un en-tête vide."""
+    enregistrements, entete, morceaux = [], "", []
+    for ligne in (texte or "").splitlines():
+        ligne = ligne.strip()
+        if ligne.startswith(">"):
+            if morceaux:
+                enregistrements.append((entete, "".join(morceaux)))
+            entete, morceaux = ligne[1:].strip(), []
+        elif ligne:
+            morceaux.append(ligne.replace(" ", ""))
+    if morceaux:
+        enregistrements.append((entete, "".join(morceaux)))
+    return enregistrements
+
+def encoder_sequence(sequence: str) -> np.ndarray:
+    """Séquence → codes uint8 (A=0, C=1, G=2, T/U=3, autre=4)."""
+    return _CODES_NUCLEOTIDES[np.frombuffer(sequence.encode("ascii", errors="replace"), dtype=np.uint8)]
+
+def compacter_sequence(sequence: str) -> Tuple[bytes, bytes]:
+    """Compacte une séquence à 2 bits par base (zlib) avec la liste des plages ambiguës.
+
+    Les bases autres que A/C/G/T (N, IUPAC...) sont codées A dans le flux 2 bits
+    et restituées grâce aux exceptions : triplets int32 (début, longueur, caractère).
+    La casse n'est pas conservée.
+    """
+    brut = np.frombuffer(sequence.upper().encode("ascii", errors="replace"), dtype=np.uint8)
+    codes = _CODES_NUCLEOTIDES[brut]
+    ambigu = codes == 4
+    exceptions = np.zeros((0, 3), dtype=np.int32)
+    if ambigu.any():
+        # Plages consécutives d'un même caractère ambigu
+        rupture = np.flatnonzero(np.diff(np.concatenate([[0], ambigu.astype(np.int8), [0]])) != 0)
+        debuts, fins = rupture[::2], rupture[1::2]
+        morceaux = []
+        for debut, fin in zip(debuts, fins):
+            changement = np.flatnonzero(np.diff(brut[debut:fin])) + 1
+            bornes = np.concatenate([[0], changement, [fin - debut]]) + debut
+            morceaux.append(np.c_[bornes[:-1], np.diff(bornes), brut[bornes[:-1]]])
+        exceptions = np.concatenate(morceaux).astype(np.int32)
+    codes = np.where(ambigu, 0, codes).astype(np.uint8)
+    if len(codes) % 4:
+        codes = np.concatenate([codes, np.zeros(4 - len(codes) % 4, dtype=np.uint8)])
+    quatre = codes.reshape(-1, 4)
+    octets = quatre[:, 0] | (quatre[:, 1] << 2) | (quatre[:, 2] << 4) | (quatre[:, 3] << 6)
+    return zlib.compress(octets.tobytes()), zlib.compress(exceptions.tobytes())
+
+def decompacter_sequence(donnees: bytes, exceptions: bytes, longueur: int) -> str:
+    """Inverse de compacter_sequence."""
+    octets = np.frombuffer(zlib.decompress(donnees), dtype=np.uint8)
+    codes = ((octets[:, None] >> np.array([0, 2, 4, 6], dtype=np.uint8)) & 3).ravel()[:longueur]
+    caracteres = np.frombuffer(b"ACGT", dtype=np.uint8)[codes]
+    for debut, taille, caractere in np.frombuffer(zlib.decompress(exceptions), dtype=np.int32).reshape(-1, 3):
+        caracteres[debut:debut + taille] = caractere
+    return caracteres.tobytes().decode("ascii")
+
+def enregistrer_sequence(brebis_id: int, fasta: str, conn: Optional[sqlite3.Connection] = None) -> int:
+    """Remplace les séquences d'une brebis par les enregistrements du texte FASTA ; renvoie leur nombre."""
+    conn = conn or db.conn
+    conn.execute("DELETE FROM sequences WHERE brebis_id=?", (brebis_id,))
+    conn.execute("DELETE FROM sketches_minhash WHERE brebis_id=?", (brebis_id,))
+    enregistrements = parser_fasta(fasta)
+    for rang, (entete, sequence) in enumerate(enregistrements):
+        donnees, exceptions = compacter_sequence(sequence)
+        conn.execute("""
+            INSERT INTO sequences (brebis_id, rang, entete, longueur, donnees, exceptions, date_maj)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (brebis_id, rang, entete, len(sequence), donnees, exceptions, datetime.now().isoformat()))
+    if enregistrements:
+        # Esquisse MinHash calculée à l'enregistrement, sur l'ensemble des séquences de la brebis
+        enregistrer_esquisse(conn, brebis_id, [seq for _, seq in enregistrements])
+    conn.commit()
+    return len(enregistrements)
+
+def charger_sequences(brebis_id: int) -> List[Tuple[str, str]]:
+    """Enregistrements (en-tête, séquence) d'une brebis, décompressés à la demande."""
+    return [(entete, decompacter_sequence(donnees, exceptions, longueur))
+            for entete, longueur, donnees, exceptions in db.fetchall(
+                "SELECT entete, longueur, donnees, exceptions FROM sequences WHERE brebis_id=? ORDER BY rang",
+                (brebis_id,))]
+
+def charger_sequence_fasta(brebis_id: int, largeur: int = 70) -> str:
+    """Séquences d'une brebis remises au format FASTA (vide si aucune)."""
+    return "\n".join(f">{entete}\n" + "\n".join(seq[i:i + largeur] for i in range(0, len(seq), largeur))
+                     for entete, seq in charger_sequences(brebis_id))
+
+# -----------------------------------------------------------------------------
+# ESQUISSES MINHASH (SIMILARITÉ DES SÉQUENCES À L'ÉCHELLE DU TROUPEAU)
+# -----------------------------------------------------------------------------
+MINHASH_VIDE = np.uint32(0xFFFFFFFF)
+
+def splitmix64(x: np.ndarray) -> np.ndarray:
+    """Hachage splitmix64 vectorisé (uint64 → uint64)."""
+    z = x.astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+def kmers_canoniques(sequence: str, k: int = Config.MINHASH_K) -> np.ndarray:
+    """Codes des k-mers canoniques (minimum du k-mer et de son complément inverse), sans base ambiguë."""
+    codes = encoder_sequence(sequence.upper())
+    directs, valides = codes_kmers(codes, k)
+    inverses, _ = codes_kmers(complement_inverse(codes), k)
+    return np.minimum(directs, inverses[::-1])[valides]
+
+def esquisse_minhash(sequences: List[str], k: int = Config.MINHASH_K,
+                     taille: int = Config.MINHASH_TAILLE) -> Tuple[np.ndarray, int]:
+    """Esquisse MinHash à une permutation : minimum du hachage dans chacun des `taille` compartiments.
+
+    Les bits de poids fort du hachage choisissent le compartiment ; on garde 32
+    bits du reste (uint32, MINHASH_VIDE pour un compartiment vide), soit 2 Ko
+    par brebis pour 512 compartiments.
+    """
+    kmers = np.unique(np.concatenate([kmers_canoniques(s, k) for s in sequences] or [np.zeros(0, np.int64)]))
+    signature = np.full(taille, MINHASH_VIDE, dtype=np.uint32)
+    if len(kmers) == 0:
+        return signature, 0
+    h = splitmix64(kmers)
+    bits = int(np.log2(taille))
+    compartiment = (h >> np.uint64(64 - bits)).astype(np.int64)
+    valeur = ((h >> np.uint64(64 - bits - 32)) & np.uint64(0xFFFFFFFF)).astype(np.uint32)
+    valeur = np.minimum(valeur, MINHASH_VIDE - np.uint32(1))
+    ordre = np.lexsort((valeur, compartiment))
+    premiers = np.unique(compartiment[ordre], return_index=True)[1]
+    signature[compartiment[ordre][premiers]] = valeur[ordre][premiers]
+    return signature, int(len(kmers))
+
+def enregistrer_esquisse(conn: sqlite3.Connection, brebis_id: int, sequences: List[str]):
+    signature, n_kmers = esquisse_minhash(sequences)
+    conn.execute("INSERT OR REPLACE INTO sketches_minhash VALUES (?, ?, ?, ?, ?, ?)",
+                 (brebis_id, Config.MINHASH_K, Config.MINHASH_TAILLE, signature.tobytes(), n_kmers,
+                  datetime.now().isoformat()))
+
+def jaccard_minhash(A: np.ndarray, B: np.ndarray, budget: int = Config.MINHASH_BUDGET_ELEMENTS) -> np.ndarray:
+    """Jaccard estimé entre chaque ligne de A (a × s) et de B (b × s) : compartiments égaux / compartiments non vides.
+
+    Les comptes sont accumulés par tranches de l'esquisse, de sorte que les tableaux
+    intermédiaires (a × b × tranche) ne dépassent pas `budget` éléments.
+    """
+    egaux = np.zeros((len(A), len(B)), dtype=np.int32)
+    non_vides = np.zeros((len(A), len(B)), dtype=np.int32)
+    tranche = max(1, budget // max(len(A) * len(B), 1))
+    for debut in range(0, A.shape[1], tranche):
+        a = A[:, None, debut:debut + tranche]
+        b = B[None, :, debut:debut + tranche]
+        egaux += ((a == b) & (a != MINHASH_VIDE)).sum(axis=2, dtype=np.int32)
+        non_vides += ((a != MINHASH_VIDE) | (b != MINHASH_VIDE)).sum(axis=2, dtype=np.int32)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(non_vides > 0, egaux / non_vides, np.nan)
+
+def distance_mash(jaccard: np.ndarray, k: int = Config.MINHASH_K) -> np.ndarray:
+    """Distance de Mash (≈ divergence par base) à partir du Jaccard estimé."""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.clip(-np.log(2 * jaccard / (1 + jaccard)) / k, 0, 1) + 0.0
+
+def charger_esquisses(user_id) -> Tuple[pd.DataFrame, np.ndarray]:
+    """Esquisses MinHash des brebis de l'utilisateur : (brebis, matrice n × taille)."""
+    lignes = db.fetchall("""
+        SELECT b.id, b.numero_id, b.nom, s.signature, s.n_kmers
+        FROM sketches_minhash s
+        JOIN brebis b ON s.brebis_id = b.id
+        JOIN elevages e ON b.elevage_id = e.id
+        JOIN eleveurs el ON e.eleveur_id = el.id
+        WHERE el.user_id=? AND s.k=? AND s.taille=?
+        ORDER BY b.id
+    """, (user_id, Config.MINHASH_K, Config.MINHASH_TAILLE))
+    brebis = pd.DataFrame([l[:3] + (l[4],) for l in lignes], columns=["brebis_id", "numero_id", "nom", "n_kmers"])
+    signatures = np.stack([np.frombuffer(l[3], dtype=np.uint32) for l in lignes]) if lignes \
+        else np.zeros((0, Config.MINHASH_TAILLE), dtype=np.uint32)
+    return brebis, signatures
+
+def similarites_troupeau(user_id, brebis_id: int) -> pd.DataFrame:
+    """Jaccard et distance de Mash entre une brebis et tout le troupeau, en une opération vectorisée."""
+    brebis, signatures = charger_esquisses(user_id)
+    position = np.flatnonzero(brebis["brebis_id"].to_numpy() == brebis_id)
+    if len(position) == 0:
+        return pd.DataFrame(columns=["brebis_id", "numero_id", "nom", "jaccard", "distance_mash"])
+    jaccard = jaccard_minhash(signatures[position], signatures)[0]
+    resultat = brebis.assign(jaccard=jaccard, distance_mash=distance_mash(jaccard))
+    return resultat[resultat["brebis_id"] != brebis_id].sort_values("jaccard", ascending=False)
+
+def doublons_troupeau(user_id, seuil: float = Config.MINHASH_SEUIL_DOUBLON,
+                      taille_bloc: Optional[int] = None) -> pd.DataFrame:
+    """Couples de brebis dont les séquences sont quasi identiques (échantillons dupliqués probables).
+
+    Par défaut, chaque bloc de brebis est dimensionné pour que ses comparaisons avec tout le
+    troupeau laissent au moins 64 compartiments par tranche dans le budget mémoire.
+    """
+    brebis, signatures = charger_esquisses(user_id)
+    taille_bloc = taille_bloc or max(1, Config.MINHASH_BUDGET_ELEMENTS // (64 * max(len(brebis), 1)))
+    couples = []
+    for debut in range(0, len(brebis), taille_bloc):
+        jaccard = jaccard_minhash(signatures[debut:debut + taille_bloc], signatures)
+        i, j = np.nonzero(np.nan_to_num(jaccard) >= seuil)
+        i = i + debut
+        garde = j > i
+        couples.append(pd.DataFrame({"i": i[garde], "j": j[garde], "jaccard": jaccard[i[garde] - debut, j[garde]]}))
+    if not couples or sum(len(c) for c in couples) == 0:
+        return pd.DataFrame(columns=["Brebis 1", "Brebis 2", "jaccard", "distance_mash"])
+    df = pd.concat(couples, ignore_index=True)
+    return pd.DataFrame({
+        "Brebis 1": brebis["numero_id"].to_numpy()[df["i"]], "Brebis 2": brebis["numero_id"].to_numpy()[df["j"]],
+        "jaccard": df["jaccard"].round(3), "distance_mash": distance_mash(df["jaccard"].to_numpy()).round(5)
+    }).sort_values("jaccard", ascending=False)
+
+# -----------------------------------------------------------------------------
+# RECHERCHE LOCALE DE SÉQUENCES (INDEX DE K-MERS, EXTENSION VECTORISÉE)
+# -----------------------------------------------------------------------------
+def codes_kmers(codes: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Code entier (2 bits par base) de chaque k-mer et masque des k-mers sans base ambiguë."""
+    if len(codes) < k:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool)
+    fenetres = np.lib.stride_tricks.sliding_window_view(codes, k)
+    poids = 4 ** np.arange(k - 1, -1, -1, dtype=np.int64)
+    valides = (fenetres < 4).all(axis=1)
+    return (fenetres.astype(np.int64) * poids).sum(axis=1), valides
+
+def complement_inverse(codes: np.ndarray) -> np.ndarray:
+    return np.where(codes < 4, 3 - codes, 4).astype(np.uint8)[::-1]
+
+class IndexKmers:
+    """Index des k-mers d'une collection de séquences concaténées (séparateurs ambigus).
+
+    Les positions sont triées par code de k-mer : la recherche des graines d'une
+    requête se fait par np.searchsorted, puis l'extension sans gap de toutes les
+    diagonales candidates est vectorisée (meilleur segment par sommes cumulées).
+    """
+
+    def __init__(self, sujets: List[Dict], k: int = Config.RECHERCHE_K):
+        self.k = k
+        self.sujets = sujets
+        morceaux, debuts, position = [], [], 0
+        for sujet in sujets:
+            codes = encoder_sequence(sujet["sequence"])
+            debuts.append(position)
+            morceaux.extend([codes, np.full(k, 4, dtype=np.uint8)])
+            position += len(codes) + k
+        self.texte = np.concatenate(morceaux) if morceaux else np.zeros(0, dtype=np.uint8)
+        self.debuts = np.asarray(debuts, dtype=np.int64)
+        self.longueurs = np.asarray([len(s["sequence"]) for s in sujets], dtype=np.int64)
+        self.taille_base = int(self.longueurs.sum())
+
+        kmers, valides = codes_kmers(self.texte, k)
+        positions = np.flatnonzero(valides)
+        ordre = np.argsort(kmers[positions], kind="stable")
+        self.kmers = kmers[positions][ordre]
+        self.positions = positions[ordre]
+
+    def graines(self, requete: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Couples (position requête, position texte) des k-mers exacts partagés."""
+        kmers, valides = codes_kmers(requete, self.k)
+        q_pos = np.flatnonzero(valides)
+        gauche = np.searchsorted(self.kmers, kmers[q_pos], side="left")
+        droite = np.searchsorted(self.kmers, kmers[q_pos], side="right")
+        nombre = droite - gauche
+        q_graines = np.repeat(q_pos, nombre)
+        # Indices consécutifs gauche..droite-1 pour chaque k-mer de la requête
+        decalages = np.arange(nombre.sum()) - np.repeat(np.cumsum(nombre) - nombre, nombre)
+        return q_graines, self.positions[np.repeat(gauche, nombre) + decalages]
+
+    def etendre(self, requete: np.ndarray, diagonales: np.ndarray, taille_lot: int = 256) -> Dict[str, np.ndarray]:
+        """Meilleur segment sans gap (score 1/-2) de la requête sur chaque diagonale du texte."""
+        lq = len(requete)
+        resultats = {c: [] for c in ("score", "q_debut", "q_fin", "identites")}
+        q_index = np.arange(lq)
+        for debut in range(0, len(diagonales), taille_lot):
+            diag = diagonales[debut:debut + taille_lot]
+            t_index = diag[:, None] + q_index[None, :]
+            dans = (t_index >= 0) & (t_index < len(self.texte))
+            sujet = self.texte[np.clip(t_index, 0, max(len(self.texte) - 1, 0))]
+            egal = dans & (sujet == requete[None, :]) & (requete[None, :] < 4)
+            valide = dans & (sujet < 4) & (requete[None, :] < 4)
+            # Bases ambiguës et séparateurs coupent les segments
+            scores = np.where(egal, Config.RECHERCHE_MATCH, np.where(valide, Config.RECHERCHE_MISMATCH, -10 * lq))
+            cumul = np.concatenate([np.zeros((len(diag), 1)), np.cumsum(scores, axis=1)], axis=1)
+            minimum = np.minimum.accumulate(cumul, axis=1)
+            gain = cumul[:, 1:] - minimum[:, :-1]
+            fin = gain.argmax(axis=1)
+            # Début = dernière position du minimum courant avant la fin
+            est_min = cumul == minimum
+            dernier_min = np.maximum.accumulate(np.where(est_min, np.arange(lq + 1)[None, :], 0), axis=1)
+            q_debut = dernier_min[np.arange(len(diag)), fin]
+            cumul_egal = np.concatenate([np.zeros((len(diag), 1), dtype=np.int64), np.cumsum(egal, axis=1)], axis=1)
+            lignes = np.arange(len(diag))
+            resultats["score"].append(gain[lignes, fin])
+            resultats["q_debut"].append(q_debut)
+            resultats["q_fin"].append(fin + 1)
+            resultats["identites"].append(cumul_egal[lignes, fin + 1] - cumul_egal[lignes, q_debut])
+        return {c: np.concatenate(v) if v else np.zeros(0) for c, v in resultats.items()}
+
+    def rechercher(self, sequence: str, evalue_max: float = Config.RECHERCHE_EVALUE_MAX,
+                   max_resultats: int = 50, exclure: Optional[str] = None) -> pd.DataFrame:
+        """Recherche type blastn (deux brins) : graines k-mers, extension, e-value de Karlin-Altschul."""
+        colonnes = ["sujet", "description", "brin", "score", "bits", "evalue", "identite_pct", "longueur",
+                    "q_debut", "q_fin", "s_debut", "s_fin"]
+        requete = encoder_sequence(sequence)
+        if len(requete) < self.k or self.taille_base == 0:
+            return pd.DataFrame(columns=colonnes)
+        lam, k_karlin = Config.RECHERCHE_LAMBDA, Config.RECHERCHE_K_KARLIN
+        hits = []
+        for brin, codes in (("+", requete), ("-", complement_inverse(requete))):
+            q_pos, t_pos = self.graines(codes)
+            if len(q_pos) == 0:
+                continue
+            diagonales, nb_graines = np.unique(t_pos - q_pos, return_counts=True)
+            if len(diagonales) > Config.RECHERCHE_DIAGONALES_MAX:
+                diagonales = diagonales[np.argsort(nb_graines)[::-1][:Config.RECHERCHE_DIAGONALES_MAX]]
+            ext = self.etendre(codes, diagonales)
+            sujet = np.searchsorted(self.debuts, diagonales + ext["q_debut"], side="right") - 1
+            hits.append(pd.DataFrame({
+                "i_sujet": sujet, "brin": brin, "score": ext["score"],
+                "q_debut": ext["q_debut"], "q_fin": ext["q_fin"], "identites": ext["identites"],
+                "s_debut": diagonales + ext["q_debut"] - self.debuts[sujet],
+            }))
+        if not hits:
+            return pd.DataFrame(columns=colonnes)
+        df = pd.concat(hits, ignore_index=True)
+        df = df[df["score"] > 0]
+        df["longueur"] = df["q_fin"] - df["q_debut"]
+        df["s_fin"] = df["s_debut"] + df["longueur"]
+        df["bits"] = (lam * df["score"] - np.log(k_karlin)) / np.log(2)
+        df["evalue"] = k_karlin * len(requete) * self.taille_base * np.exp(-lam * df["score"])
+        df["identite_pct"] = 100 * df["identites"] / df["longueur"]
+        # Coordonnées de la requête rapportées au brin direct
+        inverse = df["brin"] == "-"
+        df.loc[inverse, ["q_debut", "q_fin"]] = np.c_[len(requete) - df.loc[inverse, "q_fin"],
+                                                      len(requete) - df.loc[inverse, "q_debut"]]
+        df["sujet"] = [self.sujets[i]["identifiant"] for i in df["i_sujet"]]
+        df["description"] = [self.sujets[i]["description"] for i in df["i_sujet"]]
+        if exclure is not None:
+            df = df[df["sujet"] != exclure]
+        df = df[df["evalue"] <= evalue_max].sort_values(["evalue", "score"], ascending=[True, False])
+        return df.drop_duplicates("sujet")[colonnes].head(max_resultats).reset_index(drop=True)
+
+def sujets_recherche(user_id) -> List[Dict]:
+    """Séquences interrogeables : celles des brebis de l'utilisateur et les références NCBI en cache local."""
+    sujets = []
+    for bid, numero, nom, entete, longueur, donnees, exceptions in db.fetchall("""
+        SELECT b.id, b.numero_id, b.nom, s.entete, s.longueur, s.donnees, s.exceptions
+        FROM sequences s
+        JOIN brebis b ON s.brebis_id = b.id
+        JOIN elevages e ON b.elevage_id = e.id
+        JOIN eleveurs el ON e.eleveur_id = el.id
+        WHERE el.user_id=?
+        ORDER BY b.id, s.rang
+    """, (user_id,)):
+        sujets.append({"identifiant": f"brebis:{bid}", "description": f"{numero} {nom or ''} {entete}".strip(),
+                       "sequence": decompacter_sequence(donnees, exceptions, longueur)})
+    for accession, description, sequence in db.fetchall(
+            "SELECT accession, description, sequence FROM sequences_reference"):
+        sujets.append({"identifiant": accession, "description": description, "sequence": sequence})
+    return sujets
+
+@st.cache_resource(max_entries=4)
+def index_sequences(user_id, version: str) -> IndexKmers:
+    """Index k-mers mis en cache tant que les séquences (brebis, références) ne changent pas."""
+    return IndexKmers(sujets_recherche(user_id))
+
+def ajouter_reference_ncbi(accession: str) -> Optional[str]:
+    """Télécharge une séquence de référence NCBI (via le cache HTTP) et la range dans `sequences_reference`."""
+    fasta = get_ncbi_api().fetch_fasta(accession)
+    enregistrements = parser_fasta(fasta or "")
+    if not enregistrements:
+        return None
+    entete, sequence = enregistrements[0]
+    db.execute("INSERT OR REPLACE INTO sequences_reference (accession, description, sequence, date_ajout) VALUES (?, ?, ?, ?)",
+               (accession, entete or accession, sequence.upper(), datetime.now().isoformat()))
+    return entete or accession
+
+def enregistrer_recherche(brebis_id: Optional[int], gene_cible: str, sequence: str, hits: pd.DataFrame):
+    """Archive une recherche et ses résultats dans `analyses_genomiques`."""
+    meilleur = hits.iloc[0] if not hits.empty else None
+    db.execute("""
+        INSERT INTO analyses_genomiques (brebis_id, date_analyse, gene_cible, sequence_query, blast_hits, identite_pct, e_value)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, (brebis_id, datetime.now().isoformat(), gene_cible, sequence, hits.to_json(orient="records"),
+          float(meilleur["identite_pct"]) if meilleur is not None else None,
+          float(meilleur["evalue"]) if meilleur is not None else None))
+
+# -----------------------------------------------------------------------------
+# PÉDIGRÉE ET CONSANGUINITÉ (MEUWISSEN-LUO, PRODUIT A·X DE COLLEAU)
+# -----------------------------------------------------------------------------
+def lire_agneaux(texte: Optional[str]) -> List[str]:
+    """Identifiants d'agneaux saisis à la mise bas (séparés par virgules, points-virgules ou espaces)."""
+    if not texte:
+        return []
+    morceaux = texte.replace(";", ",").replace("\n", ",").replace(" ", ",").split(",")
+    return list(dict.fromkeys(m.strip() for m in morceaux if m.strip()))
+
+def _mises_bas_pedigree(condition: str = "1=1", params: tuple = ()) -> List[Tuple]:
+    """Agneaux des mises bas avec la mère et le bélier de la saillie ~150 jours avant."""
+    jours_min = Config.PEDIGREE_GESTATION_JOURS - Config.PEDIGREE_TOLERANCE_JOURS
+    jours_max = Config.PEDIGREE_GESTATION_JOURS + Config.PEDIGREE_TOLERANCE_JOURS
+    lignes = db.fetchall(f"""
+        SELECT m.id, m.date_mise_bas, m.agneaux, b.numero_id,
+            (SELECT TRIM(s.male_id) FROM saillies s
+             WHERE s.brebis_id = m.brebis_id
+               AND TRIM(COALESCE(s.male_id, '')) <> ''
+               AND COALESCE(s.resultat, '') <> 'Non gestante'
+               AND julianday(m.date_mise_bas) - julianday(s.date_saillie) BETWEEN ? AND ?
+             ORDER BY s.resultat = 'Gestante' DESC, s.date_saillie DESC
+             LIMIT 1)
+        FROM mises_bas m
+        JOIN brebis b ON m.brebis_id = b.id
+        WHERE TRIM(COALESCE(m.agneaux, '')) <> '' AND {condition}
+    """, (jours_min, jours_max) + tuple(params))
+    return [(agneau, pere, mere, date_mb, mb_id)
+            for mb_id, date_mb, agneaux, mere, pere in lignes
+            for agneau in lire_agneaux(agneaux)]
+
+def _inserer_pedigree(conn: sqlite3.Connection, lignes: List[Tuple], source: str, ecraser: bool):
+    """Insère (animal, pere, mere, date_naissance, mise_bas_id) ; `ecraser` donne priorité aux nouvelles valeurs."""
+    if ecraser:
+        maj = "pere = COALESCE(excluded.pere, pere), mere = COALESCE(excluded.mere, mere)"
+    else:
+        maj = "pere = COALESCE(pere, excluded.pere), mere = COALESCE(mere, excluded.mere)"
+    conn.executemany(f"""
+        INSERT INTO pedigree (animal, pere, mere, date_naissance, mise_bas_id, source)
+        VALUES (?, ?, ?, ?, ?, '{source}')
+        ON CONFLICT (animal) DO UPDATE SET {maj},
+            date_naissance = COALESCE(date_naissance, excluded.date_naissance),
+            mise_bas_id = COALESCE(mise_bas_id, excluded.mise_bas_id)
+    """, lignes)
+    # Parents absents du pédigrée : ajoutés comme fondateurs
+    conn.execute("""
+        INSERT OR IGNORE INTO pedigree (animal, source)
+        SELECT pere, 'parent' FROM pedigree WHERE pere IS NOT NULL
+        UNION SELECT mere, 'parent' FROM pedigree WHERE mere IS NOT NULL
+    """)
+
+def enregistrer_mise_bas_pedigree(mise_bas_id: int) -> int:
+    """Ajoute au pédigrée les agneaux d'une mise bas."""
+    lignes = _mises_bas_pedigree("m.id = ?", (mise_bas_id,))
+    if lignes:
+        _inserer_pedigree(db.conn, lignes, "mise_bas", ecraser=False)
+        db.conn.commit()
+    return len(lignes)
+
+def construire_pedigree() -> Dict:
+    """Complète le pédigrée à partir des brebis, des mises bas et des saillies (les imports restent prioritaires)."""
+    brebis = [(numero, None, None, naissance, None) for numero, naissance in db.fetchall(
+        "SELECT numero_id, date_naissance FROM brebis WHERE TRIM(COALESCE(numero_id, '')) <> ''")]
+    agneaux = _mises_bas_pedigree()
+    _inserer_pedigree(db.conn, brebis, "brebis", ecraser=False)
+    _inserer_pedigree(db.conn, agneaux, "mise_bas", ecraser=False)
+    db.conn.commit()
+    sans_pere = sum(1 for a in agneaux if a[1] is None)
+    return {"brebis": len(brebis), "agneaux": len(agneaux), "agneaux_sans_pere": sans_pere}
+
+def importer_pedigree(df: pd.DataFrame) -> int:
+    """Importe un pédigrée (colonnes animal, pere, mere, date_naissance facultative) ; « 0 » ou vide = inconnu."""
+    df = df.rename(columns={c: c.strip().lower().replace("è", "e") for c in df.columns})
+    # Une seule colonne source par champ : la première présente dans l'ordre de préférence
+    alias = {"animal": ["animal", "numero_id", "id"], "pere": ["pere", "sire"], "mere": ["mere", "dam"]}
+    df = df.rename(columns={next(c for c in noms if c in df.columns): champ
+                            for champ, noms in alias.items() if any(c in df.columns for c in noms)})
+    df = df.loc[:, ~df.columns.duplicated()]
+    if not {"animal", "pere", "mere"} <= set(df.columns):
+        raise ValueError("Colonnes attendues : animal, pere, mere (date_naissance facultative)")
+
+    def nettoyer(serie: pd.Series) -> pd.Series:
+        serie = serie.astype("string").str.strip()
+        return serie.mask(serie.isin(["", "0", "NA", "nan"]))
+
+    df = df.assign(animal=nettoyer(df["animal"]), pere=nettoyer(df["pere"]), mere=nettoyer(df["mere"]))
+    df = df.dropna(subset=["animal"]).drop_duplicates("animal", keep="last")
+    if ((df["animal"] == df["pere"]) | (df["animal"] == df["mere"])).any():
+        raise ValueError("Un animal ne peut pas être son propre parent")
+    naissance = df["date_naissance"] if "date_naissance" in df.columns else pd.Series(None, index=df.index)
+    lignes = [(a, p if pd.notna(p) else None, m if pd.notna(m) else None,
+               str(n) if pd.notna(n) else None, None)
+              for a, p, m, n in zip(df["animal"], df["pere"], df["mere"], naissance)]
+    _inserer_pedigree(db.conn, lignes, "import", ecraser=True)
+    try:
+        matrice_pedigree(version_donnees("pedigree"))
+    except ValueError:
+        db.conn.rollback()
+        raise
+    db.conn.commit()
+    return len(lignes)
+
+@st.cache_resource(max_entries=2)
+def matrice_pedigree(version: str) -> Dict:
+    """Pédigrée codé et trié par génération (parents avant descendants), indices -1 = parent inconnu."""
+    df = pd.read_sql_query("SELECT animal, pere, mere FROM pedigree", db.conn)
+    codes = pd.Index(df["animal"])
+    pere = codes.get_indexer(df["pere"])
+    mere = codes.get_indexer(df["mere"])
+    n = len(codes)
+
+    generation = np.zeros(n, dtype=np.int64)
+    for _ in range(Config.PEDIGREE_PROFONDEUR_MAX + 1):
+        nouvelle = np.maximum(np.where(pere >= 0, generation[np.maximum(pere, 0)] + 1, 0),
+                              np.where(mere >= 0, generation[np.maximum(mere, 0)] + 1, 0))
+        if np.array_equal(nouvelle, generation):
+            break
+        generation = nouvelle
+    else:
+        raise ValueError("Pédigrée cyclique (un animal est son propre ancêtre) ou trop profond")
+
+    ordre = np.argsort(generation, kind="stable")
+    rang = np.empty(n, dtype=np.int64)
+    rang[ordre] = np.arange(n)
+    pere_ord = np.where(pere[ordre] >= 0, rang[pere[ordre]], -1)
+    mere_ord = np.where(mere[ordre] >= 0, rang[mere[ordre]], -1)
+    generation = generation[ordre]
+    bornes = np.searchsorted(generation, np.arange(generation.max() + 2 if n else 1))
+    generations = [np.arange(bornes[g], bornes[g + 1]) for g in range(len(bornes) - 1)]
+    return {
+        "animaux": codes[ordre],
+        "pere": pere_ord,
+        "mere": mere_ord,
+        "generations": generations,
+        "transmission": matrices_transmission(pere_ord, mere_ord, generations),
+    }
+
+def matrices_transmission(pere: np.ndarray, mere: np.ndarray, generations: List[np.ndarray]) -> List[sparse.csr_matrix]:
+    """Blocs P_g de la matrice de transmission (0,5 par parent connu), un par génération.
+
+    P_g a une ligne par animal de la génération g et une colonne par animal des générations
+    antérieures : les passes de Colleau et les lignes de T deviennent des produits creux.
+    """
+    blocs = []
+    for idx in generations:
+        lignes = np.concatenate([np.arange(len(idx))[pere[idx] >= 0], np.arange(len(idx))[mere[idx] >= 0]])
+        parents = np.concatenate([pere[idx][pere[idx] >= 0], mere[idx][mere[idx] >= 0]])
+        blocs.append(sparse.csr_matrix((np.full(len(lignes), 0.5), (lignes, parents)),
+                                       shape=(len(idx), idx[0] if len(idx) else 0)))
+    return blocs
+
+def consanguinite_meuwissen_luo(ped: Dict, F_connus: Optional[np.ndarray] = None) -> np.ndarray:
+    """Coefficients de consanguinité d'un pédigrée trié, F_i = Σ_k T_ik² D_k − 1 (Meuwissen et Luo, 1992).
+
+    Les lignes de T = (I − P)⁻¹ (contributions des ancêtres) sont construites génération par
+    génération, T_g = P_g·T + I, sous forme creuse : le coût suit le nombre total d'ancêtres et
+    non le nombre de pères multiplié par la taille du pédigrée. Seuls les animaux à NaN dans
+    `F_connus` et leurs ancêtres reçoivent une ligne, ce qui rend la mise à jour incrémentale.
+    """
+    pere, mere, generations = ped["pere"], ped["mere"], ped["generations"]
+    n = len(pere)
+    F = np.full(n, np.nan) if F_connus is None else np.array(F_connus, dtype=float)
+
+    besoin = np.isnan(F)
+    for idx in reversed(generations):
+        parents = np.concatenate([pere[idx[besoin[idx]]], mere[idx[besoin[idx]]]])
+        besoin[parents[parents >= 0]] = True
+
+    T = sparse.csr_matrix((0, n))
+    for idx, P in zip(generations, ped["transmission"]):
+        n_avant, fin = idx[0], idx[-1] + 1
+        utiles = sparse.diags(besoin[idx].astype(float))
+        Tg = sparse.hstack([utiles @ P @ T[:, :n_avant], utiles, sparse.csr_matrix((len(idx), n - fin))],
+                           format="csr")
+        cibles = np.isnan(F[idx])
+        if cibles.any():
+            # Les parents appartiennent aux générations antérieures, dont F est déjà connu
+            Fp = np.where(pere[:fin] >= 0, F[np.maximum(pere[:fin], 0)], -1.0)
+            Fm = np.where(mere[:fin] >= 0, F[np.maximum(mere[:fin], 0)], -1.0)
+            D = 0.5 - 0.25 * (Fp + Fm)
+            F[idx[cibles]] = (Tg[:, :fin].power(2) @ D - 1.0)[cibles]
+        T = sparse.vstack([T, Tg], format="csr")
+    return F
+
+def maj_consanguinite(forcer: bool = False) -> Dict:
+    """Calcule F pour les animaux nouveaux ou dont un ancêtre a changé, et enregistre les résultats."""
+    debut_calcul = time.perf_counter()
+    ped = matrice_pedigree(version_donnees("pedigree"))
+    pere, mere = ped["pere"], ped["mere"]
+    connus = pd.Series(dict(db.fetchall("SELECT animal, F FROM consanguinite")), dtype=float)
+    F = np.full(len(pere), np.nan) if forcer else np.array(connus.reindex(ped["animaux"]), dtype=float)
+
+    # Un F manquant rend obsolètes ceux de tous les descendants
+    a_calculer = np.isnan(F)
+    for idx in ped["generations"][1:]:
+        p, m = pere[idx], mere[idx]
+        a_calculer[idx] |= ((p >= 0) & a_calculer[np.maximum(p, 0)]) | ((m >= 0) & a_calculer[np.maximum(m, 0)])
+    F[a_calculer] = np.nan
+
+    F = consanguinite_meuwissen_luo(ped, F)
+    maintenant = datetime.now().isoformat()
+    db.conn.executemany(
+        "INSERT OR REPLACE INTO consanguinite (animal, F, date_calcul) VALUES (?, ?, ?)",
+        [(a, float(f), maintenant) for a, f in zip(ped["animaux"][a_calculer], F[a_calculer])]
+    )
+    duree = time.perf_counter() - debut_calcul
+    details = {"animaux": len(F), "calcules": int(a_calculer.sum()), "duree_s": duree}
+    db.conn.execute("""
+        INSERT OR REPLACE INTO executions_taches (tache, derniere_execution, details)
+        VALUES ('consanguinite', ?, ?)
+    """, (maintenant, json.dumps(details)))
+    db.conn.commit()
+    return details
+
+def coefficients_consanguinite(ped: Dict) -> np.ndarray:
+    """F dans l'ordre du pédigrée trié (0 pour les animaux pas encore calculés)."""
+    F = pd.Series(dict(db.fetchall("SELECT animal, F FROM consanguinite")), dtype=float)
+    return F.reindex(ped["animaux"]).fillna(0.0).to_numpy()
+
+def produit_parente(ped: Dict, F: np.ndarray, X: np.ndarray) -> np.ndarray:
+    """A·X sans former A (Colleau, 2002) : A = T D Tᵀ avec T = (I − P)⁻¹.
+
+    Tᵀ·X remonte des descendants vers les parents, T·(D·Y) descend des parents vers les
+    descendants ; chaque passe traite une génération entière par un produit creux P_g.
+    """
+    pere, mere = ped["pere"], ped["mere"]
+    Fp = np.where(pere >= 0, F[np.maximum(pere, 0)], -1.0)
+    Fm = np.where(mere >= 0, F[np.maximum(mere, 0)], -1.0)
+    D = 0.5 - 0.25 * (Fp + Fm)
+    X = np.asarray(X, dtype=np.float64)
+    vecteur = X.ndim == 1
+    Y = X.reshape(len(pere), -1).copy()
+
+    etapes = [(idx, P) for idx, P in zip(ped["generations"], ped["transmission"]) if len(idx) and idx[0]]
+    for idx, P in reversed(etapes):
+        Y[:idx[0]] += P.T @ Y[idx]
+    Y *= D[:, None]
+    for idx, P in etapes:
+        Y[idx] += P @ Y[:idx[0]]
+    return Y[:, 0] if vecteur else Y
+
+def parente_entre(ped: Dict, F: np.ndarray, lignes: List[str], colonnes: List[str]) -> pd.DataFrame:
+    """Sous-matrice de parenté additive A[lignes, colonnes] par un produit A·E (une colonne par animal demandé)."""
+    index = pd.Index(ped["animaux"])
+    i, j = index.get_indexer(lignes), index.get_indexer(colonnes)
+    if (i < 0).any() or (j < 0).any():
+        raise KeyError("Animal absent du pédigrée")
+    E = np.zeros((len(index), len(j)))
+    E[j, np.arange(len(j))] = 1.0
+    return pd.DataFrame(produit_parente(ped, F, E)[i], index=lignes, columns=colonnes)
+
+# -----------------------------------------------------------------------------
+# ÉVALUATION GÉNÉTIQUE (BLUP MODÈLE ANIMAL)
+# -----------------------------------------------------------------------------
+def performances_lait() -> pd.DataFrame:
+    """Une performance par brebis et par campagne : production journalière moyenne, élevage-année, classe d'âge."""
+    df = pd.read_sql_query("""
+        SELECT p.brebis_id, b.numero_id AS animal, b.elevage_id, b.date_naissance,
+               strftime('%Y', p.date) AS annee, AVG(p.quantite) AS lait, COUNT(*) AS n_controles
+        FROM productions p
+        JOIN brebis b ON p.brebis_id = b.id
+        WHERE p.quantite IS NOT NULL AND b.numero_id IS NOT NULL
+        GROUP BY p.brebis_id, annee
+        HAVING COUNT(*) >= ?
+    """, db.conn, params=(Config.BLUP_MIN_CONTROLES,))
+    age = pd.to_numeric(df["annee"]) - pd.to_datetime(df["date_naissance"], errors="coerce").dt.year
+    df["classe_age"] = age.clip(1, 5).astype("Int64").astype(str).replace("<NA>", "inconnue")
+    df["elevage_annee"] = df["elevage_id"].astype(str) + "-" + df["annee"]
+    return df
+
+def inverse_parente(pere: np.ndarray, mere: np.ndarray, F: np.ndarray) -> sparse.csr_matrix:
+    """A⁻¹ par les règles de Henderson (consanguinité des parents comprise), assemblée directement en creux."""
+    n = len(pere)
+    Fp = np.where(pere >= 0, F[np.maximum(pere, 0)], -1.0)
+    Fm = np.where(mere >= 0, F[np.maximum(mere, 0)], -1.0)
+    b = 1.0 / (0.5 - 0.25 * (Fp + Fm))
+    membres = [(np.arange(n), np.ones(n, dtype=bool), 1.0), (pere, pere >= 0, -0.5), (mere, mere >= 0, -0.5)]
+    lignes, colonnes, valeurs = [], [], []
+    for i, connu_i, poids_i in membres:
+        for j, connu_j, poids_j in membres:
+            garde = connu_i & connu_j
+            lignes.append(i[garde])
+            colonnes.append(j[garde])
+            valeurs.append(b[garde] * poids_i * poids_j)
+    # Les doublons (un parent commun à plusieurs descendants) sont additionnés à la conversion
+    return sparse.csr_matrix((np.concatenate(valeurs), (np.concatenate(lignes), np.concatenate(colonnes))), shape=(n, n))
+
+def _indicatrices(codes: np.ndarray, n_niveaux: int) -> sparse.csr_matrix:
+    return sparse.csr_matrix((np.ones(len(codes)), (np.arange(len(codes)), codes)), shape=(len(codes), n_niveaux))
+
+def gradient_conjugue_jacobi(C: sparse.csr_matrix, rhs: np.ndarray, x0: Optional[np.ndarray] = None,
+                             tolerance: float = Config.BLUP_TOLERANCE,
+                             iterations_max: int = Config.BLUP_ITERATIONS_MAX) -> Tuple[np.ndarray, int]:
+    """Résout C x = rhs (C symétrique définie positive) par gradient conjugué préconditionné par la diagonale."""
+    diagonale = C.diagonal()
+    inv_diag = np.where(diagonale > 0, 1.0 / np.where(diagonale > 0, diagonale, 1.0), 1.0)
+    x = np.zeros_like(rhs) if x0 is None else x0.astype(float).copy()
+    r = rhs - C @ x
+    z = inv_diag * r
+    p = z.copy()
+    rz = r @ z
+    norme_rhs = np.linalg.norm(rhs) or 1.0
+    for iteration in range(1, iterations_max + 1):
+        if np.linalg.norm(r) <= tolerance * norme_rhs:
+            return x, iteration - 1
+        Cp = C @ p
+        pas = rz / (p @ Cp)
+        x += pas * p
+        r -= pas * Cp
+        z = inv_diag * r
+        rz_nouveau = r @ z
+        p = z + (rz_nouveau / rz) * p
+        rz = rz_nouveau
+    return x, iterations_max
+
+def blup_modele_animal(perf: pd.DataFrame, ped: Dict, F: np.ndarray,
+                       heritabilite: float = Config.BLUP_HERITABILITE_LAIT,
+                       repetabilite: float = Config.BLUP_REPETABILITE_LAIT) -> Dict:
+    """BLUP modèle animal à performances répétées : y = élevage-année + classe d'âge + animal + env. permanent + e.
+
+    Les équations du modèle mixte sont assemblées en creux avec A⁻¹ de Henderson et résolues par
+    gradient conjugué ; les variances sont exprimées en proportions de la variance phénotypique.
+    """
+    animaux = pd.Index(ped["animaux"])
+    absentes = pd.Index(perf["animal"].unique()).difference(animaux)
+    animaux = animaux.append(absentes)
+    pere = np.concatenate([ped["pere"], np.full(len(absentes), -1)])
+    mere = np.concatenate([ped["mere"], np.full(len(absentes), -1)])
+    F = np.concatenate([F, np.zeros(len(absentes))])
+
+    code_ea, niveaux_ea = pd.factorize(perf["elevage_annee"])
+    code_age, niveaux_age = pd.factorize(perf["classe_age"], sort=True)
+    code_animal = animaux.get_indexer(perf["animal"])
+    code_ep, niveaux_ep = pd.factorize(perf["animal"])
+    # Première classe d'âge absorbée par les élevages-années (rang plein)
+    X = sparse.hstack([_indicatrices(code_ea, len(niveaux_ea)),
+                       _indicatrices(code_age, len(niveaux_age))[:, 1:]])
+    M = sparse.hstack([X, _indicatrices(code_animal, len(animaux)),
+                       _indicatrices(code_ep, len(niveaux_ep))]).tocsr()
+
+    alpha_a = (1 - repetabilite) / heritabilite
+    alpha_ep = (1 - repetabilite) / (repetabilite - heritabilite)
+    n_fixes = X.shape[1]
+    penalites = sparse.block_diag([sparse.csr_matrix((n_fixes, n_fixes)),
+                                   alpha_a * inverse_parente(pere, mere, F),
+                                   alpha_ep * sparse.identity(len(niveaux_ep))], format="csr")
+    C = (M.T @ M + penalites).tocsr()
+    y = perf["lait"].to_numpy(dtype=float)
+    solution, iterations = gradient_conjugue_jacobi(C, M.T @ y)
+
+    ebv = solution[n_fixes:n_fixes + len(animaux)]
+    nb_perf = np.bincount(code_animal, minlength=len(animaux))
+    return {
+        "animaux": animaux,
+        "ebv": ebv,
+        "nb_performances": nb_perf,
+        "iterations": iterations,
+        "equations": C.shape[0],
+        "residu": float(np.linalg.norm(M.T @ y - C @ solution) / (np.linalg.norm(M.T @ y) or 1.0)),
+    }
+
+def enregistrer_valeurs_genetiques(animaux, valeurs: np.ndarray, caractere: str, methode: str,
+                                   nb_performances: Optional[np.ndarray] = None, precision: Optional[np.ndarray] = None):
+    """Remplace les valeurs génétiques (caractère, méthode) ; les brebis du troupeau sont reliées par numero_id."""
+    brebis_ids = pd.Series(dict(db.fetchall("SELECT numero_id, id FROM brebis WHERE numero_id IS NOT NULL")))
+    ids = brebis_ids.reindex(animaux).to_numpy()
+    n = len(valeurs)
+    nb_perf = np.zeros(n, dtype=int) if nb_performances is None else nb_performances
+    prec = np.full(n, np.nan) if precision is None else precision
+    maintenant = datetime.now().isoformat()
+    db.conn.execute("DELETE FROM valeurs_genetiques WHERE caractere=? AND methode=?", (caractere, methode))
+    db.conn.executemany("""
+        INSERT INTO valeurs_genetiques (animal, brebis_id, caractere, methode, valeur, precision, nb_performances, date_calcul)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, [(a, int(b) if pd.notna(b) else None, caractere, methode, float(v),
+           float(p) if np.isfinite(p) else None, int(k), maintenant)
+          for a, b, v, p, k in zip(animaux, ids, valeurs, prec, nb_perf)])
+    db.conn.commit()
+
+def calculer_blup_lait(forcer: bool = False) -> Optional[Dict]:
+    """Évaluation BLUP du lait, relancée seulement si les productions, les brebis ou le pédigrée ont changé."""
+    version = version_donnees("productions", "brebis", "pedigree")
+    derniere = db.fetchone("SELECT details FROM executions_taches WHERE tache='blup_lait'")
+    if not forcer and derniere and json.loads(derniere[0]).get("version") == version:
+        return json.loads(derniere[0])
+
+    debut_calcul = time.perf_counter()
+    perf = performances_lait()
+    if perf.empty:
+        return None
+    maj_consanguinite()
+    ped = matrice_pedigree(version_donnees("pedigree"))
+    res = blup_modele_animal(perf, ped, coefficients_consanguinite(ped))
+    enregistrer_valeurs_genetiques(res["animaux"], res["ebv"], "lait", "BLUP", nb_performances=res["nb_performances"])
+    details = {"version": version, "animaux": len(res["animaux"]), "performances": len(perf),
+               "equations": res["equations"], "iterations": res["iterations"], "residu": res["residu"],
+               "duree_s": time.perf_counter() - debut_calcul}
+    db.conn.execute("""
+        INSERT OR REPLACE INTO executions_taches (tache, derniere_execution, details)
+        VALUES ('blup_lait', ?, ?)
+    """, (datetime.now().isoformat(), json.dumps(details)))
+    db.conn.commit()
+    return details
+
+# -----------------------------------------------------------------------------
+# PRÉDICTION GÉNOMIQUE (GBLUP / RIDGE SUR LES SNPS)
+# -----------------------------------------------------------------------------
+def phenotypes_corriges_lait() -> pd.DataFrame:
+    """Performance moyenne de chaque brebis corrigée des effets élevage-année et classe d'âge (moindres carrés)."""
+    perf = performances_lait()
+    if perf.empty:
+        return pd.DataFrame(columns=["brebis_id", "animal", "lait_corrige", "n_performances"])
+    code_ea, niveaux_ea = pd.factorize(perf["elevage_annee"])
+    code_age, niveaux_age = pd.factorize(perf["classe_age"], sort=True)
+    X = sparse.hstack([_indicatrices(code_ea, len(niveaux_ea)),
+                       _indicatrices(code_age, len(niveaux_age))[:, 1:]]).tocsr()
+    y = perf["lait"].to_numpy(dtype=float)
+    perf["lait_corrige"] = y - X @ sparse.linalg.lsqr(X, y)[0]
+    return perf.groupby(["brebis_id", "animal"], as_index=False).agg(
+        lait_corrige=("lait_corrige", "mean"), n_performances=("lait", "size"))
+
+def _pli_gblup(K, entrainement: np.ndarray, test: np.ndarray, y: np.ndarray, deltas: np.ndarray) -> np.ndarray:
+    """Forme noyau : prédictions de `test` pour chaque δ = σ²e/σ²g, avec une seule décomposition propre de K_entraînement.
+
+    μ est estimé en GLS ; ĝ_test = K[test, entraînement]·(K_ee + δI)⁻¹(y − μ).
+    """
+    valeurs, vecteurs = np.linalg.eigh(np.asarray(K[np.ix_(entrainement, entrainement)], dtype=np.float64))
+    valeurs = np.clip(valeurs, 0, None)
+    y_rot = vecteurs.T @ y
+    un_rot = vecteurs.T @ np.ones(len(y))
+    K_test = np.asarray(K[np.ix_(test, entrainement)])
+    predictions = []
+    for delta in deltas:
+        w = 1 / (valeurs + delta)
+        mu = (w * un_rot * y_rot).sum() / (w * un_rot * un_rot).sum()
+        alpha = vecteurs @ (w * (y_rot - mu * un_rot))
+        predictions.append(K_test @ alpha.astype(K_test.dtype))
+    return np.column_stack(predictions).astype(float)
+
+def _pli_ridge(Z: np.ndarray, entrainement: np.ndarray, test: np.ndarray, y: np.ndarray,
+               lambdas: np.ndarray) -> np.ndarray:
+    """Forme primale (SNPs < individus) : ridge à intercept non pénalisé, une décomposition propre de ZᵀZ par pli."""
+    Z_e = np.asarray(Z[entrainement], dtype=np.float64)
+    Z_e -= Z_e.mean(axis=0)
+    valeurs, vecteurs = np.linalg.eigh(Z_e.T @ Z_e)
+    valeurs = np.clip(valeurs, 0, None)
+    projete = vecteurs.T @ (Z_e.T @ (y - y.mean()))
+    Z_test = np.asarray(Z[test], dtype=np.float64)
+    return np.column_stack([Z_test @ (vecteurs @ (projete / (valeurs + lam))) for lam in lambdas])
+
+def prediction_genomique(stock: GenotypeStore, pheno: pd.DataFrame, trait: str,
+                         grille_h2=Config.GBLUP_H2_GRILLE, n_plis: int = Config.GBLUP_PLIS,
+                         n_jobs: int = -1, graine: int = 42) -> Dict:
+    """Valeurs génomiques de toutes les brebis génotypées (GBLUP ≡ ridge sur les SNPs centrés de VanRaden).
+
+    Forme noyau (GRM en cache, n × n) quand les SNPs sont plus nombreux que les individus, forme
+    primale (ZᵀZ, m × m) sinon ; les deux donnent le même prédicteur avec λ = δ·2Σp(1-p).
+    L'héritabilité est choisie sur une grille par validation croisée k-fold, les plis étant
+    répartis sur un pool de processus (la GRM voyage sous forme de memmap).
+    """
+    lignes = np.flatnonzero(stock.echantillons["brebis_id"].notna().to_numpy())
+    lignes_pheno, y = stock.aligner_phenotypes(pheno, trait)
+    position = pd.Series(np.arange(len(lignes)), index=lignes)
+    pheno_pos = position.reindex(lignes_pheno).to_numpy()
+    garde = ~np.isnan(pheno_pos)
+    pheno_pos, y = pheno_pos[garde].astype(int), y[garde]
+    if len(y) < max(n_plis, 10):
+        raise ValueError(f"Trop peu de brebis génotypées et phénotypées ({len(y)})")
+
+    grille_h2 = np.asarray(grille_h2, dtype=float)
+    deltas = (1 - grille_h2) / grille_h2
+    forme_noyau = stock.m >= len(lignes)
+    if forme_noyau:
+        source, meta = grm_vanraden(stock, lignes)
+        denominateur, m_utilises = meta["denominateur"], meta["m"]
+        pli, parametres = _pli_gblup, deltas
+    else:
+        blocs = [centrer_bloc_vanraden(G) for _, G in stock.iter_blocs(lignes=lignes, dtype=np.float32)]
+        source = np.hstack([Z for Z, _ in blocs])
+        denominateur, m_utilises = sum(d for _, d in blocs), source.shape[1]
+        pli, parametres = _pli_ridge, deltas * denominateur
+
+    plis = list(KFold(n_splits=n_plis, shuffle=True, random_state=graine).split(y))
+    resultats = joblib.Parallel(n_jobs=n_jobs)(
+        joblib.delayed(pli)(source, pheno_pos[e], pheno_pos[t], y[e], parametres) for e, t in plis
+    )
+    correlations = np.array([[np.corrcoef(pred[:, k], y[t])[0, 1] for k in range(len(grille_h2))]
+                             for pred, (_, t) in zip(resultats, plis)])
+    validation = pd.DataFrame({"h2": grille_h2, "correlation": np.nanmean(correlations, axis=0),
+                               "ecart_type": np.nanstd(correlations, axis=0)})
+    meilleur = int(np.nanargmax(validation["correlation"].to_numpy()))
+
+    gebv = pli(source, pheno_pos, np.arange(len(lignes)), y, parametres[meilleur:meilleur + 1])[:, 0]
+    return {
+        "lignes": lignes,
+        "gebv": gebv,
+        "h2": float(grille_h2[meilleur]),
+        "validation": validation,
+        "forme": "noyau" if forme_noyau else "primale",
+        "n_phenotypes": len(y),
+        "m": int(m_utilises),
+    }
+
+def calculer_gblup_lait(forcer: bool = False, n_jobs: int = -1) -> Optional[Dict]:
+    """GBLUP du lait sur le stock du troupeau, relancé seulement si génotypes, productions ou brebis ont changé."""
+    version = version_donnees("genotypes", "productions", "brebis")
+    derniere = db.fetchone("SELECT details FROM executions_taches WHERE tache='gblup_lait'")
+    if not forcer and derniere and json.loads(derniere[0]).get("version") == version:
+        return json.loads(derniere[0])
+
+    debut_calcul = time.perf_counter()
+    stock = construire_stock_troupeau()
+    pheno = phenotypes_corriges_lait()
+    if stock is None or pheno.empty:
+        return None
+    res = prediction_genomique(stock, pheno, "lait_corrige", n_jobs=n_jobs)
+    echantillons = stock.echantillons.iloc[res["lignes"]]
+    nb_perf = pheno.set_index("brebis_id")["n_performances"].reindex(echantillons["brebis_id"]).fillna(0).to_numpy(dtype=int)
+    enregistrer_valeurs_genetiques(echantillons["identifiant"].astype(str).to_numpy(), res["gebv"], "lait", "GBLUP",
+                                   nb_performances=nb_perf)
+    details = {"version": version, "animaux": len(res["lignes"]), "phenotypes": res["n_phenotypes"],
+               "snps": res["m"], "forme": res["forme"], "h2": res["h2"],
+               "validation": res["validation"].round(4).to_dict(orient="records"),
+               "duree_s": time.perf_counter() - debut_calcul}
+    db.conn.execute("""
+        INSERT OR REPLACE INTO executions_taches (tache, derniere_execution, details)
+        VALUES ('gblup_lait', ?, ?)
+    """, (datetime.now().isoformat(), json.dumps(details)))
+    db.conn.commit()
+    return details
+
+# -----------------------------------------------------------------------------
+# COMPOSITION RACIALE (ADMIXTURE SUPERVISÉE PAR PANELS DE RÉFÉRENCE)
+# -----------------------------------------------------------------------------
+def _qp_simplexe(M: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Minimise qᵀM q − 2bᵀq sur le simplexe, pour chaque animal (M : n × K × K, b : n × K).
+
+    Le problème est convexe et K est petit : l'optimum est la solution du système KKT
+    (contrainte Σq = 1 seule) sur l'un des 2^K − 1 supports possibles. Tous les supports sont
+    résolus en lot et le meilleur support réalisable est retenu, ce qui donne la solution exacte.
+    """
+    n, K = b.shape
+    meilleur = np.full(n, np.inf)
+    Q = np.full((n, K), 1.0 / K)
+    echelle = np.trace(M, axis1=1, axis2=2)[:, None, None] / K
+    for taille in range(1, K + 1):
+        for support in combinations(range(K), taille):
+            S = list(support)
+            A = M[:, S][:, :, S] + (1e-10 * echelle + 1e-300) * np.eye(taille)
+            second = np.stack([b[:, S], np.ones((n, taille))], axis=2)
+            u, v = np.moveaxis(np.linalg.solve(A, second), 2, 0)
+            nu = (1 - u.sum(axis=1)) / v.sum(axis=1)
+            q = u + nu[:, None] * v
+            realisable = (q >= -1e-10).all(axis=1)
+            q = np.clip(q, 0, None)
+            q /= q.sum(axis=1, keepdims=True)
+            objectif = np.einsum("ni,nij,nj->n", q, M[:, S][:, :, S], q) - 2 * (b[:, S] * q).sum(axis=1)
+            mieux = realisable & (objectif < meilleur)
+            meilleur[mieux] = objectif[mieux]
+            Q[mieux] = 0
+            Q[np.ix_(mieux, S)] = q[mieux]
+    return Q
+
+def estimer_composition_raciale(stock: GenotypeStore, races_reference: np.ndarray, races: List[str],
+                                snps: Optional[np.ndarray] = None, purete_min: float = Config.ADMIXTURE_PURETE_MIN,
+                                iterations_max: int = Config.ADMIXTURE_ITERATIONS_MAX,
+                                taille_lot: int = 10000) -> Dict:
+    """Proportions raciales de chaque individu du stock (modèle d'admixture x ≈ Q·Pᵀ).
+
+    `races_reference` donne, par ligne du stock, l'indice de la race déclarée (-1 si non utilisable
+    comme référence). Chaque passe en flux sur les SNPs estime les fréquences alléliques P des races
+    sur les références, puis accumule pour tous les animaux M = Σ oⱼ pⱼpⱼᵀ et b = Σ oⱼ xⱼ pⱼ sur les
+    SNPs observés (deux produits matriciels par bloc) ; Q est ensuite résolu exactement sur le
+    simplexe par lots d'animaux. Les références dont la part de leur race déclarée reste sous
+    `purete_min` sont retirées du panel et la passe est refaite, jusqu'à stabilité.
+    """
+    races_reference = np.asarray(races_reference)
+    K = len(races)
+    references = races_reference >= 0
+    historique = []
+    for iteration in range(1, iterations_max + 1):
+        H = np.zeros((stock.n, K))
+        H[np.flatnonzero(references), races_reference[references]] = 1
+        M = np.zeros((stock.n, K * K))
+        b = np.zeros((stock.n, K))
+        m_utilises = 0
+        for _, G in stock.iter_blocs(dtype=np.float32, snps=snps):
+            observe = ~np.isnan(G)
+            X = np.where(observe, G, 0).astype(np.float64) / 2
+            O = observe.astype(np.float64)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                P = (H.T @ X) / (H.T @ O)
+                moyenne = X.sum(axis=0) / O.sum(axis=0)
+            P = np.where(np.isnan(P), moyenne, P).T
+            informatif = np.isfinite(P).all(axis=1) & (np.ptp(P, axis=1) > 0)
+            if not informatif.any():
+                continue
+            P, X, O = P[informatif], X[:, informatif], O[:, informatif]
+            M += O @ (P[:, :, None] * P[:, None, :]).reshape(-1, K * K)
+            b += X @ P
+            m_utilises += int(informatif.sum())
+        if m_utilises == 0:
+            raise ValueError("Aucun SNP ne distingue les races de référence")
+        M = M.reshape(-1, K, K)
+        Q = np.vstack([_qp_simplexe(M[i:i + taille_lot], b[i:i + taille_lot])
+                       for i in range(0, stock.n, taille_lot)])
+
+        purs = references & (Q[np.arange(stock.n), np.maximum(races_reference, 0)] >= purete_min)
+        historique.append({"iteration": iteration, "references": int(references.sum()), "retirees": int((references & ~purs).sum())})
+        # Chaque race garde au moins ses références les plus pures
+        for k in range(K):
+            if references[races_reference == k].any() and not purs[races_reference == k].any():
+                purs |= references & (races_reference == k)
+        if (purs == references).all():
+            break
+        references = purs
+    return {"Q": Q, "references": references, "m": m_utilises, "iterations": historique}
+
+def calculer_composition_raciale(forcer: bool = False) -> Optional[Dict]:
+    """Composition raciale de toutes les brebis génotypées ; les races déclarées servent de panels de référence."""
+    version = version_donnees("genotypes", "brebis")
+    derniere = db.fetchone("SELECT details FROM executions_taches WHERE tache='composition_raciale'")
+    if not forcer and derniere and json.loads(derniere[0]).get("version") == version:
+        return json.loads(derniere[0])
+
+    debut_calcul = time.perf_counter()
+    stock = construire_stock_troupeau()
+    if stock is None:
+        return None
+    races_declarees = pd.Series(dict(db.fetchall("SELECT id, race FROM brebis")))
+    declarees = races_declarees.reindex(stock.echantillons["brebis_id"]).to_numpy()
+    races = [r for r in Config.RACES if r != "Autre" and (declarees == r).sum() >= Config.ADMIXTURE_MIN_REFERENCES]
+    if len(races) < 2:
+        raise ValueError(f"Il faut au moins deux races avec {Config.ADMIXTURE_MIN_REFERENCES} brebis génotypées de référence")
+    indices = pd.Series(np.arange(len(races)), index=races)
+    res = estimer_composition_raciale(stock, indices.reindex(declarees).fillna(-1).astype(int).to_numpy(), races)
+
+    maintenant = datetime.now().isoformat()
+    echantillons = stock.echantillons
+    lignes = []
+    for k, race in enumerate(races):
+        lignes += [(int(bid), race, float(q), int(ref and declaree == race), maintenant)
+                   for bid, q, ref, declaree in zip(echantillons["brebis_id"], res["Q"][:, k], res["references"], declarees)]
+    db.conn.execute("DELETE FROM composition_raciale")
+    db.conn.executemany("""
+        INSERT INTO composition_raciale (brebis_id, race, proportion, reference, date_calcul)
+        VALUES (?, ?, ?, ?, ?)
+    """, lignes)
+    details = {"version": version, "animaux": int(stock.n), "races": races, "snps": res["m"],
+               "references": int(res["references"].sum()), "iterations": res["iterations"],
+               "duree_s": time.perf_counter() - debut_calcul}
+    db.conn.execute("""
+        INSERT OR REPLACE INTO executions_taches (tache, derniere_execution, details)
+        VALUES ('composition_raciale', ?, ?)
+    """, (maintenant, json.dumps(details)))
+    db.conn.commit()
+    return details
+
+# -----------------------------------------------------------------------------
+# VÉRIFICATION DE PARENTÉ (HOMOZYGOTES OPPOSÉS SUR SNPS)
+# -----------------------------------------------------------------------------
+def panel_parente(stock: GenotypeStore, nb_snps: int = Config.PARENTE_NB_SNPS, lignes=None) -> np.ndarray:
+    """Indices des SNPs les plus informatifs pour l'exclusion (MAF × taux d'appel les plus élevés)."""
+    scores = []
+    for _, G in stock.iter_blocs(lignes=lignes, dtype=np.int8):
+        observe = G >= 0
+        appels = observe.sum(axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            p = np.where(observe, G, 0).sum(axis=0) / (2 * appels)
+        scores.append(np.nan_to_num(np.minimum(p, 1 - p)) * appels / G.shape[0])
+    scores = np.concatenate(scores)
+    retenus = np.flatnonzero(scores > 0)
+    return np.sort(retenus[np.argsort(-scores[retenus], kind="stable")[:nb_snps]])
+
+if hasattr(np, "bitwise_count"):
+    compter_bits = np.bitwise_count
+else:
+    # NumPy < 2 : popcount par table des 256 octets
+    _BITS_OCTET = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+    def compter_bits(mots: np.ndarray) -> np.ndarray:
+        """Nombre de bits à 1 de chaque mot de 64 bits."""
+        mots = np.ascontiguousarray(mots, dtype=np.uint64)
+        return _BITS_OCTET[mots.view(np.uint8)].reshape(*mots.shape, 8).sum(axis=-1, dtype=np.uint8)
+
+def _naissances(identifiants) -> pd.Series:
+    """Dates de naissance connues (pédigrée, sinon fiche brebis) des identifiants donnés."""
+    dates = dict(db.fetchall("SELECT numero_id, date_naissance FROM brebis WHERE numero_id IS NOT NULL"))
+    dates.update({a: d for a, d in db.fetchall("SELECT animal, date_naissance FROM pedigree WHERE date_naissance IS NOT NULL")})
+    return pd.to_datetime(pd.Series(dates, dtype=object).reindex(list(identifiants)), errors="coerce")
+
+def _candidats_impossibles(agneaux: pd.Series, beliers: List[str]) -> np.ndarray:
+    """Paires (agneau, bélier) à écarter : bélier descendant de l'agneau ou né après lui.
+
+    L'exclusion par homozygotes opposés est symétrique entre parent et descendant :
+    sans ce filtre, un fils génotypé de l'agneau serait proposé comme son père.
+    """
+    naissance_agneau = _naissances(agneaux).to_numpy()
+    naissance_belier = _naissances(beliers).to_numpy()
+    impossibles = naissance_belier[None, :] >= naissance_agneau[:, None]
+    try:
+        ped = matrice_pedigree(version_donnees("pedigree"))
+    except ValueError:
+        return impossibles
+    rang_agneau = ped["animaux"].get_indexer(agneaux)
+    for k, b in enumerate(ped["animaux"].get_indexer(beliers)):
+        if b < 0:
+            continue
+        ancetres, front = set(), np.array([b])
+        for _ in range(Config.PEDIGREE_PROFONDEUR_MAX):
+            front = np.concatenate([ped["pere"][front], ped["mere"][front]])
+            front = np.setdiff1d(front[front >= 0], list(ancetres))
+            if front.size == 0:
+                break
+            ancetres.update(front.tolist())
+        impossibles[:, k] |= np.isin(rang_agneau, list(ancetres)) & (rang_agneau >= 0)
+    return impossibles
+
+def masques_homozygotes(stock: GenotypeStore, lignes: np.ndarray, snps: Optional[np.ndarray] = None) -> Dict[str, np.ndarray]:
+    """Vecteurs de bits par individu (lignes × mots de 64 SNPs) : homozygotes 0, homozygotes 2, SNPs appelés."""
+    taille_bloc = max(64, taille_bloc_auto(len(lignes)) // 64 * 64)
+    morceaux = {"hom0": [], "hom2": [], "observe": []}
+    for _, G in stock.iter_blocs(taille_bloc, lignes=lignes, dtype=np.int8, snps=snps):
+        for cle, masque in (("hom0", G == 0), ("hom2", G == 2), ("observe", G >= 0)):
+            octets = np.packbits(masque, axis=1)
+            # Blocs multiples de 64 SNPs : seul le dernier est complété jusqu'au mot suivant
+            morceaux[cle].append(np.pad(octets, ((0, 0), (0, -octets.shape[1] % 8))))
+    if not morceaux["hom0"]:
+        raise ValueError("Aucun SNP disponible pour la vérification de parenté")
+    return {cle: np.ascontiguousarray(np.hstack(blocs)).view(np.uint64) for cle, blocs in morceaux.items()}
+
+def exclusions_homozygotes(descendants: Dict[str, np.ndarray], parents: Dict[str, np.ndarray],
+                           taille_lot: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """Homozygotes opposés et SNPs comparables entre chaque descendant et chaque parent candidat.
+
+    Un descendant ne peut pas être homozygote pour un allèle dont son parent est homozygote
+    pour l'autre : le décompte est un popcount de (d0 & p2) | (d2 & p0) sur des mots de 64 SNPs,
+    calculé par lots de descendants contre tous les candidats à la fois.
+    """
+    n_desc, mots = descendants["hom0"].shape
+    n_parents = parents["hom0"].shape[0]
+    taille_lot = taille_lot or max(1, 4_000_000 // max(n_parents * mots, 1))
+    exclusions = np.empty((n_desc, n_parents), dtype=np.int32)
+    compares = np.empty((n_desc, n_parents), dtype=np.int32)
+    for debut in range(0, n_desc, taille_lot):
+        lot = slice(debut, debut + taille_lot)
+        opposes = (descendants["hom0"][lot, None, :] & parents["hom2"][None]) | \
+                  (descendants["hom2"][lot, None, :] & parents["hom0"][None])
+        exclusions[lot] = compter_bits(opposes).sum(axis=2, dtype=np.int32)
+        compares[lot] = compter_bits(descendants["observe"][lot, None, :] & parents["observe"][None]).sum(axis=2, dtype=np.int32)
+    return exclusions, compares
+
+def _statut_parent(exclusions: np.ndarray, compares: np.ndarray, declare: np.ndarray, genotype: np.ndarray,
+                   taux_max: float) -> np.ndarray:
+    """Statut du parent déclaré : inconnu, non_genotype, insuffisant, compatible ou exclu."""
+    with np.errstate(invalid="ignore", divide="ignore"):
+        taux = exclusions / compares
+    return np.select(
+        [~declare, ~genotype, compares < Config.PARENTE_SNPS_MIN, taux <= taux_max],
+        ["inconnu", "non_genotype", "insuffisant", "compatible"], "exclu"
+    )
+
+def verifier_parentes(taux_max: float = Config.PARENTE_TAUX_EXCLUSION_MAX) -> Optional[Dict]:
+    """Contrôle les parents déclarés des agneaux génotypés et propose le bélier le plus compatible.
+
+    Les béliers candidats sont les pères du pédigrée et des saillies présents dans le stock de
+    génotypes ; le panel retient les SNPs les plus informatifs (Config.PARENTE_NB_SNPS).
+    """
+    debut_calcul = time.perf_counter()
+    stock = construire_stock_troupeau()
+    if stock is None:
+        return None
+    ped = pd.read_sql_query("SELECT animal, pere, mere FROM pedigree WHERE pere IS NOT NULL OR mere IS NOT NULL", db.conn)
+    ligne_de = pd.Series(np.arange(stock.n), index=stock.echantillons["identifiant"].astype(str))
+    ligne_de = ligne_de[~ligne_de.index.duplicated()]
+    ped = ped[ped["animal"].isin(ligne_de.index)].reset_index(drop=True)
+    if ped.empty:
+        return None
+    males = set(ped["pere"].dropna()) | {m for (m,) in db.fetchall("SELECT DISTINCT male_id FROM saillies WHERE male_id IS NOT NULL")}
+    beliers = sorted(str(m) for m in males if str(m) in ligne_de.index)
+
+    lignes = np.unique(np.concatenate([ligne_de.reindex(ped["animal"]).to_numpy(), ligne_de.reindex(beliers).to_numpy(),
+                                       ligne_de.reindex(ped["mere"].dropna()).dropna().to_numpy()]).astype(int))
+    position = pd.Series(np.arange(len(lignes)), index=lignes)
+    panel = panel_parente(stock, lignes=lignes)
+    masques = masques_homozygotes(stock, lignes, panel)
+    def sous_ensemble(identifiants):
+        rangs = position.reindex(ligne_de.reindex(identifiants).to_numpy()).to_numpy()
+        return {cle: v[rangs.astype(int)] for cle, v in masques.items()}
+
+    agneaux = sous_ensemble(ped["animal"])
+    n = len(ped)
+    resultat = pd.DataFrame({"animal": ped["animal"], "pere_declare": ped["pere"], "mere_declaree": ped["mere"]})
+
+    # Mères : une comparaison par agneau
+    mere_genotypee = ped["mere"].isin(ligne_de.index).to_numpy()
+    excl_mere, comp_mere = np.zeros(n, dtype=np.int32), np.zeros(n, dtype=np.int32)
+    if mere_genotypee.any():
+        meres = sous_ensemble(ped.loc[mere_genotypee, "mere"])
+        opposes = (agneaux["hom0"][mere_genotypee] & meres["hom2"]) | (agneaux["hom2"][mere_genotypee] & meres["hom0"])
+        excl_mere[mere_genotypee] = compter_bits(opposes).sum(axis=1)
+        comp_mere[mere_genotypee] = compter_bits(agneaux["observe"][mere_genotypee] & meres["observe"]).sum(axis=1)
+    resultat["exclusions_mere"], resultat["snps_mere"] = excl_mere, comp_mere
+    resultat["statut_mere"] = _statut_parent(excl_mere, comp_mere, ped["mere"].notna().to_numpy(), mere_genotypee, taux_max)
+
+    # Pères : tous les agneaux contre tous les béliers candidats
+    excl_pere, comp_pere = np.zeros(n, dtype=np.int32), np.zeros(n, dtype=np.int32)
+    resultat["pere_suggere"], resultat["exclusions_suggere"], resultat["snps_suggere"] = None, np.nan, np.nan
+    pere_genotype = ped["pere"].isin(beliers).to_numpy()
+    if beliers:
+        E, C = exclusions_homozygotes(agneaux, sous_ensemble(beliers))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            taux = np.where(C >= Config.PARENTE_SNPS_MIN, E / C, np.nan)
+        taux[ped["animal"].to_numpy()[:, None] == np.array(beliers)[None, :]] = np.nan
+        taux[_candidats_impossibles(ped["animal"], beliers)] = np.nan
+        rang_pere = pd.Series(np.arange(len(beliers)), index=beliers).reindex(ped["pere"]).to_numpy()
+        idx = np.flatnonzero(pere_genotype)
+        excl_pere[idx] = E[idx, rang_pere[idx].astype(int)]
+        comp_pere[idx] = C[idx, rang_pere[idx].astype(int)]
+        evaluable = ~np.isnan(taux).all(axis=1)
+        meilleur = np.where(evaluable, np.nanargmin(np.where(np.isnan(taux), np.inf, taux), axis=1), 0)
+        suggere = evaluable & (taux[np.arange(n), meilleur] <= taux_max)
+        resultat.loc[suggere, "pere_suggere"] = np.array(beliers)[meilleur[suggere]]
+        resultat.loc[suggere, "exclusions_suggere"] = E[np.arange(n), meilleur][suggere]
+        resultat.loc[suggere, "snps_suggere"] = C[np.arange(n), meilleur][suggere]
+    resultat["exclusions_pere"], resultat["snps_pere"] = excl_pere, comp_pere
+    resultat["statut_pere"] = _statut_parent(excl_pere, comp_pere, ped["pere"].notna().to_numpy(), pere_genotype, taux_max)
+
+    maintenant = datetime.now().isoformat()
+    resultat["date_verification"] = maintenant
+    colonnes = ["animal", "pere_declare", "statut_pere", "exclusions_pere", "snps_pere",
+                "mere_declaree", "statut_mere", "exclusions_mere", "snps_mere",
+                "pere_suggere", "exclusions_suggere", "snps_suggere", "date_verification"]
+    db.conn.execute("DELETE FROM verifications_parente")
+    db.conn.executemany(f"""
+        INSERT INTO verifications_parente ({', '.join(colonnes)})
+        VALUES ({', '.join('?' * len(colonnes))})
+    """, resultat[colonnes].astype(object).where(resultat[colonnes].notna(), None).itertuples(index=False, name=None))
+    details = {"agneaux": n, "beliers": len(beliers), "snps": len(panel),
+               "peres_exclus": int((resultat["statut_pere"] == "exclu").sum()),
+               "meres_exclues": int((resultat["statut_mere"] == "exclu").sum()),
+               "suggestions": int((resultat["pere_suggere"].notna() &
+                                   (resultat["pere_suggere"] != resultat["pere_declare"])).sum()),
+               "duree_s": time.perf_counter() - debut_calcul}
+    db.conn.execute("""
+        INSERT OR REPLACE INTO executions_taches (tache, derniere_execution, details)
+        VALUES ('verification_parente', ?, ?)
+    """, (maintenant, json.dumps(details)))
+    db.conn.commit()
+    return details
+
+def appliquer_peres_suggeres(animaux: List[str]) -> int:
+    """Remplace au pédigrée le père exclu ou inconnu par le bélier compatible proposé (F recalculé ensuite)."""
+    lignes = db.fetchall(f"""
+        SELECT pere_suggere, animal FROM verifications_parente
+        WHERE animal IN ({','.join('?' * len(animaux))}) AND pere_suggere IS NOT NULL
+          AND statut_pere IN ('exclu', 'inconnu', 'non_genotype')
+    """, tuple(animaux)) if animaux else []
+    db.conn.executemany("UPDATE pedigree SET pere=?, source='parente_snp' WHERE animal=?", lignes)
+    # Garde-fou comme à l'import : un pédigrée devenu cyclique est annulé
+    try:
+        matrice_pedigree(version_donnees("pedigree"))
+    except ValueError:
+        db.conn.rollback()
+        raise
+    db.conn.executemany("UPDATE verifications_parente SET pere_declare=pere_suggere, statut_pere='compatible', "
+                        "exclusions_pere=exclusions_suggere, snps_pere=snps_suggere WHERE animal=?",
+                        [(a,) for _, a in lignes])
+    db.conn.commit()
+    return len(lignes)
+
+# -----------------------------------------------------------------------------
+# PLAN D'ACCOUPLEMENT (AFFECTATION DES BÉLIERS)
+# -----------------------------------------------------------------------------
+def matrice_accouplements(brebis: List[str], beliers: List[str], methode: str = "BLUP",
+                          taille_lot: int = 64) -> Tuple[np.ndarray, np.ndarray]:
+    """Consanguinité des descendants (a_ij / 2) et mérite attendu ((VG mère + VG père) / 2) pour tous les couples.
+
+    Les colonnes de A des béliers sont obtenues par produits A·E (Colleau) ; un animal absent du
+    pédigrée est traité comme fondateur non apparenté, une valeur génétique manquante comme nulle.
+    """
+    ped = matrice_pedigree(version_donnees("pedigree"))
+    F = coefficients_consanguinite(ped)
+    index = pd.Index(ped["animaux"])
+    i, j = index.get_indexer(brebis), index.get_indexer(beliers)
+    F_desc = np.zeros((len(brebis), len(beliers)))
+    lignes_connues = np.flatnonzero(i >= 0)
+    colonnes_connues = np.flatnonzero(j >= 0)
+    for debut in range(0, len(colonnes_connues) if len(lignes_connues) else 0, taille_lot):
+        lot = colonnes_connues[debut:debut + taille_lot]
+        E = np.zeros((len(index), len(lot)))
+        E[j[lot], np.arange(len(lot))] = 1.0
+        F_desc[np.ix_(lignes_connues, lot)] = 0.5 * produit_parente(ped, F, E)[i[lignes_connues]]
+
+    ebv = pd.Series(dict(db.fetchall(
+        "SELECT animal, valeur FROM valeurs_genetiques WHERE caractere='lait' AND methode=?", (methode,)
+    )), dtype=float)
+    merite = 0.5 * (ebv.reindex(brebis).fillna(0.0).to_numpy()[:, None] + ebv.reindex(beliers).fillna(0.0).to_numpy()[None, :])
+    return F_desc, merite
+
+def optimiser_accouplements(F_desc: np.ndarray, merite: np.ndarray, capacites: np.ndarray,
+                            penalite_F: float = Config.ACCOUPLEMENT_PENALITE_F,
+                            F_max: float = Config.ACCOUPLEMENT_F_MAX) -> np.ndarray:
+    """Bélier affecté à chaque brebis (-1 si aucun) : maximise Σ(mérite − pénalité·F) sous les capacités des béliers.
+
+    Problème de transport résolu exactement par chemins augmentants successifs, à la manière de
+    l'algorithme hongrois : chaque brebis est insérée par le meilleur chemin dans le graphe des
+    béliers (Bellman-Ford vectorisé), qui peut déplacer d'autres brebis vers un bélier encore libre
+    ou en retirer une. Le graphe n'a que n_béliers nœuds, là où `linear_sum_assignment` sur les
+    béliers répétés par capacité devient très lent quand toutes les brebis visent les mêmes béliers.
+    Un bonus par brebis affectée fait passer le nombre de saillies avant le score ; les couples
+    au-delà de `F_max` sont exclus.
+    """
+    n_brebis, n_beliers = F_desc.shape
+    capacites = np.asarray(capacites, dtype=int).clip(min=0)
+    affectation = np.full(n_brebis, -1)
+    autorise = (F_desc <= F_max) & (capacites > 0)[None, :]
+    if not autorise.any():
+        return affectation
+    score = merite - penalite_F * F_desc
+    valides = score[autorise]
+    bonus = np.ptp(valides) * n_brebis + 1.0
+    # Colonne supplémentaire : brebis non affectée (valeur 0)
+    V = np.zeros((n_brebis, n_beliers + 1))
+    V[:, :n_beliers] = np.where(autorise, score - valides.min() + bonus, -np.inf)
+
+    membres = [[] for _ in range(n_beliers)]
+    effectifs = np.zeros(n_beliers, dtype=int)
+    # W[a, b] : meilleur gain à faire passer une brebis de a vers b (b = n_beliers : la retirer), K : laquelle
+    W = np.full((n_beliers, n_beliers + 1), -np.inf)
+    K = np.zeros((n_beliers, n_beliers + 1), dtype=int)
+
+    def maj_arcs(a: int):
+        if not membres[a]:
+            W[a] = -np.inf
+            return
+        m = np.array(membres[a])
+        gains = V[m] - V[m, a][:, None]
+        meilleures = gains.argmax(0)
+        W[a] = gains[meilleures, np.arange(n_beliers + 1)]
+        K[a] = m[meilleures]
+        W[a, a] = -np.inf
+
+    colonnes = np.arange(n_beliers)
+    for i in range(n_brebis):
+        gain = V[i, :n_beliers].copy()
+        precedent = np.full(n_beliers, -1)
+        for _ in range(n_beliers):
+            candidats = gain[:, None] + W[:, :n_beliers]
+            origine = candidats.argmax(0)
+            meilleur = candidats[origine, colonnes]
+            mieux = meilleur > gain + 1e-9
+            if not mieux.any():
+                break
+            gain[mieux] = meilleur[mieux]
+            precedent[mieux] = origine[mieux]
+
+        fin_libre = np.where(effectifs < capacites, gain, -np.inf)
+        b = int(fin_libre.argmax())
+        retrait = gain + W[:, n_beliers]
+        a_retrait = int(retrait.argmax())
+        if max(fin_libre[b], retrait[a_retrait]) <= 0:
+            continue
+        mouvements = []
+        if retrait[a_retrait] > fin_libre[b]:
+            mouvements.append((K[a_retrait, n_beliers], a_retrait, -1))
+            b = a_retrait
+        while precedent[b] >= 0:
+            mouvements.append((K[precedent[b], b], precedent[b], b))
+            b = precedent[b]
+        mouvements.append((i, -1, b))
+
+        touches = set()
+        for k, depart, arrivee in mouvements:
+            if depart >= 0:
+                membres[depart].remove(k)
+                effectifs[depart] -= 1
+                touches.add(depart)
+            if arrivee >= 0:
+                membres[arrivee].append(k)
+                effectifs[arrivee] += 1
+                touches.add(arrivee)
+            affectation[k] = arrivee
+        for a in touches:
+            maj_arcs(a)
+    return affectation
+
+def enregistrer_plan_accouplement(brebis_ids: List[int], beliers: List[str], affectation: np.ndarray,
+                                  F_desc: np.ndarray, merite: np.ndarray) -> str:
+    """Range le plan dans `plans_accouplement` et retourne son identifiant."""
+    plan_id = uuid.uuid4().hex[:12]
+    maintenant = datetime.now().isoformat()
+    lignes = np.flatnonzero(affectation >= 0)
+    db.conn.executemany("""
+        INSERT INTO plans_accouplement (plan_id, date_plan, brebis_id, belier, F_descendant, merite)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, [(plan_id, maintenant, int(brebis_ids[k]), beliers[affectation[k]],
+           float(F_desc[k, affectation[k]]), float(merite[k, affectation[k]])) for k in lignes])
+    db.conn.commit()
+    return plan_id
+
 # -----------------------------------------------------------------------------
 # FONCTIONS DE DÉTECTION D'ÉTALON (NOUVELLES)
 # -----------------------------------------------------------------------------
@@ -858,10 +4315,31 @@ def page_genomique():
             gene_search = st.text_input("Nom du gène", "BMP15", 
                                        help="Ex: BMP15, MSTN, DGAT1, CAST...")
         with col2:
-            organism = st.selectbox("Organisme", ["Ovis aries (Mouton)", "Capra hircus (Chèvre)", "Bos taurus (Bovin)"])
+            organism = st.selectbox("Organisme", list(Config.NCBI_ORGANISMES.keys()))
+        organisme = Config.NCBI_ORGANISMES[organism]
+        
+        derniere_synchro = db.fetchone("SELECT derniere_execution, details FROM executions_taches WHERE tache='miroir_genes_ncbi'")
+        col_miroir1, col_miroir2 = st.columns([3, 1])
+        if derniere_synchro:
+            bilan = json.loads(derniere_synchro[1])
+            col_miroir1.caption(f"Miroir local NCBI : {bilan['genes']} gènes, mis à jour le {derniere_synchro[0][:16]}")
+        else:
+            col_miroir1.caption("Miroir local NCBI vide : lancez une mise à jour pour travailler hors ligne.")
+        if col_miroir2.button("🔄 Mettre à jour le miroir", use_container_width=True):
+            with st.spinner("Téléchargement des gènes économiques pour tous les organismes..."):
+                try:
+                    bilan = prefetch_genes_economiques()
+                    st.success(f"{bilan['genes']} gènes enregistrés en {bilan['duree_s']} s "
+                               f"({bilan['erreurs']} recherche(s) en échec)")
+                except requests.RequestException as e:
+                    st.error(f"NCBI injoignable : {e}")
         
         if st.button("🔍 Rechercher dans NCBI", use_container_width=True):
-            results = genomic_analyzer.ncbi.search_gene(gene_search, "Ovis aries")
+            results = genes_miroir(gene_search, organisme)
+            if results:
+                st.caption(f"Réponse du miroir local (mis à jour le {results[0]['date_maj'][:10]})")
+            else:
+                results = genomic_analyzer.ncbi.search_gene(gene_search, organisme)
             
             if results:
                 for gene in results:
@@ -917,6 +4395,55 @@ def page_genomique():
                 st.success("### ✅ Recommandations")
                 for rec in analysis['recommandations']:
                     st.write(rec)
+        
+        st.markdown("---")
+        st.subheader("Composition raciale estimée sur les SNPs")
+        st.caption("Fréquences alléliques de chaque race estimées sur les brebis génotypées de race déclarée "
+                   "(les références trop métissées sont écartées), puis proportions raciales de chaque brebis "
+                   "ajustées sur ses génotypes.")
+        if st.button("🧬 Estimer la composition raciale"):
+            with st.spinner("Estimation des proportions raciales..."):
+                try:
+                    bilan_races = calculer_composition_raciale(forcer=True)
+                except ValueError as e:
+                    st.warning(str(e))
+                else:
+                    if bilan_races is None:
+                        st.info("Aucun génotype enregistré pour le troupeau.")
+        derniere_compo = db.fetchone("SELECT derniere_execution, details FROM executions_taches WHERE tache='composition_raciale'")
+        if derniere_compo:
+            infos = json.loads(derniere_compo[1])
+            st.caption(f"Calcul du {derniere_compo[0][:16]} : {infos['animaux']} brebis, {infos['snps']:,} SNPs informatifs, "
+                       f"{infos['references']} références, {len(infos['iterations'])} passes en {infos['duree_s']:.1f} s")
+            query_compo = """
+                SELECT b.numero_id, b.nom, b.race AS race_declaree, c.race, c.proportion, c.reference
+                FROM composition_raciale c
+                JOIN brebis b ON c.brebis_id = b.id
+                JOIN elevages e ON b.elevage_id = e.id
+                JOIN eleveurs el ON e.eleveur_id = el.id
+                WHERE el.user_id=?
+            """
+            query_compo, params_compo = filtrer_par_eleveur(query_compo, [st.session_state.user_id], join_eleveur=True)
+            compo = pd.read_sql_query(query_compo, db.conn, params=params_compo)
+            if not compo.empty:
+                large = compo.pivot_table(index=["numero_id", "nom", "race_declaree"], columns="race",
+                                          values="proportion").reset_index()
+                races_estimees = [r for r in infos["races"] if r in large.columns]
+                large["race_dominante"] = large[races_estimees].idxmax(axis=1)
+                moyennes = large.groupby("race_declaree")[races_estimees].mean()
+                st.plotly_chart(px.imshow(moyennes.round(2), text_auto=True, color_continuous_scale="Blues",
+                                          title="Composition moyenne par race déclarée",
+                                          labels={"x": "Race estimée", "y": "Race déclarée", "color": "Proportion"}),
+                                use_container_width=True)
+                apercu = large.sort_values(["race_dominante"] + races_estimees, ascending=False).head(200)
+                fig = px.bar(apercu.melt(id_vars="numero_id", value_vars=races_estimees, var_name="race", value_name="proportion"),
+                             x="numero_id", y="proportion", color="race", title="Proportions raciales (200 premières brebis)")
+                fig.update_layout(xaxis={"showticklabels": False}, bargap=0)
+                st.plotly_chart(fig, use_container_width=True)
+                discordantes = large[large["race_declaree"].isin(races_estimees) &
+                                     (large["race_dominante"] != large["race_declaree"])]
+                st.markdown(f"**Brebis dont la race dominante diffère de la race déclarée : {len(discordantes)}**")
+                st.dataframe(discordantes.round(3))
     
     with tab3:
         st.subheader("Base de données SNPs et QTN économiques")
@@ -1996,7 +5523,8 @@ def page_production():
 def page_genomique_avancee():
     st.title("🧬 Génomique avancée")
     
-    tab1, tab2, tab3 = st.tabs(["🔍 BLAST", "🧬 SNPs d'intérêt", "📊 GWAS"])
+    tab1, tab2, tab3, tab4, tab5, tab6 = st.tabs(["🔍 BLAST", "🧬 SNPs d'intérêt", "📊 GWAS", "🧮 Parenté génomique",
+                                                  "🔗 Déséquilibre de liaison", "🎯 Prédiction génomique"])
     
     params = [st.session_state.user_id]
     query_brebis = """
@@ -2011,51 +5539,99 @@ def page_genomique_avancee():
     brebis_dict = {f"{b[0]} - {b[1]} {b[2]}": b[0] for b in brebis_list}
     
     with tab1:
-        st.subheader("Alignement BLAST sur NCBI")
+        st.subheader("Recherche locale de séquences (type BLASTN)")
+        st.caption("Index de k-mers sur les séquences des brebis et les références NCBI en cache local ; "
+                   "graines exactes, extension sans gap (1/-2) et e-values de Karlin-Altschul.")
+        
+        with st.expander("📚 Séquences de référence NCBI en cache local"):
+            col1, col2 = st.columns([3, 1])
+            accession = col1.text_input("Accession NCBI Nucleotide", placeholder="NM_001114767.1", key="ref_accession")
+            if col2.button("Ajouter", key="ref_ajouter") and accession:
+                with st.spinner(f"Téléchargement de {accession}..."):
+                    description = ajouter_reference_ncbi(accession.strip())
+                if description:
+                    st.success(f"Référence ajoutée : {description}")
+                else:
+                    st.error("Séquence introuvable.")
+            references = db.fetchall("SELECT accession, description, LENGTH(sequence), date_ajout FROM sequences_reference")
+            if references:
+                st.dataframe(pd.DataFrame(references, columns=["Accession", "Description", "Longueur (pb)", "Ajoutée le"]),
+                             use_container_width=True, hide_index=True)
         
         default_seq = ""
+        bid_requete = None
         if brebis_dict:
             blast_brebis = st.selectbox("Sélectionner une brebis (pour utiliser sa séquence FASTA)", 
                                         ["Nouvelle séquence"] + list(brebis_dict.keys()))
             if blast_brebis != "Nouvelle séquence":
-                bid = brebis_dict[blast_brebis]
-                seq_result = db.fetchone("SELECT sequence_fasta FROM brebis WHERE id=?", (bid,))
-                if seq_result and seq_result[0]:
-                    default_seq = seq_result[0]
+                bid_requete = brebis_dict[blast_brebis]
+                default_seq = charger_sequence_fasta(bid_requete)
         
         seq_input = st.text_area("Séquence FASTA", value=default_seq, height=150)
-        database = st.selectbox("Base de données", ["nr", "nt", "refseq_rna", "refseq_protein"])
+        if bid_requete and seq_input.strip() and seq_input.strip() != default_seq.strip():
+            if st.button("💾 Enregistrer cette séquence pour la brebis"):
+                nombre = enregistrer_sequence(bid_requete, seq_input)
+                st.success(f"{nombre} séquence(s) enregistrée(s) (stockage compact 2 bits)")
+                st.rerun()
+        col1, col2 = st.columns(2)
+        gene_cible = col1.text_input("Gène ciblé (optionnel)", key="recherche_gene")
+        evalue_max = col2.select_slider("E-value maximale", [1e-50, 1e-20, 1e-10, 1e-5, 1e-3, 0.01, 0.1, 1.0, 10.0],
+                                        value=10.0, key="recherche_evalue")
         
-        if st.button("Lancer BLAST"):
-            if not seq_input:
+        if st.button("Lancer la recherche"):
+            enregistrements = parser_fasta(seq_input)
+            if not enregistrements:
                 st.error("Veuillez entrer une séquence.")
             else:
-                with st.spinner("Recherche BLAST en cours..."):
-                    try:
-                        url = "https://blast.ncbi.nlm.nih.gov/Blast.cgi"
-                        params = {
-                            "CMD": "Put",
-                            "PROGRAM": "blastn",
-                            "DATABASE": database,
-                            "QUERY": seq_input,
-                            "FORMAT_TYPE": "JSON2"
-                        }
-                        requests.post(url, data=params)
-                        st.warning("Le BLAST en ligne est complexe à intégrer. Pour une démonstration, nous affichons un résultat factice.")
-                        time.sleep(2)
-                        st.success("BLAST terminé (simulation)")
-                        
-                        mock_results = [
-                            {"accession": "XM_004012345.1", "description": "Ovis aries BMP15 mRNA", "score": 1234, "evalue": 1e-150},
-                            {"accession": "NM_001009345.1", "description": "Ovis aries MSTN mRNA", "score": 1100, "evalue": 1e-140},
-                        ]
-                        df_mock = pd.DataFrame(mock_results)
-                        st.dataframe(df_mock)
-                        
-                        if st.button("Enregistrer ce résultat"):
-                            st.info("Fonctionnalité à implémenter (sauvegarde en base)")
-                    except Exception as e:
-                        st.error(f"Erreur BLAST: {e}")
+                sequence = enregistrements[0][1]
+                index = index_sequences(st.session_state.user_id, version_donnees("sequences", "sequences_reference"))
+                debut_recherche = time.perf_counter()
+                hits = index.rechercher(sequence, evalue_max=evalue_max,
+                                        exclure=f"brebis:{bid_requete}" if bid_requete else None)
+                duree_ms = (time.perf_counter() - debut_recherche) * 1000
+                st.success(f"{len(hits)} résultat(s) en {duree_ms:.0f} ms — {len(index.sujets)} séquences, "
+                           f"{index.taille_base:,} pb indexées")
+                if not hits.empty:
+                    affichage = hits.copy()
+                    affichage["evalue"] = affichage["evalue"].map(lambda v: f"{v:.1e}")
+                    affichage["identite_pct"] = affichage["identite_pct"].round(1)
+                    affichage["bits"] = affichage["bits"].round(1)
+                    st.dataframe(affichage, use_container_width=True, hide_index=True)
+                enregistrer_recherche(bid_requete, gene_cible, sequence, hits)
+                st.caption("Recherche enregistrée dans l'historique des analyses génomiques.")
+        
+        historique = db.fetchall("""
+            SELECT a.date_analyse, b.numero_id, a.gene_cible, LENGTH(a.sequence_query), a.identite_pct, a.e_value
+            FROM analyses_genomiques a
+            JOIN brebis b ON a.brebis_id = b.id
+            JOIN elevages e ON b.elevage_id = e.id
+            JOIN eleveurs el ON e.eleveur_id = el.id
+            WHERE el.user_id=?
+            ORDER BY a.date_analyse DESC LIMIT 10
+        """, (st.session_state.user_id,))
+        if historique:
+            with st.expander("🕘 Dernières recherches sur les brebis"):
+                st.dataframe(pd.DataFrame(historique, columns=["Date", "Brebis", "Gène", "Longueur requête",
+                                                               "Identité (%)", "E-value"]),
+                             use_container_width=True, hide_index=True)
+        
+        with st.expander("🧬 Similarité des séquences dans le troupeau (MinHash)"):
+            st.caption(f"Esquisses de {Config.MINHASH_TAILLE} compartiments sur les {Config.MINHASH_K}-mers canoniques, "
+                       "calculées à l'enregistrement des séquences.")
+            if bid_requete:
+                proches = similarites_troupeau(st.session_state.user_id, bid_requete)
+                if proches.empty:
+                    st.info("Aucune esquisse pour cette brebis ou le reste du troupeau.")
+                else:
+                    st.dataframe(proches.head(20).round({"jaccard": 3, "distance_mash": 5}),
+                                 use_container_width=True, hide_index=True)
+            if st.button("🔎 Détecter les échantillons dupliqués", key="minhash_doublons"):
+                doublons = doublons_troupeau(st.session_state.user_id)
+                if doublons.empty:
+                    st.success(f"Aucun couple au-dessus de Jaccard {Config.MINHASH_SEUIL_DOUBLON}.")
+                else:
+                    st.warning(f"{len(doublons)} couple(s) quasi identique(s)")
+                    st.dataframe(doublons, use_container_width=True, hide_index=True)
     
     with tab2:
         st.subheader("SNPs d'intérêt économique")
@@ -2070,95 +5646,321 @@ def page_genomique_avancee():
         if brebis_dict:
             selected = st.selectbox("Charger les SNPs d'une brebis", list(brebis_dict.keys()))
             bid = brebis_dict[selected]
-            variants = db.fetchone("SELECT variants_snps FROM brebis WHERE id=?", (bid,))
-            if variants and variants[0]:
-                try:
-                    snps = json.loads(variants[0])
-                    st.json(snps)
-                except:
-                    st.info("Les SNPs ne sont pas au format JSON valide.")
+            df_snps_brebis = genotypes_brebis(bid)
+            if not df_snps_brebis.empty:
+                st.dataframe(df_snps_brebis, use_container_width=True, hide_index=True)
             else:
                 st.info("Aucun SNP enregistré pour cette brebis.")
             
             with st.expander("Ajouter / modifier les SNPs"):
                 snps_json = st.text_area("SNPs au format JSON (ex: {'BMP15': 'AA', 'MSTN': 'GG'})", height=150)
                 if st.button("Enregistrer"):
-                    db.execute("UPDATE brebis SET variants_snps=? WHERE id=?", (snps_json, bid))
-                    st.success("SNPs enregistrés")
-                    st.rerun()
+                    snps = lire_snps_texte(snps_json)
+                    if snps is None:
+                        st.error("Les SNPs ne sont pas au format JSON valide.")
+                    else:
+                        enregistrer_genotypes(bid, snps)
+                        st.success("SNPs enregistrés")
+                        st.rerun()
+        
+        st.markdown("**Porteurs et fréquences alléliques par élevage**")
+        snps_connus = [r[0] for r in db.fetchall(
+            "SELECT DISTINCT snp_name FROM comptes_genotypes WHERE n > 0 ORDER BY snp_name LIMIT 5000")]
+        if snps_connus:
+            col1, col2 = st.columns(2)
+            snp_choisi = col1.selectbox("SNP / gène", snps_connus, key="porteurs_snp")
+            allele_choisi = col2.selectbox("Allèle recherché", list("ACGTID"), key="porteurs_allele")
+            debut_requete = time.perf_counter()
+            n_porteurs = compter_porteurs(snp_choisi, allele_choisi, st.session_state.user_id, st.session_state.eleveur_id)
+            porteurs = porteurs_allele(snp_choisi, allele_choisi, st.session_state.user_id, st.session_state.eleveur_id,
+                                       limite=1000)
+            freq = frequences_alleliques(snp_choisi, st.session_state.user_id, st.session_state.eleveur_id)
+            st.caption(f"Requêtes exécutées en {(time.perf_counter() - debut_requete) * 1000:.0f} ms")
+            col1, col2 = st.columns(2)
+            with col1:
+                st.metric(f"Porteuses de l'allèle {allele_choisi.upper()}", n_porteurs)
+                if n_porteurs > len(porteurs):
+                    st.caption(f"{len(porteurs)} premières porteuses affichées")
+                st.dataframe(porteurs.drop(columns="brebis_id"), use_container_width=True, hide_index=True, height=300)
+            with col2:
+                if not freq.empty:
+                    fig = px.bar(freq, x="elevage", y="frequence", color="allele", barmode="group",
+                                 title=f"Fréquences alléliques — {snp_choisi}", hover_data=["copies", "n_brebis"])
+                    st.plotly_chart(fig, use_container_width=True)
     
     with tab3:
         st.subheader("Analyse d'association GWAS")
         st.markdown("""
         Cette section permet de réaliser une étude d'association pangénomique simplifiée.
-        Vous devez fournir deux fichiers CSV :
-        - **Génotypes** : avec une colonne `brebis_id` et une colonne par SNP (valeurs 0,1,2 pour le dosage allélique).
-        - **Phénotypes** : avec les colonnes `brebis_id` et un trait quantitatif (ex: production laitière, poids...).
+        - **Génotypes** : un fichier CSV avec une colonne `brebis_id` et une colonne par SNP
+          (valeurs 0,1,2 pour le dosage allélique), un jeu PLINK binaire (.bed/.bim/.fam, les
+          identifiants du .fam correspondant aux numéros des brebis) ou le stock de génotypes du troupeau.
+        - **Phénotypes** : fichier CSV avec les colonnes `brebis_id` et un trait quantitatif (ex: production laitière, poids...).
         """)
         
-        upload_geno = st.file_uploader("Fichier génotypes (CSV)", type="csv", key="geno")
+        source_geno = st.radio("Source des génotypes",
+                               ["Fichier CSV", "Fichiers PLINK (.bed/.bim/.fam)", "Stock de génotypes du troupeau"],
+                               horizontal=True, key="gwas_source")
+        upload_geno = None
+        if source_geno == "Fichier CSV":
+            upload_geno = st.file_uploader("Fichier génotypes (CSV)", type="csv", key="geno")
+        elif source_geno.startswith("Fichiers PLINK"):
+            uploads_plink = st.file_uploader("Fichiers PLINK (.bed, .bim, .fam)", type=["bed", "bim", "fam"],
+                                             accept_multiple_files=True, key="geno_plink")
+            fichiers_plink = {os.path.splitext(f.name)[1].lower(): f for f in uploads_plink or []}
+            if set(fichiers_plink) == {".bed", ".bim", ".fam"}:
+                # file_id change à chaque téléversement, même si le nom du fichier est identique
+                televersement = sorted(f.file_id for f in uploads_plink)
+                if st.session_state.get("gwas_plink_televersement") != televersement \
+                        or not os.path.exists(st.session_state.gwas_plink_prefixe + ".bed"):
+                    st.session_state.gwas_plink_prefixe = enregistrer_fichiers_plink(fichiers_plink)
+                    st.session_state.gwas_plink_televersement = televersement
+                upload_geno = st.session_state.gwas_plink_prefixe
         upload_pheno = st.file_uploader("Fichier phénotypes (CSV)", type="csv", key="pheno")
         
-        if upload_geno and upload_pheno:
+        mode_gwas = st.radio("Modèle d'association",
+                             ["Régression simple", "Modèle mixte (EMMAX, corrige la structure familiale)"],
+                             horizontal=True, key="gwas_mode")
+        modele_mixte = mode_gwas.startswith("Modèle mixte")
+        mixte_indisponible = modele_mixte and source_geno == "Fichier CSV"
+        if mixte_indisponible:
+            st.error("Le modèle mixte nécessite un stock de génotypes ou un jeu PLINK (calcul de la GRM) : "
+                     "choisissez une autre source ou la régression simple.")
+        
+        elagage_ld = False
+        if source_geno != "Fichier CSV":
+            elagage_ld = st.checkbox(f"Élaguer le panel par LD avant l'analyse (fenêtre {Config.LD_FENETRE} SNPs, "
+                                     f"pas {Config.LD_PAS}, r² > {Config.LD_SEUIL_R2})", key="gwas_ld")
+        
+        col_perm1, col_perm2 = st.columns(2)
+        avec_permutations = col_perm1.checkbox("Seuil empirique par permutations (max-T)", key="gwas_perm")
+        n_permutations = col_perm2.number_input("Nombre de permutations", 100, 10000, 1000, step=100,
+                                                disabled=not avec_permutations, key="gwas_n_perm")
+        
+        if upload_pheno and (upload_geno or source_geno.startswith("Stock")) and not mixte_indisponible:
             try:
-                df_geno = pd.read_csv(upload_geno)
                 df_pheno = pd.read_csv(upload_pheno)
+                df_res = None
+                source_perm = lignes_perm = colonnes_perm = snps_meta = None
                 
-                if 'brebis_id' not in df_geno.columns or 'brebis_id' not in df_pheno.columns:
-                    st.error("Les fichiers doivent contenir une colonne 'brebis_id'.")
-                else:
-                    df_merged = pd.merge(df_geno, df_pheno, on='brebis_id')
-                    trait_col = st.selectbox("Sélectionner le trait phénotypique", 
-                                             [c for c in df_pheno.columns if c != 'brebis_id'])
-                    
-                    snp_cols = [c for c in df_geno.columns if c != 'brebis_id' and df_geno[c].dtype in ['int64', 'float64']]
-                    
-                    if len(snp_cols) == 0:
-                        st.error("Aucune colonne SNP numérique trouvée.")
+                if 'brebis_id' not in df_pheno.columns:
+                    st.error("Le fichier phénotypes doit contenir une colonne 'brebis_id'.")
+                elif source_geno == "Fichier CSV":
+                    df_geno = pd.read_csv(upload_geno)
+                    if 'brebis_id' not in df_geno.columns:
+                        st.error("Les fichiers doivent contenir une colonne 'brebis_id'.")
                     else:
-                        st.write(f"Nombre de SNPs analysés : {len(snp_cols)}")
+                        df_merged = pd.merge(df_geno, df_pheno, on='brebis_id')
+                        trait_col = st.selectbox("Sélectionner le trait phénotypique", 
+                                                 [c for c in df_pheno.columns if c != 'brebis_id'])
                         
-                        results = []
-                        pbar = st.progress(0)
-                        for i, snp in enumerate(snp_cols):
-                            X = df_merged[snp].values
-                            y = df_merged[trait_col].values
-                            X = sm.add_constant(X)
-                            model = sm.OLS(y, X).fit()
-                            p_value = model.pvalues[1]
-                            beta = model.params[1]
-                            results.append({
-                                'SNP': snp,
-                                'Beta': beta,
-                                'P_value': p_value,
-                                '-log10(p)': -np.log10(p_value) if p_value > 0 else 10
-                            })
-                            pbar.progress((i+1)/len(snp_cols))
+                        snp_cols = [c for c in df_geno.columns if c != 'brebis_id' and df_geno[c].dtype in ['int64', 'float64']]
                         
-                        df_res = pd.DataFrame(results)
-                        
-                        fig = px.scatter(df_res, x='SNP', y='-log10(p)', 
-                                         title="Manhattan plot",
-                                         labels={'-log10(p)': '-log10(p-value)'},
-                                         hover_data=['Beta', 'P_value'])
-                        fig.add_hline(y=-np.log10(0.05/len(snp_cols)), line_dash="dash", 
-                                      annotation_text="Bonferroni threshold")
-                        st.plotly_chart(fig, use_container_width=True)
-                        
-                        sig = df_res[df_res['P_value'] < 0.05]
-                        if not sig.empty:
-                            st.subheader("SNPs suggestifs (p < 0.05)")
-                            st.dataframe(sig.sort_values('P_value'), use_container_width=True, hide_index=True)
+                        if len(snp_cols) == 0:
+                            st.error("Aucune colonne SNP numérique trouvée.")
+                        else:
+                            st.write(f"Nombre de SNPs analysés : {len(snp_cols)}")
+                            
+                            y = df_merged[trait_col].to_numpy(dtype=float)
+                            G = df_merged[snp_cols].to_numpy(dtype=float)
+                            with st.spinner("Association en cours..."):
+                                df_res = gwas_vectorise(G, y, snp_cols)
+                            source_perm = G
+                else:
+                    if source_geno.startswith("Fichiers PLINK"):
+                        stock = StockPlink(upload_geno, st.session_state.user_id)
+                        non_reconnues = int(stock.echantillons["brebis_id"].isna().sum())
+                        if non_reconnues:
+                            st.warning(f"{non_reconnues} individu(s) du .fam sans brebis correspondante (ignorés).")
+                    else:
+                        with st.spinner("Préparation du stock de génotypes..."):
+                            stock = construire_stock_troupeau()
+                    if stock is None:
+                        st.error("Aucun génotype enregistré pour le troupeau.")
+                    else:
+                        trait_col = st.selectbox("Sélectionner le trait phénotypique", 
+                                                 [c for c in df_pheno.columns if c != 'brebis_id'])
+                        lignes, y = stock.aligner_phenotypes(df_pheno, trait_col)
+                        snps_gwas = None
+                        if elagage_ld and len(lignes) >= 3:
+                            with st.spinner("Élagage LD du panel..."):
+                                snps_gwas = elaguer_ld(stock)["indices"]
+                        if len(lignes) < 3:
+                            st.error("Trop peu de brebis phénotypées présentes dans le stock.")
                         else:
-                            st.info("Aucun SNP significatif au seuil de 0.05.")
+                            st.write(f"Nombre de SNPs analysés : {stock.m if snps_gwas is None else len(snps_gwas)}"
+                                     f" — brebis : {len(lignes)}")
+                            if modele_mixte:
+                                with st.spinner("GRM, décomposition et modèle nul (une seule fois), puis association..."):
+                                    df_res, modele_nul = gwas_mixte(stock, lignes, y, snps_gwas)
+                                st.caption(f"Héritabilité génomique estimée : h² = {modele_nul['h2']:.2f} "
+                                           f"(δ = σ²e/σ²g = {modele_nul['delta']:.3f})")
+                            else:
+                                with st.spinner("Association en cours..."):
+                                    df_res = gwas_par_blocs(stock.iter_blocs(lignes=lignes, snps=snps_gwas), y)
+                                source_perm, lignes_perm, colonnes_perm = stock, lignes, snps_gwas
+                            snps_meta = stock.snps
+                
+                if df_res is not None:
+                    seuils = None
+                    if avec_permutations and source_perm is None:
+                        st.info("Les permutations ne sont disponibles qu'en régression simple.")
+                    elif avec_permutations:
+                        with st.spinner(f"{int(n_permutations)} permutations en cours..."):
+                            debut_perm = time.time()
+                            max_t = permutations_max_t(source_perm, y, lignes_perm, int(n_permutations),
+                                                       colonnes=colonnes_perm)
+                            seuils = seuils_permutation(df_res, max_t)
+                        st.info(f"Seuil génomique empirique (α = 5 %) : |T| > {seuils['seuil_t']:.2f}, "
+                                f"soit p < {seuils['seuil_p']:.2e} — {seuils['n_permutations']} permutations "
+                                f"en {time.time() - debut_perm:.1f} s")
+                    
+                    lignes_seuil = [(-np.log10(0.05/len(df_res)), "Bonferroni threshold", "grey")]
+                    if seuils:
+                        lignes_seuil.append((-np.log10(seuils['seuil_p']), "Seuil permutations (max-T)", "red"))
+                    st.plotly_chart(figure_manhattan(df_res, snps_meta, lignes_seuil), use_container_width=True)
+                    
+                    fig_qq, lambda_gc = figure_qq(df_res['P_value'].to_numpy())
+                    col_qq, col_lambda = st.columns([3, 1])
+                    col_qq.plotly_chart(fig_qq, use_container_width=True)
+                    col_lambda.metric("Inflation génomique λGC", f"{lambda_gc:.3f}")
+                    
+                    sig = df_res[df_res['P_value'] < 0.05]
+                    if not sig.empty:
+                        st.subheader("SNPs suggestifs (p < 0.05)")
+                        if len(sig) > 500:
+                            st.caption(f"{len(sig):,} SNPs suggestifs — les 500 plus significatifs sont affichés.")
+                        st.dataframe(sig.nsmallest(500, 'P_value'), use_container_width=True, hide_index=True)
+                    else:
+                        st.info("Aucun SNP significatif au seuil de 0.05.")
             except Exception as e:
                 st.error(f"Erreur lors de l'analyse : {e}")
+    
+    with tab4:
+        st.subheader("Matrice de parenté génomique (VanRaden)")
+        st.markdown("""
+        Parenté entre brebis génotypées calculée à partir de tous les SNPs du stock du troupeau.
+        La matrice est mise en cache : elle n'est recalculée que si les génotypes ou les brebis changent.
+        """)
+        with st.spinner("Préparation du stock de génotypes..."):
+            stock = construire_stock_troupeau()
+        lignes_grm = stock.lignes_brebis([b[0] for b in brebis_list]) if stock is not None else np.array([])
+        lignes_grm = np.sort(lignes_grm[lignes_grm >= 0])
+        if len(lignes_grm) < 2:
+            st.info("Au moins deux brebis génotypées sont nécessaires.")
+        else:
+            recalculer = st.button("🔄 Recalculer la matrice", key="grm_recalcul")
+            with st.spinner("Calcul de la matrice de parenté..."):
+                K, meta_grm = grm_vanraden(stock, lignes_grm, forcer=recalculer)
+            ids_grm = stock.echantillons.iloc[lignes_grm]["identifiant"].astype(str).to_numpy()
+            diag = np.asarray(np.diag(K))
+            hors_diag = np.asarray(K[np.triu_indices(len(lignes_grm), 1)]) if len(lignes_grm) <= 3000 else None
+            
+            col1, col2, col3 = st.columns(3)
+            col1.metric("Brebis", meta_grm["n"])
+            col2.metric("SNPs polymorphes", f"{meta_grm['m']:,}")
+            col3.metric("Diagonale moyenne (1 + F)", f"{diag.mean():.3f}")
+            st.caption(f"Calculée le {meta_grm['date'][:16]} en {meta_grm['duree_s']} s")
+            
+            n_affiche = min(len(lignes_grm), 200)
+            fig = px.imshow(np.asarray(K[:n_affiche, :n_affiche]), x=ids_grm[:n_affiche], y=ids_grm[:n_affiche],
+                            color_continuous_scale="RdBu_r", zmin=-0.5, zmax=1.5,
+                            title=f"Parenté génomique ({n_affiche} premières brebis)")
+            st.plotly_chart(fig, use_container_width=True)
+            
+            if hors_diag is not None:
+                i_sup, j_sup = np.triu_indices(len(lignes_grm), 1)
+                top = np.argsort(hors_diag)[::-1][:20]
+                st.subheader("Couples les plus apparentés")
+                st.dataframe(pd.DataFrame({
+                    "Brebis 1": ids_grm[i_sup[top]], "Brebis 2": ids_grm[j_sup[top]],
+                    "Parenté": hors_diag[top].round(3)
+                }), use_container_width=True, hide_index=True)
+    
+    with tab5:
+        st.subheader("Déséquilibre de liaison et élagage du panel")
+        st.markdown("""
+        r² calculé entre chaque SNP et ses voisins (même chromosome) sur le stock du troupeau, puis élagage
+        à la manière de PLINK `--indep-pairwise` : dans chaque fenêtre, le SNP de plus faible MAF d'une paire
+        trop liée est retiré. Les paires fortement liées sont conservées en cache pour les analyses suivantes.
+        """)
+        stock_ld = construire_stock_troupeau()
+        if stock_ld is None:
+            st.info("Aucun génotype enregistré pour le troupeau.")
+        else:
+            col1, col2, col3 = st.columns(3)
+            fenetre_ld = col1.number_input("Fenêtre (SNPs)", 5, 1000, Config.LD_FENETRE, key="ld_fenetre")
+            pas_ld = col2.number_input("Pas (SNPs)", 1, 500, Config.LD_PAS, key="ld_pas")
+            seuil_ld = col3.slider("Seuil r²", 0.2, 0.99, Config.LD_SEUIL_R2, 0.01, key="ld_seuil")
+            if st.button("Calculer le LD et élaguer", key="ld_calcul"):
+                with st.spinner("Calcul du LD par fenêtres..."):
+                    elagage = elaguer_ld(stock_ld, int(fenetre_ld), int(pas_ld), float(seuil_ld))
+                col1, col2, col3 = st.columns(3)
+                col1.metric("SNPs conservés", f"{elagage['n_gardes']:,}")
+                col2.metric("SNPs retirés", f"{elagage['n_retires']:,}")
+                col3.metric(f"Paires stockées (r² ≥ {Config.LD_SEUIL_STOCKAGE})", f"{elagage['paires'].nnz:,}")
+                
+                decroissance = decroissance_ld(stock_ld, elagage["paires"])
+                if not decroissance.empty:
+                    fig = px.line(decroissance, x="distance_kb", y="r2_moyen", markers=True,
+                                  title=f"Décroissance du LD (paires avec r² ≥ {Config.LD_SEUIL_STOCKAGE})",
+                                  labels={"distance_kb": "Distance (kb)", "r2_moyen": "r² moyen"})
+                    st.plotly_chart(fig, use_container_width=True)
+                with open(elagage["prune_in"], "rb") as f:
+                    st.download_button("📥 Télécharger prune.in", f.read(), file_name="prune.in", mime="text/plain")
+
+    with tab6:
+        st.subheader("Valeurs génomiques (GBLUP) pour le lait")
+        st.markdown("""
+        Les performances laitières, corrigées de l'élevage-année et de l'âge, sont régressées sur les SNPs
+        du troupeau : forme noyau (GRM) quand les marqueurs sont plus nombreux que les animaux, ridge sur
+        les SNPs sinon. L'héritabilité est retenue par validation croisée ; les jeunes brebis génotypées
+        sans contrôle laitier reçoivent ainsi une valeur génomique.
+        """)
+        if st.button("Calculer les valeurs génomiques", key="gblup_calcul"):
+            with st.spinner("Validation croisée et ajustement..."):
+                try:
+                    bilan_gblup = calculer_gblup_lait(forcer=True)
+                except ValueError as e:
+                    st.warning(str(e))
+                else:
+                    if bilan_gblup is None:
+                        st.info("Aucun génotype ou aucune performance laitière enregistré.")
+        derniere_gblup = db.fetchone("SELECT derniere_execution, details FROM executions_taches WHERE tache='gblup_lait'")
+        if derniere_gblup:
+            infos = json.loads(derniere_gblup[1])
+            col1, col2, col3, col4 = st.columns(4)
+            col1.metric("Animaux génotypés", f"{infos['animaux']:,}")
+            col2.metric("Avec performances", f"{infos['phenotypes']:,}")
+            col3.metric("SNPs", f"{infos['snps']:,}")
+            col4.metric("h² retenue", f"{infos['h2']:.2f}")
+            st.caption(f"Calcul du {derniere_gblup[0][:16]} (forme {infos['forme']}) en {infos['duree_s']:.1f} s")
+            validation = pd.DataFrame(infos["validation"])
+            fig = px.line(validation, x="h2", y="correlation", error_y="ecart_type", markers=True,
+                          title="Validation croisée : corrélation prédiction / performance corrigée",
+                          labels={"h2": "Héritabilité", "correlation": "Corrélation"})
+            st.plotly_chart(fig, use_container_width=True)
+
+            ids_troupeau = [b[0] for b in brebis_list]
+            if ids_troupeau:
+                jeunes = pd.read_sql_query(f"""
+                    SELECT b.numero_id, b.nom, b.race, b.date_naissance, v.valeur AS gebv_lait
+                    FROM valeurs_genetiques v
+                    JOIN brebis b ON v.brebis_id = b.id
+                    WHERE v.caractere='lait' AND v.methode='GBLUP' AND v.nb_performances=0
+                      AND b.id IN ({','.join('?' * len(ids_troupeau))})
+                    ORDER BY v.valeur DESC
+                    LIMIT 50
+                """, db.conn, params=ids_troupeau)
+                st.markdown("**Meilleures brebis sans contrôle laitier**")
+                st.dataframe(jeunes.round(3))
 
 # -----------------------------------------------------------------------------
 # PAGE SANTÉ
 # -----------------------------------------------------------------------------
 def page_sante():
     st.title("🏥 Suivi sanitaire et vaccinal")
+    detection_quotidienne_production()
 
     params = [st.session_state.user_id]
     query_brebis = """
@@ -2340,31 +6142,41 @@ def page_sante():
         else:
             st.info("Aucun modèle de prédiction entraîné. Vous pouvez en entraîner un avec l'onglet IA.")
 
-        prod_recentes = db.fetchall("""
-            SELECT quantite FROM productions 
-            WHERE brebis_id=? AND date >= date('now', '-60 days')
-            ORDER BY date
-        """, (bid,))
-        poids_recents = db.fetchall("""
-            SELECT poids_vif FROM composition_corporelle 
-            WHERE brebis_id=? AND date_estimation >= date('now', '-60 days')
-            ORDER BY date_estimation
+        st.subheader("Alertes de production laitière")
+        alertes = db.fetchall("""
+            SELECT date_alerte, type, score, message, statut FROM alertes_sante
+            WHERE brebis_id=? AND date_alerte >= date('now', '-30 days')
+            ORDER BY date_alerte DESC
         """, (bid,))
-
-        if len(prod_recentes) >= 5 and len(poids_recents) >= 5:
-            X_prod = np.array([p[0] for p in prod_recentes[-5:]]).reshape(1, -1)
-            X_poids = np.array([p[0] for p in poids_recents[-5:]]).reshape(1, -1)
-
-            anomaly_model_path = os.path.join(MODEL_DIR, 'anomaly_prod.pkl')
-            if os.path.exists(anomaly_model_path):
-                model_anomaly = joblib.load(anomaly_model_path)
-                pred = model_anomaly.predict(X_prod)
-                if pred[0] == -1:
-                    st.warning("⚠️ Anomalie détectée dans la production laitière récente.")
-                else:
-                    st.success("Production laitière normale.")
+        if alertes:
+            st.warning("⚠️ Anomalie détectée dans la production laitière récente.")
+            df_alertes = pd.DataFrame(alertes, columns=["Date", "Type", "Score", "Message", "Statut"])
+            st.dataframe(df_alertes.round(2), use_container_width=True, hide_index=True)
         else:
-            st.info("Pas assez de données pour la détection d'anomalies.")
+            st.success("Production laitière normale (aucune alerte sur 30 jours).")
+
+        with st.expander("🐑 Alertes du troupeau"):
+            params_alertes = [st.session_state.user_id]
+            query_alertes = """
+                SELECT a.date_alerte, b.numero_id, b.nom, a.type, a.score, a.message
+                FROM alertes_sante a
+                JOIN brebis b ON a.brebis_id = b.id
+                JOIN elevages e ON b.elevage_id = e.id
+                JOIN eleveurs el ON e.eleveur_id = el.id
+                WHERE el.user_id=? AND a.date_alerte >= date('now', '-7 days')
+            """
+            query_alertes, params_alertes = filtrer_par_eleveur(query_alertes, params_alertes, join_eleveur=True)
+            alertes_troupeau = db.fetchall(query_alertes + " ORDER BY a.date_alerte DESC, a.score", params_alertes)
+            if alertes_troupeau:
+                df_troupeau = pd.DataFrame(alertes_troupeau, columns=["Date", "Numéro", "Nom", "Type", "Score", "Message"])
+                st.dataframe(df_troupeau.round(2), use_container_width=True, hide_index=True)
+            else:
+                st.info("Aucune alerte sur les 7 derniers jours.")
+            if st.button("🔄 Relancer la détection sur le troupeau"):
+                resultat = detection_quotidienne_production(forcer=True)
+                st.success(f"{resultat['brebis']} brebis analysées en {resultat['duree_s']:.2f} s, "
+                           f"{resultat['alertes']} alertes.")
+                st.rerun()
 
         st.subheader("Recommandations vaccinales")
         dernier_vaccin_annuel = db.fetchone("""
@@ -2450,7 +6262,8 @@ def page_reproduction():
     selected = st.selectbox("Choisir une brebis", list(brebis_dict.keys()))
     bid = brebis_dict[selected]
     
-    tab1, tab2, tab3 = st.tabs(["🔥 Chaleurs", "🐏 Saillies", "🐑 Mises bas"])
+    tab1, tab2, tab3, tab4, tab5 = st.tabs(["🔥 Chaleurs", "🐏 Saillies", "🐑 Mises bas", "🌳 Pédigrée",
+                                            "📋 Plan d'accouplement"])
     
     with tab1:
         st.subheader("Observations des chaleurs / synchronisation")
@@ -2513,23 +6326,197 @@ def page_reproduction():
             date_mb = st.date_input("Date de mise bas", value=datetime.today().date())
             nb_agneaux = st.number_input("Nombre d'agneaux", min_value=1, step=1)
             poids_portee = st.number_input("Poids total de la portée (kg)", min_value=0.0, step=0.1)
+            agneaux = st.text_input("Identifiants des agneaux (séparés par des virgules)")
             remarques = st.text_area("Remarques")
             if st.form_submit_button("Enregistrer"):
-                db.execute(
-                    "INSERT INTO mises_bas (brebis_id, date_mise_bas, nb_agneaux, poids_portee, remarques) VALUES (?, ?, ?, ?, ?)",
-                    (bid, date_mb.isoformat(), nb_agneaux, poids_portee, remarques)
+                cursor = db.execute(
+                    "INSERT INTO mises_bas (brebis_id, date_mise_bas, nb_agneaux, poids_portee, remarques, agneaux) VALUES (?, ?, ?, ?, ?, ?)",
+                    (bid, date_mb.isoformat(), nb_agneaux, poids_portee, remarques, ", ".join(lire_agneaux(agneaux)) or None)
                 )
+                if enregistrer_mise_bas_pedigree(cursor.lastrowid):
+                    maj_consanguinite()
                 st.success("Mise bas enregistrée")
                 st.rerun()
         
         mbas = db.fetchall(
-            "SELECT date_mise_bas, nb_agneaux, poids_portee, remarques FROM mises_bas WHERE brebis_id=? ORDER BY date_mise_bas DESC",
+            "SELECT date_mise_bas, nb_agneaux, agneaux, poids_portee, remarques FROM mises_bas WHERE brebis_id=? ORDER BY date_mise_bas DESC",
             (bid,)
         )
         if mbas:
-            df = pd.DataFrame(mbas, columns=["Date", "Agneaux", "Poids portée (kg)", "Remarques"])
+            df = pd.DataFrame(mbas, columns=["Date", "Agneaux", "Identifiants", "Poids portée (kg)", "Remarques"])
             st.dataframe(df, use_container_width=True, hide_index=True)
 
+    with tab4:
+        st.subheader("Pédigrée et consanguinité")
+        st.caption(f"Le père d'un agneau est le bélier de la saillie enregistrée environ "
+                   f"{Config.PEDIGREE_GESTATION_JOURS} jours avant la mise bas.")
+        col1, col2 = st.columns(2)
+        with col1:
+            if st.button("🔄 Reconstruire depuis les saillies et mises bas"):
+                bilan = construire_pedigree()
+                calcul = maj_consanguinite()
+                st.success(f"{bilan['agneaux']} agneaux reliés ({bilan['agneaux_sans_pere']} sans père retrouvé), "
+                           f"{calcul['calcules']} coefficients calculés en {calcul['duree_s']:.1f} s")
+            if st.button("🧮 Recalculer toute la consanguinité"):
+                calcul = maj_consanguinite(forcer=True)
+                st.success(f"{calcul['animaux']} animaux en {calcul['duree_s']:.1f} s")
+        with col2:
+            fichier_ped = st.file_uploader("Importer un pédigrée (CSV : animal, pere, mere, date_naissance)", type=["csv"])
+            if fichier_ped is not None and st.button("Importer"):
+                try:
+                    n_import = importer_pedigree(pd.read_csv(fichier_ped, dtype=str))
+                    calcul = maj_consanguinite()
+                    st.success(f"{n_import} animaux importés, {calcul['calcules']} coefficients mis à jour")
+                except ValueError as e:
+                    st.error(str(e))
+
+        try:
+            ped = matrice_pedigree(version_donnees("pedigree"))
+        except ValueError as e:
+            st.error(str(e))
+            ped = None
+        numeros = [b[1] for b in brebis_list]
+        df_f = pd.read_sql_query(f"""
+            SELECT p.animal AS Animal, p.pere AS Père, p.mere AS Mère, p.date_naissance AS Naissance, c.F
+            FROM pedigree p
+            LEFT JOIN consanguinite c ON c.animal = p.animal
+            WHERE p.animal IN (SELECT value FROM json_each(?))
+               OR p.mere IN (SELECT value FROM json_each(?))
+            ORDER BY c.F DESC
+        """, db.conn, params=(json.dumps(numeros), json.dumps(numeros)))
+        if ped is None or df_f.empty:
+            st.info("Pédigrée vide : saisissez les agneaux à la mise bas ou importez un fichier.")
+        else:
+            col1, col2, col3 = st.columns(3)
+            col1.metric("Animaux au pédigrée", len(ped["animaux"]))
+            col2.metric("F moyen (troupeau)", f"{df_f['F'].mean():.3f}")
+            col3.metric("F ≥ 0,0625", int((df_f["F"] >= 0.0625).sum()))
+            st.dataframe(df_f.head(1000), use_container_width=True, hide_index=True)
+            st.plotly_chart(px.histogram(df_f, x="F", nbins=40, title="Distribution des coefficients de consanguinité"),
+                            use_container_width=True)
+
+            st.markdown("**Parenté entre deux animaux**")
+            col1, col2 = st.columns(2)
+            animal_a = col1.text_input("Animal 1")
+            animal_b = col2.text_input("Animal 2")
+            if animal_a and animal_b:
+                try:
+                    a_ij = parente_entre(ped, coefficients_consanguinite(ped), [animal_a.strip()], [animal_b.strip()]).iloc[0, 0]
+                    st.info(f"Parenté additive : {a_ij:.4f} — consanguinité d'un descendant : {a_ij / 2:.4f}")
+                except KeyError:
+                    st.warning("Animal absent du pédigrée")
+
+        st.markdown("---")
+        st.subheader("Vérification de parenté par SNPs")
+        st.caption(f"Compte les homozygotes opposés entre chaque agneau génotypé et ses parents déclarés, puis "
+                   f"contre tous les béliers génotypés ; un parent est exclu au-delà de "
+                   f"{Config.PARENTE_TAUX_EXCLUSION_MAX:.0%} de SNPs incompatibles.")
+        if st.button("🔍 Vérifier les parentés"):
+            with st.spinner("Comparaison des agneaux à tous les béliers candidats..."):
+                try:
+                    bilan_parente = verifier_parentes()
+                except ValueError as e:
+                    st.warning(str(e))
+                else:
+                    if bilan_parente is None:
+                        st.info("Aucun agneau génotypé avec des parents déclarés.")
+        derniere_parente = db.fetchone("SELECT derniere_execution, details FROM executions_taches WHERE tache='verification_parente'")
+        if derniere_parente:
+            infos = json.loads(derniere_parente[1])
+            col1, col2, col3, col4 = st.columns(4)
+            col1.metric("Agneaux vérifiés", infos["agneaux"])
+            col2.metric("Pères exclus", infos["peres_exclus"])
+            col3.metric("Mères exclues", infos["meres_exclues"])
+            col4.metric("Pères proposés", infos["suggestions"])
+            st.caption(f"Vérification du {derniere_parente[0][:16]} : {infos['beliers']} béliers candidats, "
+                       f"{infos['snps']} SNPs en {infos['duree_s']:.1f} s")
+            anomalies = pd.read_sql_query("""
+                SELECT animal, pere_declare, statut_pere, exclusions_pere, snps_pere,
+                       mere_declaree, statut_mere, exclusions_mere, snps_mere,
+                       pere_suggere, exclusions_suggere, snps_suggere
+                FROM verifications_parente
+                WHERE (animal IN (SELECT value FROM json_each(?)) OR mere_declaree IN (SELECT value FROM json_each(?)))
+                  AND (statut_pere = 'exclu' OR statut_mere = 'exclu'
+                       OR (pere_suggere IS NOT NULL AND pere_suggere != COALESCE(pere_declare, '')))
+                ORDER BY statut_pere, animal
+            """, db.conn, params=(json.dumps(numeros), json.dumps(numeros)))
+            if anomalies.empty:
+                st.success("Toutes les parentés vérifiables sont compatibles.")
+            else:
+                st.dataframe(anomalies, use_container_width=True, hide_index=True)
+                a_corriger = anomalies.loc[anomalies["pere_suggere"].notna() &
+                                           anomalies["statut_pere"].isin(["exclu", "inconnu", "non_genotype"]), "animal"]
+                if len(a_corriger) and st.button(f"✅ Appliquer les {len(a_corriger)} pères proposés au pédigrée"):
+                    try:
+                        n_corriges = appliquer_peres_suggeres(a_corriger.tolist())
+                    except ValueError as e:
+                        st.error(f"Corrections annulées : {e}")
+                    else:
+                        calcul = maj_consanguinite()
+                        st.success(f"{n_corriges} pères corrigés, {calcul['calcules']} coefficients de consanguinité recalculés")
+
+    with tab5:
+        st.subheader("Plan d'accouplement du troupeau")
+        st.caption("Affecte un bélier à chaque brebis en maximisant le mérite attendu des agneaux "
+                   "(valeurs génétiques BLUP) pénalisé par leur consanguinité, dans la limite des capacités des béliers.")
+        ids_brebis = [b[0] for b in brebis_list]
+        etats = dict(db.fetchall(
+            f"SELECT id, etat_physio FROM brebis WHERE id IN ({','.join('?' * len(ids_brebis))})", tuple(ids_brebis)
+        ))
+        exclus = st.multiselect("États physiologiques exclus", Config.ETATS_PHYSIO,
+                                default=["Jeune", "Gestation début", "Gestation fin"])
+        a_saillir = [b for b in brebis_list if etats.get(b[0]) not in exclus]
+
+        connus = [r[0] for r in db.fetchall(f"""
+            SELECT DISTINCT TRIM(male_id) FROM saillies
+            WHERE brebis_id IN ({','.join('?' * len(ids_brebis))}) AND TRIM(COALESCE(male_id, '')) <> ''
+            ORDER BY 1
+        """, tuple(ids_brebis))]
+        df_beliers = st.data_editor(
+            pd.DataFrame({"Bélier": connus, "Capacité": Config.ACCOUPLEMENT_CAPACITE}),
+            num_rows="dynamic", use_container_width=True, key="beliers_plan"
+        ).dropna(subset=["Bélier"])
+        df_beliers["Bélier"] = df_beliers["Bélier"].astype(str).str.strip()
+        df_beliers = df_beliers[df_beliers["Bélier"] != ""].drop_duplicates("Bélier")
+
+        col1, col2 = st.columns(2)
+        penalite = col1.number_input("Pénalité (L/j de mérite par unité de F)", min_value=0.0,
+                                     value=Config.ACCOUPLEMENT_PENALITE_F, step=1.0)
+        F_max = col2.slider("Consanguinité maximale des agneaux", 0.0, 0.5, Config.ACCOUPLEMENT_F_MAX, 0.0025)
+        st.write(f"{len(a_saillir)} brebis à saillir, {len(df_beliers)} béliers, "
+                 f"{int(df_beliers['Capacité'].fillna(0).sum())} saillies possibles")
+
+        if st.button("🧮 Calculer le plan") and a_saillir and len(df_beliers):
+            debut_plan = time.perf_counter()
+            beliers = df_beliers["Bélier"].tolist()
+            F_desc, merite = matrice_accouplements([b[1] for b in a_saillir], beliers)
+            affectation = optimiser_accouplements(F_desc, merite, df_beliers["Capacité"].fillna(0).to_numpy(),
+                                                  penalite_F=penalite, F_max=F_max)
+            plan_id = enregistrer_plan_accouplement([b[0] for b in a_saillir], beliers, affectation, F_desc, merite)
+            st.success(f"Plan {plan_id} : {(affectation >= 0).sum()} brebis affectées en "
+                       f"{time.perf_counter() - debut_plan:.1f} s")
+            if (affectation < 0).any():
+                st.warning(f"{(affectation < 0).sum()} brebis sans bélier (capacités insuffisantes ou consanguinité trop élevée)")
+
+        dernier_plan = db.fetchone("SELECT plan_id, date_plan FROM plans_accouplement ORDER BY id DESC LIMIT 1")
+        if dernier_plan:
+            df_plan = pd.read_sql_query(f"""
+                SELECT b.numero_id AS Brebis, b.nom AS Nom, p.belier AS Bélier,
+                       p.F_descendant AS "F agneau", p.merite AS "Mérite attendu"
+                FROM plans_accouplement p
+                JOIN brebis b ON p.brebis_id = b.id
+                WHERE p.plan_id = ? AND p.brebis_id IN ({','.join('?' * len(ids_brebis))})
+                ORDER BY p.belier, b.numero_id
+            """, db.conn, params=[dernier_plan[0]] + ids_brebis)
+            if not df_plan.empty:
+                st.markdown(f"**Dernier plan** ({dernier_plan[1][:16]})")
+                col1, col2 = st.columns(2)
+                col1.metric("F moyen des agneaux", f"{df_plan['F agneau'].mean():.4f}")
+                col2.metric("Mérite moyen attendu", f"{df_plan['Mérite attendu'].mean():.3f}")
+                st.dataframe(df_plan.round(4), use_container_width=True, hide_index=True)
+                st.download_button("📥 Exporter le plan (CSV)", df_plan.to_csv(index=False).encode("utf-8"),
+                                   f"plan_accouplement_{dernier_plan[0]}.csv", "text/csv")
+
 # -----------------------------------------------------------------------------
 # PAGE NUTRITION AVANCÉE
 # -----------------------------------------------------------------------------
@@ -2963,14 +6950,37 @@ def page_elite():
         """, (bid,))
         rendement.append(comp[0] if comp else None)
     df["rendement (%)"] = rendement
+
+    # Valeurs génétiques BLUP : corrigées de l'élevage-année et de l'âge, contrairement aux moyennes brutes
+    col1, col2 = st.columns([1, 3])
+    with col1:
+        if st.button("🧬 Calculer les valeurs génétiques (BLUP)"):
+            with st.spinner("Résolution des équations du modèle mixte..."):
+                bilan = calculer_blup_lait(forcer=True)
+            if bilan is None:
+                st.warning(f"Aucune campagne avec au moins {Config.BLUP_MIN_CONTROLES} contrôles laitiers.")
+    with col2:
+        derniere_blup = db.fetchone("SELECT derniere_execution, details FROM executions_taches WHERE tache='blup_lait'")
+        if derniere_blup:
+            infos = json.loads(derniere_blup[1])
+            st.caption(f"BLUP du {derniere_blup[0][:16]} : {infos['animaux']} animaux, {infos['performances']} performances, "
+                       f"{infos['iterations']} itérations en {infos['duree_s']:.1f} s")
+    ebv = pd.Series(dict(db.fetchall(
+        "SELECT brebis_id, valeur FROM valeurs_genetiques WHERE caractere='lait' AND methode='BLUP' AND brebis_id IS NOT NULL"
+    )), dtype=float)
+    df["ebv_lait (L/j)"] = ebv.reindex(df["id"]).to_numpy()
+    gebv = pd.Series(dict(db.fetchall(
+        "SELECT brebis_id, valeur FROM valeurs_genetiques WHERE caractere='lait' AND methode='GBLUP' AND brebis_id IS NOT NULL"
+    )), dtype=float)
+    df["gebv_lait (L/j)"] = gebv.reindex(df["id"]).to_numpy()
     
     st.subheader("📊 Tableau des brebis")
-    colonnes_affichees = ["numero", "nom", "eleveur", "elevage", "race", "poids", "prod_moy (L/j)", "score_morpho", "viande_estimee (kg)", "rendement (%)"]
+    colonnes_affichees = ["numero", "nom", "eleveur", "elevage", "race", "poids", "prod_moy (L/j)", "ebv_lait (L/j)", "gebv_lait (L/j)", "score_morpho", "viande_estimee (kg)", "rendement (%)"]
     st.dataframe(df[colonnes_affichees].round(2))
     
     st.subheader("🏆 Classement")
     critere = st.selectbox("Critère de classement", 
-                           ["prod_moy (L/j)", "score_morpho", "viande_estimee (kg)", "poids", "rendement (%)"])
+                           ["prod_moy (L/j)", "ebv_lait (L/j)", "gebv_lait (L/j)", "score_morpho", "viande_estimee (kg)", "poids", "rendement (%)"])
     top_n = st.slider("Nombre de brebis à afficher", 5, 50, 10)
     ascending = st.checkbox("Ordre croissant", False)
     
@@ -3053,88 +7063,91 @@ def page_ia():
                         model, score = result
                         st.success(f"Modèle entraîné avec un score R² de {score:.2f} sur le test.")
 
+        with st.expander("📊 Comparer les modèles (validation croisée et coûts)"):
+            n_splits = st.slider("Nombre de plis", 3, 10, 5, key="eval_plis")
+            if st.button("Lancer l'évaluation"):
+                with st.spinner("Validation croisée en cours..."):
+                    rapport = evaluer_modeles_lait(n_splits=n_splits)
+                if rapport is None:
+                    st.error("Pas assez de données (minimum 20 brebis avec productions).")
+                else:
+                    st.dataframe(rapport.round(3), use_container_width=True, hide_index=True)
+                    fig = px.bar(rapport, x="modele", y="r2_cv", error_y="r2_cv_std",
+                                 hover_data=["latence_10k_ms", "taille_disque_ko"],
+                                 title="R² en validation croisée")
+                    st.plotly_chart(fig, use_container_width=True)
+                    st.caption(f"Rapport enregistré : {rapport.attrs['chemin']}")
+                    st.download_button("📥 Télécharger le rapport CSV", rapport.to_csv(index=False).encode('utf-8'),
+                                       file_name=os.path.basename(rapport.attrs["chemin"]), mime="text/csv")
+
     with tab2:
         st.subheader("Détection d'anomalies (Isolation Forest)")
-        params = [st.session_state.user_id]
-        query_brebis = """
-            SELECT b.id, b.numero_id, b.nom, b.poids_vif,
-                   AVG(p.quantite) as prod_moy,
-                   AVG(m.score_global) as score_morpho
-            FROM brebis b
-            LEFT JOIN productions p ON b.id = p.brebis_id AND p.date >= date('now', '-30 days')
-            LEFT JOIN mesures_morpho m ON b.id = m.brebis_id
-            JOIN elevages e ON b.elevage_id = e.id
-            JOIN eleveurs el ON e.eleveur_id = el.id
-            WHERE el.user_id=?
-            GROUP BY b.id
-        """
-        query_brebis, params = filtrer_par_eleveur(query_brebis, params, join_eleveur=True)
-        df = pd.read_sql_query(query_brebis, db.conn, params=params)
-        if df.empty:
+        forcer = st.button("🔄 Réentraîner le détecteur", key="refit_anomalies")
+        info = maj_scores_anomalies(st.session_state.user_id, forcer=forcer)
+        if info["artefact"] is None:
             st.warning("Aucune donnée disponible.")
         else:
-            df['viande_estimee'] = df['poids_vif'] * 0.45
-            df['prod_moy'] = df['prod_moy'].fillna(0)
-            df['score_morpho'] = df['score_morpho'].fillna(0)
-            
-            features = ['prod_moy', 'score_morpho', 'poids_vif', 'viande_estimee']
-            X = df[features].fillna(0)
-            model = IsolationForest(contamination=0.1, random_state=42)
-            preds = model.fit_predict(X)
-            df['anomalie'] = preds
-            anomalies = df[df['anomalie'] == -1]
+            if info["reentraine"]:
+                st.info(f"Détecteur réentraîné ({info['motif']}).")
+            st.caption(f"Modèle du {info['artefact']['date'][:16]} – {info['artefact']['n']} brebis, "
+                       f"{info['rescores']} brebis rescorées, dérive {info['derive']:.2f}")
+
+            params = [st.session_state.user_id]
+            query_scores = """
+                SELECT b.numero_id, b.nom, s.prod_moy, s.score_morpho, s.poids_vif, s.score, s.anomalie
+                FROM scores_anomalies s
+                JOIN brebis b ON s.brebis_id = b.id
+                JOIN elevages e ON b.elevage_id = e.id
+                JOIN eleveurs el ON e.eleveur_id = el.id
+                WHERE el.user_id=?
+            """
+            query_scores, params = filtrer_par_eleveur(query_scores, params, join_eleveur=True)
+            df = pd.read_sql_query(query_scores + " ORDER BY s.score", db.conn, params=params)
+            anomalies = df[df['anomalie'] == 1]
             st.write(f"**{len(anomalies)}** brebis potentiellement anormales détectées.")
             if not anomalies.empty:
-                st.dataframe(anomalies[['numero_id', 'nom', 'prod_moy', 'score_morpho', 'poids_vif']])
+                st.dataframe(anomalies[['numero_id', 'nom', 'prod_moy', 'score_morpho', 'poids_vif', 'score']])
             else:
                 st.success("Aucune anomalie détectée.")
 
     with tab3:
-        st.subheader("Clustering des brebis (K-Means)")
-        params = [st.session_state.user_id]
-        query_brebis = """
-            SELECT b.id, b.numero_id, b.nom, b.poids_vif,
-                   AVG(p.quantite) as prod_moy,
-                   AVG(m.score_global) as score_morpho
-            FROM brebis b
-            LEFT JOIN productions p ON b.id = p.brebis_id AND p.date >= date('now', '-30 days')
-            LEFT JOIN mesures_morpho m ON b.id = m.brebis_id
-            JOIN elevages e ON b.elevage_id = e.id
-            JOIN eleveurs el ON e.eleveur_id = el.id
-            WHERE el.user_id=?
-            GROUP BY b.id
-        """
-        query_brebis, params = filtrer_par_eleveur(query_brebis, params, join_eleveur=True)
-        df = pd.read_sql_query(query_brebis, db.conn, params=params)
+        st.subheader("Clustering des brebis (MiniBatch K-Means)")
+        version = f"{version_donnees('brebis', 'productions', 'mesures_morpho')}|{datetime.now().date()}"
+        with st.spinner("Évaluation des nombres de clusters..."):
+            clustering = service_clustering(st.session_state.user_id, st.session_state.eleveur_id, version)
         
-        if df.empty:
-            st.warning("Aucune donnée disponible pour le clustering.")
+        if clustering is None:
+            st.warning("Pas assez de brebis pour effectuer un clustering (minimum 3).")
         else:
-            df['viande_estimee'] = df['poids_vif'] * 0.45
-            df['prod_moy'] = df['prod_moy'].fillna(0)
-            df['score_morpho'] = df['score_morpho'].fillna(0)
+            df = clustering["df"].copy()
+            evaluation = clustering["evaluation"]
+            k_values = evaluation["k"].tolist()
+            
+            with st.expander("📐 Choix du nombre de clusters (inertie / silhouette)"):
+                fig_k = go.Figure()
+                fig_k.add_trace(go.Scatter(x=evaluation["k"], y=evaluation["inertie"], name="Inertie", mode="lines+markers"))
+                fig_k.add_trace(go.Scatter(x=evaluation["k"], y=evaluation["silhouette"], name="Silhouette",
+                                           mode="lines+markers", yaxis="y2"))
+                fig_k.update_layout(xaxis_title="k", yaxis=dict(title="Inertie"),
+                                    yaxis2=dict(title="Silhouette", overlaying="y", side="right"))
+                st.plotly_chart(fig_k, use_container_width=True)
+                st.caption(f"k recommandé (silhouette maximale) : {clustering['meilleur_k']}")
             
-            n_brebis = len(df)
-            max_clusters = min(5, n_brebis)
-            if max_clusters < 2:
-                st.warning(f"Pas assez de brebis ({n_brebis}) pour effectuer un clustering (minimum 2).")
+            if len(k_values) == 1:
+                # Petit troupeau : un seul k évalué, un slider min == max serait refusé par Streamlit
+                n_clusters = k_values[0]
+                st.caption(f"Nombre de clusters : {n_clusters} (seule valeur possible pour {len(df)} brebis)")
             else:
-                n_clusters = st.slider("Nombre de clusters", 2, max_clusters, min(3, max_clusters))
-                
-                features = ['prod_moy', 'score_morpho', 'poids_vif', 'viande_estimee']
-                X = df[features].fillna(0)
-                scaler = StandardScaler()
-                X_scaled = scaler.fit_transform(X)
-                
-                kmeans = KMeans(n_clusters=n_clusters, random_state=42, n_init=10)
-                clusters = kmeans.fit_predict(X_scaled)
-                df['cluster'] = clusters
-                
-                fig = px.scatter_3d(df, x='prod_moy', y='score_morpho', z='poids_vif', color='cluster',
-                                     hover_data=['numero_id', 'nom'], title="Clusters des brebis")
-                st.plotly_chart(fig, use_container_width=True)
-                
-                st.dataframe(df.groupby('cluster')[features].mean().round(2))
+                n_clusters = st.slider("Nombre de clusters", min(k_values), max(k_values), clustering["meilleur_k"])
+            
+            features = FEATURES_IA
+            df['cluster'] = clustering["labels"][n_clusters]
+            
+            fig = px.scatter_3d(df, x='prod_moy', y='score_morpho', z='poids_vif', color='cluster',
+                                 hover_data=['numero_id', 'nom'], title="Clusters des brebis")
+            st.plotly_chart(fig, use_container_width=True)
+            
+            st.dataframe(df.groupby('cluster')[features].mean().round(2))
 
     with tab4:
         st.subheader("Analyse exploratoire d'un fichier externe")